@@ -1,157 +1,607 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+import functools
+import json
+import logging
 import os
-from dotenv import load_dotenv
-from utils.db_utils import init_db, query_db_with_image_and_text, combine_text
-from utils.gpt_utils import query_openai_with_image_and_text
-import traceback
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.db_utils import (
+    embed_images,
+    from_fallback,
+    retrieve_neighbours,
+    search_db_by_embeddings_with_scores,
+    combine_shortlist_text
+)
+from utils.gpt_utils import (
+    query_openai_with_image_and_text,
+    stream_openai_with_image_and_text,
+    diagnosis_result,
+    parse_diagnosis_response
+)
+from utils.image_utils import UploadBuffer, UploadRejected, normalize_image, sniff_image_format, upload_buffer
+from utils.cache_utils import hash_image_bytes
+from utils.batch_utils import EmbeddingBatcher
+from utils.vote_utils import prediction_payload
+from utils.admission_utils import AdmissionRejected, admission_params
+from utils.health_utils import readiness_status
+from utils.log_utils import REQUEST_ID_HEADER, bind_request_id
+from utils.metrics_utils import REGISTRY, REQUESTS, REQUEST_SECONDS, ERRORS, StageTimer
+import services
+from services import (
+    api_key,
+    OPENAI_MODEL,
+    OPENAI_MAX_TOKENS,
+    OPENAI_TEMPERATURE,
+    RETRIEVAL_K,
+    ServiceWarmingUp,
+    readiness_probe
+)
 
-print("Starting Flask application...")
+logger = logging.getLogger(__name__)
+logger.info("Starting Flask application...")
+
+# Largest accepted image, enforced while the multipart body streams in
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+# Room for the non-file form fields (patient history, mode) on top of the images
+UPLOAD_FORM_BYTES = int(os.getenv('UPLOAD_FORM_BYTES', str(256 * 1024)))
+
+class UploadRequest(Request):
+    """
+    Keeps uploaded files in memory instead of Werkzeug's spooled temporary files, so the
+    decode stage can read them through a memoryview with no extra copy. Memory per
+    request is bounded by max_content_length and UPLOAD_MAX_BYTES per file.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadBuffer(UPLOAD_MAX_BYTES)
 
 app = Flask(__name__)
-CORS(app)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + UPLOAD_FORM_BYTES
+CORS(app, expose_headers=[REQUEST_ID_HEADER, "Server-Timing", "Retry-After"])
 
-print("Loading environment variables...")
-load_dotenv()
-api_key = os.getenv('OPENAI_API_KEY')
+def endpoint_label():
+    # The route pattern rather than the raw path, so metric label values stay bounded
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
 
-if not api_key:
-    print("ERROR: OPENAI_API_KEY not found in environment variables")
-    raise ValueError("OPENAI_API_KEY not found in environment variables")
-else:
-    print("OpenAI API key loaded successfully")
-
-print("Initializing database connection...")
-try:
-    print("Attempting to initialize embedding function and connect to database...")
-    multimodal_ef, db = init_db()
-    print("Database connection established successfully!")
-except Exception as e:
-    print(f"Failed to initialize database: {str(e)}")
-    print("Full error:")
-    print(traceback.format_exc())
-    raise
+@app.before_request
+def start_request():
+    """Bind the request id (from X-Request-ID or a new one) and start the stage timer"""
+    g.request_id = bind_request_id(request.headers.get(REQUEST_ID_HEADER))
+    g.started = time.perf_counter()
+    g.timer = StageTimer(endpoint_label())
+
+@app.after_request
+def finish_request(response):
+    """
+    Record request count and latency and return the correlation headers.
+    For streamed responses this runs when the stream opens, so latency is time to first byte.
+    """
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    if g.timer.stages:
+        response.headers["Server-Timing"] = g.timer.server_timing()
+    endpoint = endpoint_label()
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    return response
+
+@app.errorhandler(ServiceWarmingUp)
+def handle_warming_up(error):
+    """Requests that need the model before warm-up finishes"""
+    return jsonify({"error": str(error), "startup": services.startup.report()}), 503, {"Retry-After": "5"}
+
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(error):
+    """Requests shed by the admission layer: 503 when overloaded, 429 over the per-client limit"""
+    logger.info("Shed request (%s): %s", error.reason, error)
+    return jsonify({"error": str(error), "reason": error.reason}), error.status, {"Retry-After": str(error.retry_after)}
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(error):
+    """Uploads over the request or per-image byte limit, rejected while streaming in"""
+    message = error.description
+    if message == RequestEntityTooLarge.description:
+        message = f"Request body exceeds {request.max_content_length} bytes"
+    logger.info("Rejected upload: %s", message)
+    return jsonify({"error": message}), 413
+
+@app.errorhandler(UploadRejected)
+def handle_upload_rejected(error):
+    """Unsupported formats and oversized dimensions, found before the image is decoded"""
+    logger.info("Rejected upload: %s", error)
+    return jsonify({"error": str(error)}), error.status
 
 @app.errorhandler(Exception)
 def handle_error(error):
     """Global error handler"""
-    print(f"Error occurred: {str(error)}")
-    print("Full traceback:")
-    print(traceback.format_exc())
+    ERRORS.inc(endpoint=endpoint_label(), type=error.__class__.__name__)
+    logger.exception("Error occurred: %s", error)
     return jsonify({
         "error": str(error),
         "type": error.__class__.__name__
     }), 500
 
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({"status": "alive"}), 200
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: IRIS answers a bounded query and the CLIP model is loaded"""
+    result = readiness_probe.check()
+    return jsonify(dict(result, status=readiness_status(result))), 200 if result["ready"] else 503
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    print("Health check requested")
-    try:
-        # Test database connection
-        db.get()
-        print("Health check successful")
+    result = readiness_probe.check()
+    if result["ready"]:
         return jsonify({
             "status": "healthy",
-            "database": "connected"
+            "database": result["database"]
         }), 200
-    except Exception as e:
-        print(f"Health check failed: {str(e)}")
-        return jsonify({
-            "status": "unhealthy",
-            "database": "disconnected",
-            "error": str(e)
-        }), 500
+    startup = result.get("startup", {})
+    error = result.get("error") or startup.get("error") or readiness_status(result)
+    logger.warning("Health check failed: %s", error)
+    return jsonify({
+        "status": "unhealthy",
+        "database": result["database"],
+        "error": error
+    }), 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of request, stage, cache, token and batching metrics"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Cache hit/miss counters and embedding batch histograms"""
+    return jsonify({
+        "cache": services.prediction_cache.stats(),
+        "admission": services.admission.stats() if services.admission is not None else None,
+        "embedding_batches": (
+            services.image_embedder.stats()
+            if isinstance(services.image_embedder, EmbeddingBatcher) else None
+        )
+    }), 200
+
+def admission_controlled(default_priority):
+    """
+    Run the view only once services.admission admits it. The slot is held until the
+    response is sent; for streamed responses, until the stream closes.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            controller = services.admission
+            if controller is None:
+                return view(*args, **kwargs)
+            priority, client, timeout = admission_params(request.headers, request.remote_addr, default_priority)
+            with g.timer.stage("admission"):
+                controller.acquire(priority, client, timeout)
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                controller.release(priority, client)
+                raise
+            if response.is_streamed:
+                response.call_on_close(lambda: controller.release(priority, client))
+            else:
+                controller.release(priority, client)
+            return response
+        return wrapper
+    return decorator
+
+# Client errors raised while reading the upload, answered by their own handlers
+UPLOAD_ERRORS = (RequestEntityTooLarge, UploadRejected)
+
+def validate_predict_request():
+    """
+    Check the multipart form for /predict and /predict/stream. The image format is
+    sniffed from its magic bytes; the filename is not trusted.
+    Returns (image, patient_history, None) or (None, None, error_response).
+    """
+    if 'image' not in request.files:
+        logger.info("Rejected request: no image provided")
+        return None, None, (jsonify({"error": "No image provided"}), 400)
+    
+    if 'patient_history' not in request.form:
+        logger.info("Rejected request: no patient history provided")
+        return None, None, (jsonify({"error": "No patient history provided"}), 400)
+    
+    image = request.files['image']
+    patient_hist = request.form['patient_history']
+    
+    logger.debug("Processing image: %s", image.filename)
+    
+    # Validate image
+    if not image.filename:
+        logger.info("Rejected request: empty image file")
+        return None, None, (jsonify({"error": "Empty image file"}), 400)
+    
+    with upload_buffer(image) as data:
+        if not data.nbytes:
+            logger.info("Rejected request: empty image file")
+            return None, None, (jsonify({"error": "Empty image file"}), 400)
+        if sniff_image_format(data) is None:
+            logger.info("Rejected request: invalid image format: %s", image.filename)
+            return None, None, (jsonify({"error": "Invalid image format. Must be PNG or JPEG"}), 400)
+    
+    return image, patient_hist, None
+
+def predict_mode():
+    """
+    The "mode" form field (or query parameter), defaulting to PREDICT_DEFAULT_MODE.
+    Returns (mode, None) or (None, error_response).
+    """
+    mode = (request.form.get('mode') or request.args.get('mode') or services.DEFAULT_PREDICT_MODE).lower()
+    if mode not in services.PREDICT_MODES:
+        return None, (jsonify({"error": f"Unknown mode, expected one of {', '.join(services.PREDICT_MODES)}"}), 400)
+    return mode, None
+
+def shortlist(scored_results, timer):
+    """Vote the neighbours into a diagnosis shortlist; returns (shortlist, dominant or None)"""
+    with timer.stage("vote"):
+        return services.shortlist_neighbours(scored_results)
 
 @app.route('/predict', methods=['POST'])
+@admission_controlled("interactive")
 def predict():
-    print("Prediction requested")
+    logger.debug("Prediction requested")
+    services.require_ready()
+    timer = g.timer
     try:
-        # Validate request
-        if 'image' not in request.files:
-            print("Error: No image provided in request")
-            return jsonify({"error": "No image provided"}), 400
-        
-        if 'patient_history' not in request.form:
-            print("Error: No patient history provided in request")
-            return jsonify({"error": "No patient history provided"}), 400
-        
-        image = request.files['image']
-        patient_hist = request.form['patient_history']
-        
-        print(f"Processing image: {image.filename}")
+        with timer.stage("upload"):
+            image, patient_hist, error_response = validate_predict_request()
+            if error_response:
+                return error_response
+            mode, error_response = predict_mode()
+            if error_response:
+                return error_response
         
-        # Validate image
-        if not image.filename:
-            print("Error: Empty image file")
-            return jsonify({"error": "Empty image file"}), 400
-        
-        if not image.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            print(f"Error: Invalid image format: {image.filename}")
-            return jsonify({"error": "Invalid image format. Must be PNG or JPEG"}), 400
-        
-        # Save image temporarily
-        temp_path = "temp_image.jpg"
         try:
-            print("Saving temporary image file...")
-            image.save(temp_path)
+            # Decode and normalize the upload once, straight from the request buffer;
+            # CLIP and the LLM payload share the result
+            with timer.stage("decode"), upload_buffer(image) as image_bytes:
+                decoded_image = normalize_image(image_bytes)
+                image_hash = hash_image_bytes(decoded_image)
             
-            # Verify image can be opened
-            from PIL import Image
-            Image.open(temp_path).verify()
-            print("Image verified successfully")
+            cached_response = services.prediction_cache.get_response(
+                image_hash, patient_hist, OPENAI_MODEL, OPENAI_TEMPERATURE
+            )
+            if cached_response is not None:
+                logger.debug("Returning cached prediction")
+                with timer.stage("serialize"):
+                    return jsonify(cached_response), 200
             
-            print("Querying database...")
-            results = query_db_with_image_and_text(temp_path, multimodal_ef, db)
+            scored_results = retrieve_neighbours(
+                decoded_image,
+                services.image_embedder,
+                services.search_index,
+                k=RETRIEVAL_K,
+                cache=services.prediction_cache,
+                image_hash=image_hash,
+                timer=timer
+            )
             
-            if not results:
-                print("No similar images found in database")
+            if not scored_results:
+                logger.info("No similar images found in database")
                 return jsonify({"error": "No similar images found in database"}), 404
             
-            print("Combining text...")
-            combined_output = combine_text(results, patient_hist)
+            ranked, dominant = shortlist(scored_results, timer)
+            answer = services.retrieval_answer(ranked, dominant, mode)
+            if answer is not None:
+                # Answered from retrieval and the knowledge store; only LLM answers are cached
+                logger.debug("Answered without the LLM (%s)", answer["source"])
+                with timer.stage("serialize"):
+                    return jsonify(prediction_payload(answer, ranked, early_exit=dominant is not None)), 200
             
-            print("Querying OpenAI...")
-            response = query_openai_with_image_and_text(
-                text_prompt=combined_output,
-                image_source=temp_path,
+            # query_openai_with_image_and_text times the "prompt" and "llm" stages itself
+            result = query_openai_with_image_and_text(
+                text_prompt=combine_shortlist_text(ranked, patient_hist),
+                image_source=decoded_image,
                 api_key=api_key,
-                model="gpt-4o",
-                max_tokens=1000,
-                temperature=0.4
+                model=OPENAI_MODEL,
+                max_tokens=OPENAI_MAX_TOKENS,
+                temperature=OPENAI_TEMPERATURE,
+                client=services.openai_client,
+                timer=timer
             )
+            payload = prediction_payload(result, ranked)
+            services.keep_answer(image_hash, patient_hist, result, ranked, payload, scored_results)
             
-            print("Processing completed successfully")
-            return jsonify({
-                "response": response,
-                "similar_diagnoses": [r.metadata.get("diagnosis") for r in results]
-            }), 200
+            logger.debug("Processing completed successfully")
+            with timer.stage("serialize"):
+                return jsonify(payload), 200
             
+        except UPLOAD_ERRORS:
+            raise
         except Exception as e:
-            print(f"Error processing image: {str(e)}")
-            print("Full traceback:")
-            print(traceback.format_exc())
+            logger.exception("Error processing image")
             raise Exception(f"Error processing image: {str(e)}")
-        
-        finally:
-            # Clean up temporary file
-            if os.path.exists(temp_path):
-                print("Cleaning up temporary file...")
-                os.remove(temp_path)
                 
+    except UPLOAD_ERRORS:
+        raise
     except Exception as e:
-        print(f"Prediction failed: {str(e)}")
-        print("Full traceback:")
-        print(traceback.format_exc())
+        logger.error("Prediction failed: %s", e)
         raise Exception(f"Prediction failed: {str(e)}")
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/predict/stream', methods=['POST'])
+@admission_controlled("interactive")
+def predict_stream():
+    """
+    Streaming variant of /predict using server-sent events:
+    a "neighbours" event with the diagnosis shortlist as soon as the vector search
+    finishes, "token" events while the completion streams, then a "result" event with
+    the /predict payload (including the validated diagnoses). Answers that need no LLM
+    (early exit, fast mode) skip the "token" events. Failures after streaming starts,
+    including an answer that does not validate, arrive as an "error" event.
+    """
+    logger.debug("Streaming prediction requested")
+    services.require_ready()
+    timer = g.timer
+    with timer.stage("upload"):
+        image, patient_hist, error_response = validate_predict_request()
+        if error_response:
+            return error_response
+        mode, error_response = predict_mode()
+        if error_response:
+            return error_response
+    
+    # Decode and search before the stream opens so those failures keep their status codes
+    with timer.stage("decode"), upload_buffer(image) as image_bytes:
+        decoded_image = normalize_image(image_bytes)
+        image_hash = hash_image_bytes(decoded_image)
+    cached_response = services.prediction_cache.get_response(
+        image_hash, patient_hist, OPENAI_MODEL, OPENAI_TEMPERATURE
+    )
+    
+    ranked = answer = None
+    if cached_response is None:
+        scored_results = retrieve_neighbours(
+            decoded_image,
+            services.image_embedder,
+            services.search_index,
+            k=RETRIEVAL_K,
+            cache=services.prediction_cache,
+            image_hash=image_hash,
+            timer=timer
+        )
+        if not scored_results:
+            logger.info("No similar images found in database")
+            return jsonify({"error": "No similar images found in database"}), 404
+        ranked, dominant = shortlist(scored_results, timer)
+        answer = services.retrieval_answer(ranked, dominant, mode)
+        if answer is not None:
+            answer = prediction_payload(answer, ranked, early_exit=dominant is not None)
+    
+    def neighbours_event(payload):
+        return sse_event("neighbours", {
+            "similar_diagnoses": payload["similar_diagnoses"],
+            "shortlist": payload.get("shortlist")
+        })
+    
+    def generate():
+        if cached_response is not None or answer is not None:
+            payload = cached_response or answer
+            if "diagnoses" not in payload:
+                # Responses cached before answers were validated on the server
+                payload = dict(payload, diagnoses=parse_diagnosis_response(payload["response"]))
+            yield neighbours_event(payload)
+            yield sse_event("result", payload)
+            return
+        
+        yield neighbours_event(prediction_payload(None, ranked))
+        try:
+            parts = []
+            usage = []
+            deltas = stream_openai_with_image_and_text(
+                text_prompt=combine_shortlist_text(ranked, patient_hist),
+                image_source=decoded_image,
+                api_key=api_key,
+                model=OPENAI_MODEL,
+                max_tokens=OPENAI_MAX_TOKENS,
+                temperature=OPENAI_TEMPERATURE,
+                client=services.openai_client,
+                timer=timer,
+                on_usage=usage.append
+            )
+            with timer.stage("llm"):
+                for delta in deltas:
+                    parts.append(delta)
+                    yield sse_event("token", {"text": delta})
+            
+            result = diagnosis_result("".join(parts), usage[-1] if usage else None)
+            payload = prediction_payload(result, ranked)
+            services.keep_answer(image_hash, patient_hist, result, ranked, payload, scored_results)
+            yield sse_event("result", payload)
+        except Exception as e:
+            ERRORS.inc(endpoint="/predict/stream", type=e.__class__.__name__)
+            logger.exception("Streaming prediction failed")
+            yield sse_event("error", {"error": str(e), "type": e.__class__.__name__})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+BATCH_MAX_ITEMS = int(os.getenv('PREDICT_BATCH_MAX_ITEMS', '16'))
+BATCH_LLM_CONCURRENCY = int(os.getenv('PREDICT_BATCH_LLM_CONCURRENCY', '4'))
+
+def batch_patient_histories(n_images):
+    """
+    Patient histories for a batch: either "patient_histories", a JSON list with one entry
+    per image, or a single "patient_history" shared by every image.
+    Returns (histories, None) or (None, error_response).
+    """
+    if 'patient_histories' in request.form:
+        try:
+            histories = json.loads(request.form['patient_histories'])
+        except ValueError:
+            return None, (jsonify({"error": "patient_histories must be a JSON list"}), 400)
+        if not isinstance(histories, list) or len(histories) != n_images:
+            return None, (jsonify({"error": "patient_histories must have one entry per image"}), 400)
+        return [h if isinstance(h, str) else json.dumps(h) for h in histories], None
+    if 'patient_history' in request.form:
+        return [request.form['patient_history']] * n_images, None
+    return None, (jsonify({"error": "No patient history provided"}), 400)
+
+@app.route('/predict/batch', methods=['POST'])
+@admission_controlled("batch")
+def predict_batch():
+    """
+    Predict for several images in one request (multi-lesion or multi-patient intake).
+    Images are embedded in one forward pass, searched together, and the LLM calls fan out
+    concurrently. Each item reports its own result or error, so one bad image does not
+    fail the batch.
+    """
+    timer = g.timer
+    # Room for a full batch; each image is still limited to UPLOAD_MAX_BYTES
+    request.max_content_length = BATCH_MAX_ITEMS * UPLOAD_MAX_BYTES + UPLOAD_FORM_BYTES
+    with timer.stage("upload"):
+        images = request.files.getlist('images')
+    logger.debug("Batch prediction requested for %d images", len(images))
+    services.require_ready()
+    if not images:
+        return jsonify({"error": "No images provided"}), 400
+    if len(images) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many images, at most {BATCH_MAX_ITEMS} per batch"}), 400
+    
+    histories, error_response = batch_patient_histories(len(images))
+    if error_response:
+        return error_response
+    mode, error_response = predict_mode()
+    if error_response:
+        return error_response
+    
+    items = [{"index": i, "filename": image.filename} for i, image in enumerate(images)]
+    
+    # Decode every item (timed as one stage), then check the caches; failures are recorded on the item only
+    decoded = []
+    with timer.stage("decode"):
+        for item, image, patient_hist in zip(items, images, histories):
+            try:
+                with upload_buffer(image) as image_bytes:
+                    decoded_image = normalize_image(image_bytes)
+                    image_hash = hash_image_bytes(decoded_image)
+            except UploadRejected as e:
+                item["error"] = str(e)
+                continue
+            except Exception as e:
+                item["error"] = f"Invalid image: {str(e)}"
+                continue
+            decoded.append((item, decoded_image, image_hash, patient_hist))
+    
+    pending = []
+    for item, decoded_image, image_hash, patient_hist in decoded:
+        cached_response = services.prediction_cache.get_response(
+            image_hash, patient_hist, OPENAI_MODEL, OPENAI_TEMPERATURE
+        )
+        if cached_response is not None:
+            item.update(cached_response)
+            continue
+        
+        # Neighbours cached for another k still save the embedding
+        cached = services.prediction_cache.get_neighbours(image_hash)
+        pending.append({
+            "item": item,
+            "image": decoded_image,
+            "hash": image_hash,
+            "history": patient_hist,
+            "embedding": cached["embedding"] if cached is not None else None,
+            "results": cached["results"] if cached is not None and cached.get("k") == RETRIEVAL_K else None
+        })
+    
+    # One forward pass and one batched search for everything not served from cache
+    to_search = [entry for entry in pending if entry["results"] is None]
+    to_embed = [entry for entry in to_search if entry["embedding"] is None]
+    if to_search:
+        try:
+            if to_embed:
+                with timer.stage("embed"):
+                    embeddings = embed_images(services.image_embedder, [entry["image"] for entry in to_embed])
+                for entry, embedding in zip(to_embed, embeddings):
+                    entry["embedding"] = embedding
+            with timer.stage("search"):
+                neighbours = search_db_by_embeddings_with_scores(
+                    [entry["embedding"] for entry in to_search], services.search_index, k=RETRIEVAL_K
+                )
+            for entry, results in zip(to_search, neighbours):
+                entry["results"] = results
+                if results and not from_fallback(results):
+                    services.prediction_cache.put_neighbours(entry["hash"], entry["embedding"], results, k=RETRIEVAL_K)
+        except Exception as e:
+            logger.exception("Batch retrieval failed")
+            for entry in to_search:
+                entry["item"]["error"] = f"Retrieval failed: {str(e)}"
+    
+    retrieved = [entry for entry in pending if entry["results"]]
+    with timer.stage("vote"):
+        for entry in retrieved:
+            entry["shortlist"], entry["dominant"] = services.shortlist_neighbours(entry["results"])
+    
+    # Items retrieval can answer on its own (early exit, fast mode) skip the LLM fan-out
+    for entry in retrieved:
+        answer = services.retrieval_answer(entry["shortlist"], entry["dominant"], mode)
+        if answer is not None:
+            entry["item"].update(
+                prediction_payload(answer, entry["shortlist"], early_exit=entry["dominant"] is not None)
+            )
+            entry["answered"] = True
+    
+    def diagnose(entry):
+        if not entry["results"]:
+            return {"error": "No similar images found in database"}
+        try:
+            result = query_openai_with_image_and_text(
+                text_prompt=combine_shortlist_text(entry["shortlist"], entry["history"]),
+                image_source=entry["image"],
+                api_key=api_key,
+                model=OPENAI_MODEL,
+                max_tokens=OPENAI_MAX_TOKENS,
+                temperature=OPENAI_TEMPERATURE,
+                client=services.openai_client
+            )
+        except Exception as e:
+            logger.warning("Batch item %d failed: %s", entry['item']['index'], e)
+            return {"error": str(e), "type": e.__class__.__name__}
+        payload = prediction_payload(result, entry["shortlist"])
+        services.keep_answer(entry["hash"], entry["history"], result, entry["shortlist"], payload, entry["results"])
+        return payload
+    
+    to_diagnose = [entry for entry in pending if "error" not in entry["item"] and not entry.get("answered")]
+    if to_diagnose:
+        # Timed as one stage: the calls overlap, so per-call timings would not add up
+        with timer.stage("llm"), ThreadPoolExecutor(max_workers=min(BATCH_LLM_CONCURRENCY, len(to_diagnose))) as executor:
+            for entry, outcome in zip(to_diagnose, executor.map(diagnose, to_diagnose)):
+                entry["item"].update(outcome)
+    
+    failed = sum(1 for item in items if "error" in item)
+    logger.info("Batch completed: %d succeeded, %d failed", len(items) - failed, failed)
+    with timer.stage("serialize"):
+        return jsonify({"results": items}), 200
+
 if __name__ == '__main__':
     print("\nStarting Flask server...")
     print("Access the API at http://localhost:5000")
     print("Available endpoints:")
     print("  - GET  /health  - Check server health")
+    print("  - GET  /health/live  - Liveness probe")
+    print("  - GET  /health/ready - Readiness probe")
     print("  - POST /predict - Make a prediction")
+    print("  - POST /predict/stream - Prediction streamed as server-sent events")
+    print("  - POST /predict/batch  - Predictions for several images")
+    print("  - GET  /stats   - Cache and batching statistics")
+    print("  - GET  /metrics - Prometheus metrics")
     print("\nPress Ctrl+C to stop the server")
     app.run(debug=True, port=5000)
 else:
-    print("Warning: App is being imported, not run directly")
\ No newline at end of file
+    logger.debug("App is being imported, not run directly")
\ No newline at end of file
@@ -0,0 +1,322 @@
+"""
+Async serving mode for the same endpoints as app.py.
+
+Runs on Quart (the asyncio implementation of the Flask API) under an ASGI server:
+    hypercorn asgi:app --bind 0.0.0.0:5000
+
+OpenAI calls are awaited on the event loop, IRIS searches run on an I/O thread pool and
+CLIP embedding on a small bounded CPU pool, so a slow completion no longer pins a worker
+thread. Requests beyond ASYNC_MAX_IN_FLIGHT are rejected with 429 and a Retry-After header;
+below that, services.admission queues and sheds /predict work as in app.py.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from quart import Quart, Request, Response, g, request, jsonify
+from quart_cors import cors
+from werkzeug.exceptions import RequestEntityTooLarge
+from utils.db_utils import embed_images, from_fallback, search_db_with_scores, combine_shortlist_text
+from utils.gpt_utils import build_messages, aquery_openai_with_messages, create_async_openai_client
+from utils.image_utils import UploadBuffer, UploadRejected, normalize_image, sniff_image_format, upload_buffer
+from utils.cache_utils import hash_image_bytes
+from utils.batch_utils import EmbeddingBatcher
+from utils.vote_utils import prediction_payload
+from utils.admission_utils import AdmissionRejected, admission_params
+from utils.health_utils import readiness_status
+from utils.log_utils import REQUEST_ID_HEADER, bind_request_id
+from utils.metrics_utils import REGISTRY, REQUESTS, REQUEST_SECONDS, ERRORS, StageTimer
+import services
+from services import (
+    api_key,
+    OPENAI_MODEL,
+    OPENAI_MAX_TOKENS,
+    OPENAI_TEMPERATURE,
+    RETRIEVAL_K,
+    ServiceWarmingUp,
+    readiness_probe
+)
+
+logger = logging.getLogger(__name__)
+logger.info("Starting async application...")
+
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+
+class UploadRequest(Request):
+    """Keeps uploaded files in UploadBuffers, as app.py does, so decode reads them without a copy."""
+
+    def make_form_data_parser(self):
+        parser = super().make_form_data_parser()
+        parser.stream_factory = lambda *args, **kwargs: UploadBuffer(UPLOAD_MAX_BYTES)
+        return parser
+
+app = cors(Quart(__name__), expose_headers=[REQUEST_ID_HEADER, "Server-Timing", "Retry-After"])
+app.request_class = UploadRequest
+# Quart rejects bodies over this with 413 while reading them (see UPLOAD_MAX_BYTES in app.py)
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + int(os.getenv('UPLOAD_FORM_BYTES', str(256 * 1024)))
+
+MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', '256'))
+RETRY_AFTER_SECONDS = os.getenv('ASYNC_RETRY_AFTER_SECONDS', '1')
+
+# CPU-bound work (decode, CLIP, base64 encoding) is bounded separately from blocking I/O
+cpu_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_CPU_WORKERS', '2')), thread_name_prefix="cpu")
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_IO_WORKERS', '16')), thread_name_prefix="io")
+async_openai_client = create_async_openai_client(api_key)
+
+in_flight = 0
+
+async def run_in(executor, func, *args, **kwargs):
+    # Copy the context so the request id follows the work onto the executor thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(context.run, func, *args, **kwargs)
+    )
+
+def endpoint_label():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+@app.before_request
+async def start_request():
+    g.request_id = bind_request_id(request.headers.get(REQUEST_ID_HEADER))
+    g.started = time.perf_counter()
+    g.timer = StageTimer(endpoint_label())
+
+@app.after_request
+async def finish_request(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    if g.timer.stages:
+        response.headers["Server-Timing"] = g.timer.server_timing()
+    endpoint = endpoint_label()
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    return response
+
+def limit_in_flight(handler):
+    """Reject requests with 429 + Retry-After once MAX_IN_FLIGHT are already being served."""
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        global in_flight
+        if in_flight >= MAX_IN_FLIGHT:
+            response = jsonify({"error": "Server is busy, retry later"})
+            return response, 429, {"Retry-After": RETRY_AFTER_SECONDS}
+        in_flight += 1
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            in_flight -= 1
+    return wrapper
+
+def admission_controlled(default_priority):
+    """Await admission from services.admission before running the handler (see admission_params)."""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            controller = services.admission
+            if controller is None:
+                return await handler(*args, **kwargs)
+            priority, client, timeout = admission_params(request.headers, request.remote_addr, default_priority)
+            with g.timer.stage("admission"):
+                await controller.acquire_async(priority, client, timeout)
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                controller.release(priority, client)
+        return wrapper
+    return decorator
+
+@app.errorhandler(AdmissionRejected)
+async def handle_admission_rejected(error):
+    logger.info("Shed request (%s): %s", error.reason, error)
+    return jsonify({"error": str(error), "reason": error.reason}), error.status, {"Retry-After": str(error.retry_after)}
+
+@app.errorhandler(RequestEntityTooLarge)
+async def handle_too_large(error):
+    message = error.description
+    if message == RequestEntityTooLarge.description:
+        message = f"Request body exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"
+    logger.info("Rejected upload: %s", message)
+    return jsonify({"error": message}), 413
+
+@app.errorhandler(UploadRejected)
+async def handle_upload_rejected(error):
+    logger.info("Rejected upload: %s", error)
+    return jsonify({"error": str(error)}), error.status
+
+@app.errorhandler(ServiceWarmingUp)
+async def handle_warming_up(error):
+    return jsonify({"error": str(error), "startup": services.startup.report()}), 503, {"Retry-After": "5"}
+
+@app.errorhandler(Exception)
+async def handle_error(error):
+    """Global error handler"""
+    ERRORS.inc(endpoint=endpoint_label(), type=error.__class__.__name__)
+    logger.exception("Error occurred: %s", error)
+    return jsonify({
+        "error": str(error),
+        "type": error.__class__.__name__
+    }), 500
+
+@app.route('/health/live', methods=['GET'])
+async def liveness_check():
+    return jsonify({"status": "alive"}), 200
+
+@app.route('/health/ready', methods=['GET'])
+async def readiness_check():
+    result = await run_in(io_executor, readiness_probe.check)
+    return jsonify(dict(result, status=readiness_status(result))), 200 if result["ready"] else 503
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    result = await run_in(io_executor, readiness_probe.check)
+    if result["ready"]:
+        return jsonify({
+            "status": "healthy",
+            "database": result["database"]
+        }), 200
+    startup = result.get("startup", {})
+    return jsonify({
+        "status": "unhealthy",
+        "database": result["database"],
+        "error": result.get("error") or startup.get("error") or readiness_status(result)
+    }), 503
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/stats', methods=['GET'])
+async def stats():
+    return jsonify({
+        # Counts rows in SQLite with the disk backend
+        "cache": await run_in(io_executor, services.prediction_cache.stats),
+        "embedding_batches": (
+            services.image_embedder.stats()
+            if isinstance(services.image_embedder, EmbeddingBatcher) else None
+        ),
+        "in_flight": in_flight,
+        "admission": services.admission.stats() if services.admission is not None else None
+    }), 200
+
+async def retrieve(decoded_image, image_hash, timer):
+    """
+    Cached embed + search returning (Document, cosine distance) pairs, with each blocking
+    step (cache I/O included) on its own executor. Neighbours cached for another k still save the embedding;
+    fallback (prototype) neighbours are not cached.
+    """
+    cached = await run_in(io_executor, services.prediction_cache.get_neighbours, image_hash)
+    if cached is not None and cached.get("k") == RETRIEVAL_K:
+        return cached["results"]
+    if cached is not None:
+        query_embedding = cached["embedding"]
+    else:
+        query_embedding = await embed(decoded_image, timer)
+    with timer.stage("search"):
+        results = await run_in(
+            io_executor, search_db_with_scores, query_embedding, services.search_index, RETRIEVAL_K
+        )
+    if results and not from_fallback(results):
+        await run_in(
+            io_executor, services.prediction_cache.put_neighbours, image_hash, query_embedding, results, k=RETRIEVAL_K
+        )
+    return results
+
+async def embed(decoded_image, timer):
+    with timer.stage("embed"):
+        if isinstance(services.image_embedder, EmbeddingBatcher):
+            # Only preprocessing runs on the CPU pool; the forward pass joins the shared batch
+            future = await run_in(cpu_executor, services.image_embedder.submit, decoded_image)
+            query_embedding = await asyncio.wrap_future(future)
+        else:
+            query_embedding = (
+                await run_in(cpu_executor, embed_images, services.image_embedder, [decoded_image])
+            )[0]
+    return query_embedding
+
+@app.route('/predict', methods=['POST'])
+@limit_in_flight
+@admission_controlled("interactive")
+async def predict():
+    await run_in(io_executor, services.require_ready)
+    timer = g.timer
+    with timer.stage("upload"):
+        files = await request.files
+        form = await request.form
+
+    if 'image' not in files:
+        return jsonify({"error": "No image provided"}), 400
+    if 'patient_history' not in form:
+        return jsonify({"error": "No patient history provided"}), 400
+
+    image = files['image']
+    patient_hist = form['patient_history']
+
+    with upload_buffer(image) as data:
+        if not image.filename or not data.nbytes:
+            return jsonify({"error": "Empty image file"}), 400
+        if sniff_image_format(data) is None:
+            return jsonify({"error": "Invalid image format. Must be PNG or JPEG"}), 400
+    mode = (form.get('mode') or request.args.get('mode') or services.DEFAULT_PREDICT_MODE).lower()
+    if mode not in services.PREDICT_MODES:
+        return jsonify({"error": f"Unknown mode, expected one of {', '.join(services.PREDICT_MODES)}"}), 400
+
+    try:
+        # Decoded straight from the request buffer, as in app.py
+        with timer.stage("decode"), upload_buffer(image) as image_bytes:
+            decoded_image = await run_in(cpu_executor, normalize_image, image_bytes)
+            image_hash = hash_image_bytes(decoded_image)
+
+        # The disk cache backend is SQLite, so lookups and writes stay off the event loop
+        cached_response = await run_in(
+            io_executor, services.prediction_cache.get_response,
+            image_hash, patient_hist, OPENAI_MODEL, OPENAI_TEMPERATURE
+        )
+        if cached_response is not None:
+            with timer.stage("serialize"):
+                return jsonify(cached_response), 200
+
+        scored_results = await retrieve(decoded_image, image_hash, timer)
+        if not scored_results:
+            return jsonify({"error": "No similar images found in database"}), 404
+
+        with timer.stage("vote"):
+            ranked, dominant = services.shortlist_neighbours(scored_results)
+        answer = services.retrieval_answer(ranked, dominant, mode)
+        if answer is not None:
+            with timer.stage("serialize"):
+                return jsonify(prediction_payload(answer, ranked, early_exit=dominant is not None)), 200
+
+        with timer.stage("prompt"):
+            messages = await run_in(
+                cpu_executor, build_messages, combine_shortlist_text(ranked, patient_hist), decoded_image
+            )
+        with timer.stage("llm"):
+            result = await aquery_openai_with_messages(
+                messages,
+                async_openai_client,
+                model=OPENAI_MODEL,
+                max_tokens=OPENAI_MAX_TOKENS,
+                temperature=OPENAI_TEMPERATURE
+            )
+        payload = prediction_payload(result, ranked)
+        # Also writes the knowledge store, which may wait on its file lock
+        await run_in(io_executor, services.keep_answer, image_hash, patient_hist, result, ranked, payload, scored_results)
+        with timer.stage("serialize"):
+            return jsonify(payload), 200
+
+    except UploadRejected:
+        raise
+    except Exception as e:
+        logger.exception("Prediction failed")
+        raise Exception(f"Prediction failed: {str(e)}")
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{os.getenv('PORT', '5000')}"]
+    logger.info("Serving async app on %s", config.bind[0])
+    asyncio.run(serve(app, config))
@@ -0,0 +1,255 @@
+"""
+Offline retrieval quality: hold out a labelled split of the indexed vectors, search it against
+the rest with each search backend and k, and report diagnosis accuracy of the voted shortlist,
+recall against exact search and queries per second.
+
+    python -m benchmarks.evaluate                                  # synthetic labelled store
+    python -m benchmarks.evaluate --source dataset --embedder clip # embed data/dermnet_data
+    python -m benchmarks.evaluate --source iris                    # the collection setup.py built
+    python -m benchmarks.evaluate --backends exact,routed --k 3,30 --drift-images ../data/uploads
+
+Backends are built from the training split the way the server builds them: exact and ivf are
+LocalVectorIndex (VECTOR_INDEX=local / local-approx), routed adds the per-diagnosis prototype
+table (VECTOR_INDEX_CLASS_PROBE) and prototypes is that table on its own (the search fallback).
+The JSON result file can be compared with an earlier one using python -m benchmarks.results
+compare; accuracy and recall count as regressions when they drop.
+"""
+import argparse
+import os
+import time
+import numpy as np
+from utils.index_utils import LocalVectorIndex, PrototypeIndex, normalize_rows
+from utils.vote_utils import rank_diagnoses
+from .results import summarize, write_results
+from .stub_store import DATASET_DIR, FakeImageEmbeddings, dataset_store, synthetic_store
+
+BACKENDS = ("exact", "ivf", "routed", "prototypes")
+SHORTLIST_RANKS = (1, 3, 5)
+
+def load_embedder(embedder):
+    if embedder == "clip":
+        from utils.db_utils import load_embedding_function
+        return load_embedding_function()
+    return FakeImageEmbeddings()
+
+def load_source(source, multimodal_ef, dataset_dir=DATASET_DIR, store_size=20000):
+    """(ids, unit-vector matrix, documents, metadatas) of the labelled vectors to evaluate on."""
+    if source == "iris":
+        from utils.db_utils import connect_db
+        index = LocalVectorIndex(connect_db(multimodal_ef))
+        index.refresh()
+    elif source == "dataset":
+        # Every image embedded in batched forward passes, labelled the way setup.py labels them
+        index = dataset_store(multimodal_ef, dataset_dir)
+    else:
+        index = synthetic_store(store_size)
+    snapshot = index._snapshot
+    return snapshot.ids, snapshot.matrix, snapshot.documents, snapshot.metadatas
+
+def holdout_split(labels, holdout=0.2, seed=0):
+    """
+    Stratified split: about holdout of every diagnosis is held out as queries, always leaving
+    at least one example in the index. Diagnoses with a single example are never held out.
+    Returns (train rows, test rows).
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels)
+    train, test = [], []
+    for name in np.unique(labels):
+        rows = rng.permutation(np.flatnonzero(labels == name))
+        n_test = min(len(rows) - 1, int(round(len(rows) * holdout)))
+        if len(rows) > 1:
+            n_test = max(1, n_test)
+        test.extend(rows[:n_test].tolist())
+        train.extend(rows[n_test:].tolist())
+    return np.sort(train), np.sort(test)
+
+def build_backends(names, ids, matrix, documents, metadatas, n_probe=8, class_probe=3, per_class=4):
+    """The requested backends over the training rows, plus exact (the recall reference) in any case."""
+    labels = [meta.get("diagnosis") or "Unknown" for meta in metadatas]
+    backends = {"exact": LocalVectorIndex.from_arrays(ids, matrix, documents, metadatas)}
+    prototypes = None
+    if "routed" in names or "prototypes" in names:
+        prototypes = PrototypeIndex.build(matrix, labels, per_class=per_class)
+    if "ivf" in names:
+        backends["ivf"] = LocalVectorIndex.from_arrays(ids, matrix, documents, metadatas, approximate=True,
+                                                       n_probe=n_probe)
+    if "routed" in names:
+        backends["routed"] = LocalVectorIndex.from_arrays(ids, matrix, documents, metadatas,
+                                                          prototypes=prototypes, class_probe=class_probe)
+    if "prototypes" in names:
+        backends["prototypes"] = prototypes
+    return backends
+
+def evaluate_backend(index, queries, labels, k, reference=None, temperature=0.05, latency_sample=200):
+    """
+    Search every query in one batched call and score the results: top-n accuracy of the
+    voted shortlist, accuracy of the nearest neighbour alone, the share of exact search's
+    k neighbours that were found (reference, one set of documents per query) and throughput.
+    Single-query latency is measured on the first latency_sample queries.
+    """
+    started = time.perf_counter()
+    results = index.similarity_search_with_score_by_vectors(queries, k=k)
+    elapsed = time.perf_counter() - started
+
+    hits = np.zeros(len(SHORTLIST_RANKS))
+    nearest_hits = 0
+    recalls = []
+    for position, (scored, label) in enumerate(zip(results, labels)):
+        shortlist = [entry["diagnosis"] for entry in rank_diagnoses(scored, temperature=temperature)]
+        hits += [label in shortlist[:n] for n in SHORTLIST_RANKS]
+        nearest_hits += bool(scored) and scored[0][0].metadata.get("diagnosis") == label
+        if reference is not None and reference[position]:
+            found = {doc.page_content for doc, _ in scored if not doc.metadata.get("prototype")}
+            recalls.append(len(found & reference[position]) / len(reference[position]))
+
+    samples = []
+    for query in queries[:latency_sample]:
+        query_started = time.perf_counter()
+        index.similarity_search_with_score_by_vector(query, k=k)
+        samples.append(time.perf_counter() - query_started)
+
+    n = len(labels)
+    result = {f"top{rank}_accuracy": float(hit / n) for rank, hit in zip(SHORTLIST_RANKS, hits)}
+    result.update({
+        "nearest_accuracy": nearest_hits / n,
+        "exact_recall": float(np.mean(recalls)) if recalls else None,
+        "queries": n,
+        "batch_queries_per_second": n / elapsed if elapsed else None,
+        "single_queries_per_second": len(samples) / sum(samples) if sum(samples) else None
+    })
+    result.update(summarize(samples))
+    return result
+
+def embedding_drift(train_matrix, train_labels, test_matrix, test_labels, extra=None):
+    """
+    How far queries sit from the index: nearest-neighbour similarity of the held-out split
+    (and of extra, e.g. recent uploads, when given) and the cosine between each diagnosis's
+    centroid in the index and in the held-out split. A falling similarity after a model or
+    preprocessing change means the index should be rebuilt.
+    """
+    def nearest(vectors):
+        best = np.concatenate([
+            (vectors[start:start + 1024] @ train_matrix.T).max(axis=1)
+            for start in range(0, len(vectors), 1024)
+        ])
+        p10, p50 = np.percentile(best, [10, 50])
+        return {"mean": float(best.mean()), "p10": float(p10), "p50": float(p50)}
+
+    train_labels, test_labels = np.asarray(train_labels), np.asarray(test_labels)
+    centroid_similarities = []
+    for name in np.unique(test_labels):
+        train_centroid = normalize_rows(train_matrix[train_labels == name].mean(axis=0))
+        test_centroid = normalize_rows(test_matrix[test_labels == name].mean(axis=0))
+        centroid_similarities.append(float(train_centroid @ test_centroid))
+
+    drift = {
+        "heldout_nearest_similarity": nearest(test_matrix),
+        "centroid_similarity_mean": float(np.mean(centroid_similarities)),
+        "centroid_similarity_min": float(np.min(centroid_similarities))
+    }
+    if extra is not None and len(extra):
+        drift["extra_nearest_similarity"] = nearest(extra)
+    return drift
+
+def embed_directory(multimodal_ef, directory, batch_size=32):
+    """Unit vectors for every image under directory, embedded in batches."""
+    from utils.db_utils import embed_images
+    from utils.ingest_utils import scan_images
+
+    paths = sorted(scan_images(directory))
+    embeddings = []
+    for i in range(0, len(paths), batch_size):
+        embeddings.extend(embed_images(multimodal_ef, paths[i:i + batch_size]))
+    return normalize_rows(np.asarray(embeddings, dtype=np.float32)) if embeddings else None
+
+def run(source="synthetic", embedder="fake", dataset_dir=DATASET_DIR, store_size=20000, holdout=0.2, seed=0,
+        ks=(3, 30), backends=BACKENDS, n_probe=8, class_probe=3, per_class=4, temperature=0.05,
+        latency_sample=200, drift_images=None):
+    multimodal_ef = load_embedder(embedder)
+    ids, matrix, documents, metadatas = load_source(source, multimodal_ef, dataset_dir, store_size)
+    labels = [meta.get("diagnosis") or "Unknown" for meta in metadatas]
+    train, test = holdout_split(labels, holdout, seed)
+    if not len(test):
+        raise ValueError("Nothing to hold out: every diagnosis has a single example")
+
+    def rows(values, selected):
+        return [values[i] for i in selected]
+
+    indexes = build_backends(
+        backends, rows(ids, train), matrix[train], rows(documents, train), rows(metadatas, train),
+        n_probe=n_probe, class_probe=class_probe, per_class=per_class
+    )
+    queries, query_labels = matrix[test], rows(labels, test)
+
+    results = {}
+    for k in ks:
+        reference = [
+            {doc.page_content for doc, _ in scored}
+            for scored in indexes["exact"].similarity_search_with_score_by_vectors(queries, k=k)
+        ]
+        for name in backends:
+            results[f"{name}_k{k}"] = evaluate_backend(
+                indexes[name], queries, query_labels, k,
+                reference=None if name == "prototypes" else reference,
+                temperature=temperature, latency_sample=latency_sample
+            )
+
+    extra = embed_directory(multimodal_ef, drift_images) if drift_images else None
+    results["embedding_drift"] = embedding_drift(matrix[train], rows(labels, train), queries, query_labels, extra)
+    results["split"] = {
+        "indexed": len(train),
+        "heldout": len(test),
+        "diagnoses": len(set(labels)),
+        "heldout_diagnoses": len(set(query_labels))
+    }
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline retrieval quality and throughput per search backend")
+    parser.add_argument("--source", choices=["synthetic", "dataset", "iris"], default="synthetic",
+                        help="Labelled vectors: a synthetic store, the dataset embedded now, or the IRIS collection")
+    parser.add_argument("--embedder", choices=["fake", "clip"], default="fake",
+                        help="clip loads the configured EMBED_BACKEND (for --source dataset and --drift-images)")
+    parser.add_argument("--dataset", default=DATASET_DIR, help="Image directory for --source dataset")
+    parser.add_argument("--store-size", type=int, default=20000, help="Vectors in the synthetic store")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Share of each diagnosis held out as queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--k", default="3,30", help="Comma-separated neighbour counts")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help=f"Comma-separated, from {', '.join(BACKENDS)}")
+    parser.add_argument("--n-probe", type=int, default=int(os.getenv('VECTOR_INDEX_N_PROBE', '8')))
+    parser.add_argument("--class-probe", type=int, default=int(os.getenv('VECTOR_INDEX_CLASS_PROBE', '0')) or 3)
+    parser.add_argument("--prototypes-per-class", type=int, default=4)
+    parser.add_argument("--temperature", type=float, default=float(os.getenv('RETRIEVAL_VOTE_TEMPERATURE', '0.05')))
+    parser.add_argument("--latency-sample", type=int, default=200, help="Queries timed one at a time")
+    parser.add_argument("--drift-images", help="Extra images (e.g. recent uploads) to measure distance to the index")
+    parser.add_argument("--output", help="Result file (default benchmarks/results/evaluate-<timestamp>.json)")
+    args = parser.parse_args()
+
+    unknown = set(args.backends.split(",")) - set(BACKENDS)
+    if unknown:
+        parser.error(f"Unknown backends: {', '.join(sorted(unknown))}")
+    results = run(
+        source=args.source,
+        embedder=args.embedder,
+        dataset_dir=args.dataset,
+        store_size=args.store_size,
+        holdout=args.holdout,
+        seed=args.seed,
+        ks=[int(k) for k in args.k.split(",")],
+        backends=args.backends.split(","),
+        n_probe=args.n_probe,
+        class_probe=args.class_probe,
+        per_class=args.prototypes_per_class,
+        temperature=args.temperature,
+        latency_sample=args.latency_sample,
+        drift_images=args.drift_images
+    )
+    for name, result in results.items():
+        if "top1_accuracy" in result:
+            recall = result["exact_recall"]
+            print(f"{name:16s} top1 {result['top1_accuracy']:.3f}  top3 {result['top3_accuracy']:.3f}  "
+                  f"recall {'  -  ' if recall is None else f'{recall:.3f}'}  "
+                  f"{result['batch_queries_per_second']:10.0f} q/s batched  p50 {result['p50_ms']:.3f} ms")
+    print(f"Held-out nearest similarity: {results['embedding_drift']['heldout_nearest_similarity']['mean']:.3f}")
+    write_results("evaluate", results, args.output, config=vars(args))
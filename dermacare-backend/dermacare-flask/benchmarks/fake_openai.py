@@ -0,0 +1,198 @@
+"""
+Local stand-in for the OpenAI chat completions API, with configurable latency.
+
+    python -m benchmarks.fake_openai --port 8001 --latency-ms 800 --jitter-ms 200
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=fake python app.py
+
+Answers POST /v1/chat/completions with a fixed diagnosis list (wrapped in {"diagnoses": ...}
+when a JSON response_format is requested), both as a single response
+and as a server-sent event stream (one chunk per word at --tokens-per-second), and reports
+token usage so the metrics path is exercised. --error-rate (random) and --fail-first (the
+first N requests) return 429s with Retry-After to exercise the client's retry policy; the
+settings record how many requests were in flight at once.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_DIAGNOSES = [
+    {
+        "Diagnosis": "Acne",
+        "Risk factors": ["Hormonal changes", "Family history", "Oily skin"],
+        "Clinical features": ["Comedones", "Inflammatory papules and pustules"]
+    },
+    {
+        "Diagnosis": "Rosacea",
+        "Risk factors": ["Fair skin", "Age over 30"],
+        "Clinical features": ["Facial erythema", "Telangiectasia"]
+    }
+]
+CANNED_RESPONSE = json.dumps(CANNED_DIAGNOSES)
+
+def canned_response(request):
+    if (request.get("response_format") or {}).get("type") in ("json_schema", "json_object"):
+        return json.dumps({"diagnoses": CANNED_DIAGNOSES})
+    return CANNED_RESPONSE
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        settings = self.settings
+        number = settings.count_request()
+
+        if number <= settings.fail_first or random.random() < settings.error_rate:
+            self._send_json(
+                429, {"error": {"message": "Rate limited by fake server"}}, {"Retry-After": settings.retry_after}
+            )
+            return
+
+        with settings.serving():
+            time.sleep(max(0.0, random.gauss(settings.latency, settings.jitter)))
+        content = canned_response(request)
+        prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+        completion_tokens = len(content) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        if request.get("stream"):
+            self._stream(request, content, usage)
+            return
+
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+
+    def _stream(self, request, content, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def chunk(delta, finish_reason=None, chunk_usage=None):
+            body = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4o"),
+                "choices": [] if chunk_usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            if chunk_usage:
+                body["usage"] = chunk_usage
+            self.wfile.write(f"data: {json.dumps(body)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        words = content.split(" ")
+        interval = 1.0 / self.settings.tokens_per_second if self.settings.tokens_per_second else 0
+        chunk({"role": "assistant", "content": ""})
+        for i, word in enumerate(words):
+            chunk({"content": word if i == 0 else " " + word})
+            if interval:
+                time.sleep(interval)
+        chunk({}, finish_reason="stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunk(None, chunk_usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+class FakeOpenAISettings:
+    def __init__(self, latency_ms=500, jitter_ms=0, tokens_per_second=0, error_rate=0.0, fail_first=0,
+                 retry_after="0.1"):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.retry_after = retry_after
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        """Count a request; returns its number, starting at 1."""
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    @contextmanager
+    def serving(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+def start_fake_openai(port=0, **settings):
+    """Start the fake server on a daemon thread; returns (server, base_url). server.settings holds the counters."""
+    handler = type("Handler", (FakeOpenAIHandler,), {"settings": FakeOpenAISettings(**settings)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.settings = handler.settings
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=500, help="Mean time before the first byte")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Standard deviation of the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Streaming pace (0 = no delay)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--fail-first", type=int, default=0, help="Answer the first N requests with 429")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_openai(
+        args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        fail_first=args.fail_first
+    )
+    print(f"Fake OpenAI server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,140 @@
+"""
+Closed-loop load generator for /predict (or /predict/batch, /predict/stream).
+
+    python -m benchmarks.loadgen --url http://127.0.0.1:5001/predict --concurrency 16 --duration 60
+
+Each worker posts images from --images in turn and waits for the answer before sending the
+next. Reports throughput, latency percentiles, status codes and, from the Server-Timing
+header, the per-stage breakdown. --unique-history varies the patient history per request so
+the response cache does not answer everything after the first pass.
+"""
+import argparse
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+import httpx
+from utils.ingest_utils import scan_images
+from .results import summarize, write_results
+from .stub_store import DATASET_DIR
+
+HISTORY = "Itchy red patches on both elbows for three months, worse in winter"
+
+def parse_server_timing(header):
+    stages = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if params.startswith("dur="):
+            stages[name] = float(params[4:]) / 1000.0
+    return stages
+
+class LoadGenerator:
+    def __init__(self, url, images, concurrency=8, duration=30, warmup=5, unique_history=False, timeout=120):
+        self.url = url
+        self.images = images
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.unique_history = unique_history
+        self.timeout = timeout
+        self.latencies = []
+        self.statuses = Counter()
+        self.stages = defaultdict(list)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def _request(self, client, n):
+        name, data = self.images[n % len(self.images)]
+        history = f"{HISTORY} (request {n})" if self.unique_history else HISTORY
+        if self.url.rstrip("/").endswith("/batch"):
+            files = [("images", (name, data, "image/jpeg"))]
+        else:
+            files = {"image": (name, data, "image/jpeg")}
+        return client.post(self.url, files=files, data={"patient_history": history})
+
+    def _worker(self, measure_from, stop_at):
+        with httpx.Client(timeout=self.timeout) as client:
+            while time.monotonic() < stop_at:
+                n = self._next()
+                started = time.monotonic()
+                try:
+                    response = self._request(client, n)
+                    status = response.status_code
+                    timing = response.headers.get("Server-Timing")
+                except httpx.HTTPError as e:
+                    status, timing = e.__class__.__name__, None
+                finished = time.monotonic()
+                if started < measure_from:
+                    continue
+                with self._lock:
+                    self.statuses[str(status)] += 1
+                    if status == 200:
+                        self.latencies.append(finished - started)
+                        for stage, seconds in parse_server_timing(timing or "").items():
+                            self.stages[stage].append(seconds)
+
+    def run(self):
+        started = time.monotonic()
+        measure_from = started + self.warmup
+        stop_at = measure_from + self.duration
+        workers = [
+            threading.Thread(target=self._worker, args=(measure_from, stop_at), daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        results = {"predict": summarize(self.latencies)}
+        results["predict"]["requests_per_second"] = len(self.latencies) / self.duration
+        results["predict"]["statuses"] = dict(self.statuses)
+        results["predict"]["error_rate"] = (
+            1 - self.statuses.get("200", 0) / sum(self.statuses.values()) if self.statuses else None
+        )
+        for stage, samples in sorted(self.stages.items()):
+            results[f"stage:{stage}"] = summarize(samples)
+        return results
+
+def load_images(directory, limit=64):
+    paths = sorted(scan_images(directory))[:limit]
+    if not paths:
+        raise ValueError(f"No images found under {directory}")
+    images = []
+    for path in paths:
+        with open(path, "rb") as image_file:
+            images.append((os.path.basename(path), image_file.read()))
+    return images
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test /predict")
+    parser.add_argument("--url", default="http://127.0.0.1:5001/predict")
+    parser.add_argument("--images", default=DATASET_DIR, help="Directory of images to upload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds of load before measuring")
+    parser.add_argument("--unique-history", action="store_true", help="Defeat the response cache")
+    parser.add_argument("--output", help="Result file (default benchmarks/results/loadgen-<timestamp>.json)")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(
+        args.url,
+        load_images(args.images),
+        concurrency=args.concurrency,
+        duration=args.duration,
+        warmup=args.warmup,
+        unique_history=args.unique_history
+    )
+    results = generator.run()
+    summary = results["predict"]
+    if summary["count"]:
+        print(f"{summary['requests_per_second']:.1f} req/s  p50 {summary['p50_ms']:.1f} ms  "
+              f"p95 {summary['p95_ms']:.1f} ms  p99 {summary['p99_ms']:.1f} ms  statuses {summary['statuses']}")
+    else:
+        print(f"No successful requests, statuses {summary['statuses']}")
+    write_results("loadgen", results, args.output, config=vars(args))
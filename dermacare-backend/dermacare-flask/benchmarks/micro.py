@@ -0,0 +1,121 @@
+"""
+Microbenchmarks for the per-request helpers on the /predict path.
+
+    python -m benchmarks.micro                        # fake embedder, synthetic 20k-vector store
+    python -m benchmarks.micro --embedder clip --store dataset --repeat 50
+
+Every benchmark reports latency percentiles and calls per second; the JSON result file
+can be compared with an earlier one using python -m benchmarks.results compare.
+"""
+import argparse
+import os
+import time
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from utils.db_utils import combine_text, query_db_with_image_and_text, retrieve_neighbours
+from utils.gpt_utils import load_image_from_path, resize_image
+from utils.image_utils import decode_image, normalize_image
+from utils.index_utils import LocalVectorIndex, PrototypeIndex
+from utils.vote_utils import rank_diagnoses
+from .results import summarize, write_results
+from .stub_store import DATASET_DIR, FakeImageEmbeddings, dataset_store, synthetic_store
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(__file__), "..", "..", "data", "test.jpg")
+
+def bench(func, repeat, warmup=3):
+    """Call func repeat times (after warmup calls) and summarize the per-call durations."""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    result = summarize(samples)
+    result["calls_per_second"] = len(samples) / sum(samples) if sum(samples) else None
+    return result
+
+def phone_photo(width=4032, height=3024):
+    """A phone-sized JPEG upload (noise, so it does not compress unrealistically well)."""
+    pixels = np.random.default_rng(0).integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize((width, height))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def dataset_filenames(dataset_dir=DATASET_DIR):
+    names = [name for _, _, files in os.walk(dataset_dir) for name in files]
+    return names or ["acne-cystic-12.jpg", "eczema_hand-0034.jpg", "psoriasis-plaque-7.jpeg"]
+
+def run(embedder="fake", store="synthetic", store_size=20000, repeat=200, k=3):
+    from setup import extract_diagnosis
+
+    if embedder == "clip":
+        from utils.db_utils import load_embedding_function
+        multimodal_ef = load_embedding_function()
+    else:
+        multimodal_ef = FakeImageEmbeddings()
+    index = dataset_store(multimodal_ef) if store == "dataset" else synthetic_store(store_size)
+
+    with open(SAMPLE_IMAGE, "rb") as image_file:
+        sample_bytes = image_file.read()
+    sample = decode_image(sample_bytes)
+    large_bytes = phone_photo()
+    large = decode_image(large_bytes)
+    filenames = dataset_filenames()
+    neighbours = index.similarity_search_by_vector(multimodal_ef.embed_images([sample])[0], k=k)
+    history = '{"age": 34, "symptoms": "itchy red patches on both elbows for three months"}'
+
+    results = {}
+    results["extract_diagnosis"] = bench(lambda: [extract_diagnosis(name) for name in filenames], repeat)
+    results["extract_diagnosis"]["filenames"] = len(filenames)
+    results["decode_image"] = bench(lambda: decode_image(sample_bytes), repeat)
+    results["normalize_image"] = bench(lambda: normalize_image(sample_bytes), repeat)
+    results["normalize_image_phone_photo"] = bench(lambda: normalize_image(large_bytes), max(10, repeat // 10))
+    normalized = normalize_image(large_bytes)
+    results["normalize_image_phone_photo"]["bytes_in"] = len(large_bytes)
+    results["normalize_image_phone_photo"]["bytes_out"] = len(normalized.data)
+    results["resize_image"] = bench(lambda: resize_image(sample), repeat)
+    results["resize_image_phone_photo"] = bench(lambda: resize_image(large), max(10, repeat // 10))
+    results["load_image_from_path"] = bench(lambda: load_image_from_path(sample), repeat)
+    results["load_image_from_path_phone_photo"] = bench(lambda: load_image_from_path(large), max(10, repeat // 10))
+    results["load_image_from_path_normalized"] = bench(lambda: load_image_from_path(normalized), repeat)
+    results["combine_text"] = bench(lambda: combine_text(neighbours, history), repeat * 10)
+    results["query_db_with_image_and_text"] = bench(
+        lambda: query_db_with_image_and_text(sample, multimodal_ef, index), repeat
+    )
+    results["query_db_with_image_and_text"]["store_size"] = len(index)
+    for k_votes in (30, 100):
+        scored = retrieve_neighbours(sample, multimodal_ef, index, k=k_votes)
+        results[f"retrieve_neighbours_k{k_votes}"] = bench(
+            lambda: retrieve_neighbours(sample, multimodal_ef, index, k=k_votes), repeat
+        )
+        results[f"rank_diagnoses_k{k_votes}"] = bench(lambda: rank_diagnoses(scored, limit=3), repeat * 10)
+
+    prototypes = PrototypeIndex.from_local_index(index)
+    query = multimodal_ef.embed_images([sample])[0]
+    results["prototype_top_classes"] = bench(lambda: prototypes.top_classes(query, 3), repeat * 10)
+    results["prototype_top_classes"]["prototypes"] = len(prototypes)
+    snapshot = index._snapshot
+    routed = LocalVectorIndex.from_arrays(
+        snapshot.ids, snapshot.matrix, snapshot.documents, snapshot.metadatas, prototypes=prototypes, class_probe=3
+    )
+    results["class_routed_search"] = bench(lambda: routed.similarity_search_with_score_by_vector(query, k=k), repeat)
+    results["exact_search"] = bench(lambda: index.similarity_search_with_score_by_vector(query, k=k), repeat)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the /predict helpers")
+    parser.add_argument("--embedder", choices=["fake", "clip"], default="fake",
+                        help="clip loads the configured EMBED_BACKEND")
+    parser.add_argument("--store", choices=["synthetic", "dataset"], default="synthetic")
+    parser.add_argument("--store-size", type=int, default=20000, help="Vectors in the synthetic store")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--output", help="Result file (default benchmarks/results/micro-<timestamp>.json)")
+    args = parser.parse_args()
+
+    results = run(args.embedder, args.store, args.store_size, args.repeat)
+    for name, result in results.items():
+        print(f"{name:36s} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms")
+    write_results("micro", results, args.output, config=vars(args))
@@ -0,0 +1,101 @@
+"""
+Shared helpers for the benchmark scripts: latency summaries and JSON result files.
+
+Compare two result files (e.g. before and after a change):
+    python -m benchmarks.results compare baseline.json candidate.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": len(values),
+        "mean_ms": float(values.mean()),
+        "min_ms": float(values.min()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(values.max())
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def write_results(name, results, path=None, config=None):
+    """
+    Write results with enough context (commit, host, settings) to compare runs later.
+    Defaults to benchmarks/results/<name>-<timestamp>.json; returns the path written.
+    """
+    if path is None:
+        directory = os.path.join(os.path.dirname(__file__), "results")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    document = {
+        "benchmark": name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config or {},
+        "results": results
+    }
+    with open(path, "w") as results_file:
+        json.dump(document, results_file, indent=2)
+    print(f"Results written to {path}")
+    return path
+
+# Figures where higher is better; *_ms figures are latencies, where lower is better
+HIGHER_IS_BETTER = ("_per_second", "_accuracy", "_recall")
+
+def compare(baseline_path, candidate_path, threshold=0.10):
+    """
+    Print the relative change of every *_ms, *_per_second, *_accuracy and *_recall figure
+    present in both files.
+    """
+    with open(baseline_path) as baseline_file, open(candidate_path) as candidate_file:
+        baseline = json.load(baseline_file)["results"]
+        candidate = json.load(candidate_file)["results"]
+
+    regressions = 0
+    for name in sorted(set(baseline) & set(candidate)):
+        for metric, old in baseline[name].items():
+            new = candidate[name].get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+                continue
+            if not (metric.endswith("_ms") or metric.endswith(HIGHER_IS_BETTER)):
+                continue
+            change = (new - old) / old
+            # Lower is better for latencies, higher for throughput and quality
+            worse = change > threshold if metric.endswith("_ms") else change < -threshold
+            regressions += worse
+            print(f"{name:40s} {metric:22s} {old:12.3f} -> {new:12.3f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark result tools")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    compare_parser = subcommands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="Relative change flagged as a regression")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(1 if compare(args.baseline, args.candidate, args.threshold) else 0)
@@ -0,0 +1,61 @@
+"""
+Serve app.py against local stand-ins instead of IRIS and OpenAI, for load testing.
+
+    python -m benchmarks.serve --embedder fake --store synthetic --fake-openai-latency-ms 800
+    python -m benchmarks.loadgen --url http://127.0.0.1:5001/predict --concurrency 16
+
+With --openai-url the app talks to an already running fake server (python -m
+benchmarks.fake_openai), which keeps the fake's threads out of this process. --embedder clip
+loads the real model (honouring EMBED_BACKEND), so backend changes show up end to end.
+"""
+import argparse
+import os
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Flask app on local stand-ins")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--embedder", choices=["fake", "clip"], default="fake")
+    parser.add_argument("--store", choices=["synthetic", "dataset"], default="synthetic")
+    parser.add_argument("--store-size", type=int, default=20000)
+    parser.add_argument("--approximate", action="store_true", help="Use the IVF layout for the stub store")
+    parser.add_argument("--openai-url", help="Base URL of a running fake OpenAI server")
+    parser.add_argument("--fake-openai-latency-ms", type=float, default=500,
+                        help="Latency of the in-process fake server started when --openai-url is not given")
+    args = parser.parse_args()
+
+    if args.openai_url:
+        os.environ['OPENAI_BASE_URL'] = args.openai_url
+    else:
+        from .fake_openai import start_fake_openai
+
+        _, base_url = start_fake_openai(latency_ms=args.fake_openai_latency_ms)
+        os.environ['OPENAI_BASE_URL'] = base_url
+        print(f"Fake OpenAI server listening on {base_url}")
+    # The stand-ins below replace warm-up, so nothing should try to load the model or reach IRIS
+    os.environ['WARMUP_MODE'] = 'lazy'
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+    import services
+    from utils.batch_utils import create_embedding_batcher
+    from .stub_store import FakeImageEmbeddings, StubDatabase, dataset_store, synthetic_store
+
+    if args.embedder == "clip":
+        multimodal_ef = services.load_model()
+    else:
+        multimodal_ef = FakeImageEmbeddings()
+    if args.store == "dataset":
+        search_index = dataset_store(multimodal_ef, approximate=args.approximate)
+    else:
+        search_index = synthetic_store(args.store_size, approximate=args.approximate)
+
+    services.multimodal_ef = multimodal_ef
+    # Readiness checks query services.db, so /health and /health/ready answer from the stub store
+    services.db = StubDatabase(search_index)
+    services.image_embedder = create_embedding_batcher(multimodal_ef)
+    services.search_index = search_index
+    services.startup.mark_ready()
+
+    from app import app
+
+    print(f"Serving stub-backed app on http://127.0.0.1:{args.port} ({len(search_index)} vectors)")
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
@@ -0,0 +1,112 @@
+"""
+In-process stand-ins for IRIS and (optionally) the CLIP model, so the serving path can be
+measured without a database or model download.
+
+The store is a LocalVectorIndex built from memory: either the images under data/dermnet_data
+embedded with the configured CLIP backend, or synthetic clustered vectors labelled with the
+dataset's diagnosis folders. FakeImageEmbeddings maps an image to a deterministic unit
+vector, for runs that should leave the model out of the measurement.
+"""
+import hashlib
+import os
+from types import SimpleNamespace
+import numpy as np
+from sqlalchemy import Column, MetaData, String, Table, create_engine
+from sqlalchemy.pool import StaticPool
+from utils.db_utils import COLLECTION_NAME
+from utils.image_utils import open_image
+from utils.index_utils import LocalVectorIndex, normalize_rows
+
+DATASET_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data", "dermnet_data")
+EMBEDDING_DIM = 512
+SYNTHETIC_DIAGNOSES = ["Acne", "Eczema", "Psoriasis", "Rosacea", "Vitiligo", "Shingles", "Melanoma", "Tinea"]
+
+class FakeImageEmbeddings:
+    """
+    Deterministic image "embedding" derived from a hash of the decoded pixels, in place of a
+    CLIP forward pass. It has the same preprocess/encode_pixel_batch interface, so it also
+    runs behind EmbeddingBatcher.
+    """
+
+    def __init__(self, dimension=EMBEDDING_DIM):
+        self.output_dim = dimension
+
+    def preprocess(self, image):
+        return image.convert("RGB").resize((224, 224))
+
+    def encode_pixel_batch(self, pixel_tensors):
+        vectors = []
+        for pixels in pixel_tensors:
+            seed = int.from_bytes(hashlib.sha256(pixels.tobytes()).digest()[:8], "little")
+            vectors.append(np.random.default_rng(seed).standard_normal(self.output_dim).astype(np.float32))
+        return normalize_rows(np.stack(vectors)).tolist()
+
+    def embed_images(self, image_sources):
+        return self.encode_pixel_batch([self.preprocess(open_image(source)) for source in image_sources])
+
+    def embed_image(self, uris):
+        return self.embed_images(uris)
+
+class StubDatabase:
+    """
+    Stand-in for the IRISVector connection (services.db): an in-memory SQLite table of the
+    store's row ids behind the same _conn.engine and table attributes, so the readiness
+    probe runs its usual one-row query against the stub store instead of failing.
+    """
+
+    def __init__(self, index):
+        # One shared connection, so every connect() sees the same in-memory database
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        self.table = Table(COLLECTION_NAME, MetaData(), Column("id", String, primary_key=True))
+        self.table.metadata.create_all(engine)
+        ids = [{"id": str(row_id)} for row_id in index._snapshot.ids]
+        if ids:
+            with engine.begin() as conn:
+                conn.execute(self.table.insert(), ids)
+        self._conn = SimpleNamespace(engine=engine)
+
+def dataset_diagnoses(dataset_dir=DATASET_DIR):
+    if not os.path.isdir(dataset_dir):
+        return list(SYNTHETIC_DIAGNOSES)
+    return sorted(name for name in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir, name)))
+
+def synthetic_store(n_vectors=20000, dimension=EMBEDDING_DIM, diagnoses=None, spread=0.6, seed=0, approximate=False):
+    """
+    A store of n_vectors unit vectors clustered around one centre per diagnosis, so neighbour
+    lists look like real ones (mostly one class, some confusion) at any collection size.
+    """
+    diagnoses = diagnoses or dataset_diagnoses()
+    rng = np.random.default_rng(seed)
+    centres = normalize_rows(rng.standard_normal((len(diagnoses), dimension)).astype(np.float32))
+    labels = rng.integers(0, len(diagnoses), n_vectors)
+    noise = rng.standard_normal((n_vectors, dimension)).astype(np.float32) * spread / np.sqrt(dimension)
+    vectors = normalize_rows(centres[labels] + noise)
+
+    paths = [f"synthetic/{diagnoses[label]}/{i}.jpg" for i, label in enumerate(labels)]
+    return LocalVectorIndex.from_arrays(
+        ids=[str(i) for i in range(n_vectors)],
+        embeddings=vectors,
+        documents=paths,
+        metadatas=[{"diagnosis": diagnoses[label], "path": path} for label, path in zip(labels, paths)],
+        approximate=approximate
+    )
+
+def dataset_store(multimodal_ef, dataset_dir=DATASET_DIR, batch_size=32, approximate=False):
+    """A store holding the dataset's images embedded with multimodal_ef, labelled the way setup.py labels them."""
+    from setup import extract_diagnosis
+    from utils.db_utils import embed_images
+    from utils.ingest_utils import scan_images
+
+    paths = sorted(scan_images(dataset_dir))
+    if not paths:
+        raise ValueError(f"No images found under {dataset_dir}")
+    embeddings = []
+    for i in range(0, len(paths), batch_size):
+        embeddings.extend(embed_images(multimodal_ef, paths[i:i + batch_size]))
+    return LocalVectorIndex.from_arrays(
+        ids=paths,
+        embeddings=embeddings,
+        documents=paths,
+        metadatas=[{"diagnosis": extract_diagnosis(os.path.basename(path)), "path": path} for path in paths],
+        approximate=approximate
+    )
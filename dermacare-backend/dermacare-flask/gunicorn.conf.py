@@ -0,0 +1,34 @@
+"""
+gunicorn settings for serving app.py with pre-forked workers:
+    WARMUP_MODE=preload gunicorn app:app
+
+With preload_app the master imports the app once, loading the CLIP weights before
+forking, so every worker shares those pages copy-on-write instead of loading its own
+copy. Nothing else is built before the fork: each worker creates its own prediction
+cache, admission controller, knowledge store and OpenAI client (services.init_process),
+then opens its own IRIS connection and batcher thread.
+"""
+import gc
+import os
+
+# Load the model in the master before forking; workers finish warming up in post_fork
+os.environ.setdefault('WARMUP_MODE', 'preload')
+# Tells services that post_fork below will run, so preload does not fall back to background
+os.environ['WARMUP_POST_FORK'] = '1'
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+# Queued predictions park a thread each, so leave room above ADMISSION_MAX_CONCURRENT
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+preload_app = True
+
+def when_ready(server):
+    # Move everything loaded so far out of the collector's generations, so the GC
+    # doesn't write to (and un-share) the preloaded objects in the workers
+    gc.freeze()
+
+def post_fork(server, worker):
+    import services
+    services.init_process()
+    services.start_warmup()
@@ -0,0 +1,225 @@
+"""
+Shared serving state for the Flask (app.py) and asyncio (asgi.py) entry points:
+configuration, the CLIP embedder, the IRIS connection and the helpers built on them.
+
+Startup is split into phases so the server can bind before the model is loaded.
+WARMUP_MODE selects when the heavy phases run:
+  background (default) - on a daemon thread started at import; readiness reports "warming"
+  eager                - synchronously at import, before the server binds
+  lazy                 - on the first request that needs the model
+  preload              - the model is loaded at import (in the gunicorn master with
+                         preload_app, so forked workers share its pages copy-on-write);
+                         each worker then builds its per-process state and runs the
+                         remaining phases after fork (see gunicorn.conf.py). Without that
+                         post_fork hook nothing would run them, so outside gunicorn.conf.py
+                         preload falls back to background
+"""
+import logging
+import os
+import threading
+from dotenv import load_dotenv
+from utils.log_utils import configure_logging
+from utils.admission_utils import create_admission_controller
+from utils.gpt_utils import create_openai_client
+from utils.cache_utils import create_prediction_cache
+from utils.db_utils import from_fallback
+from utils.knowledge_utils import create_knowledge_store, knowledge_result
+from utils.health_utils import ReadinessProbe, StartupState
+from utils.metrics_utils import REGISTRY
+from utils.vote_utils import dominant_diagnosis, early_exit_response, rank_diagnoses
+
+logger = logging.getLogger(__name__)
+
+class ServiceWarmingUp(Exception):
+    """Raised when a request needs the model or database before warm-up has finished."""
+
+startup = StartupState()
+
+load_dotenv()
+configure_logging()
+api_key = os.getenv('OPENAI_API_KEY')
+
+if not api_key:
+    logger.error("OPENAI_API_KEY not found in environment variables")
+    raise ValueError("OPENAI_API_KEY not found in environment variables")
+else:
+    logger.info("OpenAI API key loaded successfully")
+
+OPENAI_MODEL = "gpt-4o"
+OPENAI_MAX_TOKENS = 1000
+OPENAI_TEMPERATURE = 0.4
+# Neighbours fetched per query and aggregated into a ranked diagnosis shortlist
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', '30'))
+RETRIEVAL_VOTE_TEMPERATURE = float(os.getenv('RETRIEVAL_VOTE_TEMPERATURE', '0.05'))
+SHORTLIST_SIZE = int(os.getenv('RETRIEVAL_SHORTLIST_SIZE', '3'))
+# Answer without the LLM when one diagnosis holds this share of the vote (unset disables)
+_early_exit_confidence = os.getenv('RETRIEVAL_EARLY_EXIT_CONFIDENCE')
+EARLY_EXIT_CONFIDENCE = float(_early_exit_confidence) if _early_exit_confidence else None
+EARLY_EXIT_MIN_VOTES = int(os.getenv('RETRIEVAL_EARLY_EXIT_MIN_VOTES', '5'))
+# "full" always asks the LLM; "fast" answers from retrieval and the knowledge store when it can
+PREDICT_MODES = ('full', 'fast')
+DEFAULT_PREDICT_MODE = os.getenv('PREDICT_DEFAULT_MODE', 'full').lower()
+WARMUP_MODE = os.getenv('WARMUP_MODE', 'background').lower()
+if WARMUP_MODE == 'preload' and not os.getenv('WARMUP_POST_FORK'):
+    # gunicorn.conf.py sets WARMUP_POST_FORK; anywhere else (python app.py, hypercorn) no
+    # fork hook would build the per-process state or finish warming up
+    logger.warning("WARMUP_MODE=preload needs gunicorn.conf.py's post_fork hook, warming up in the background")
+    WARMUP_MODE = 'background'
+WARMUP_WAIT_SECONDS = float(os.getenv('WARMUP_WAIT_SECONDS', '0'))
+
+# Per-process state, filled in by init_process()
+prediction_cache = None
+# Bounded, prioritized admission in front of the predict endpoints (None when disabled)
+admission = None
+# Per-diagnosis risk factors and clinical features, built by setup.py (and learned from answers with KNOWLEDGE_LEARN)
+knowledge_store = None
+# One pooled client for the life of the process instead of one per request
+openai_client = None
+_process_pid = None
+
+# Filled in by warm_up()
+multimodal_ef = None
+db = None
+image_embedder = None
+search_index = None
+
+_warmup_lock = threading.Lock()
+_warmup_thread = None
+
+def init_process():
+    """
+    Build the state every process needs its own copy of: the prediction cache (the disk
+    backend holds SQLite connections), the admission controller's locks, the knowledge
+    store and the OpenAI client's connection pool. None of these survive fork(), so in
+    preload mode each gunicorn worker calls this after forking; otherwise it runs at import.
+    """
+    global prediction_cache, admission, knowledge_store, openai_client, _process_pid
+    if _process_pid == os.getpid():
+        return
+    prediction_cache = create_prediction_cache()
+    admission = create_admission_controller()
+    knowledge_store = create_knowledge_store()
+    openai_client = create_openai_client(api_key)
+    _process_pid = os.getpid()
+
+def load_model():
+    """
+    Phase 1: load the CLIP weights. The only phase preload runs before fork: the weights
+    are read-only afterwards, so workers can share them; everything else is per process.
+    """
+    global multimodal_ef
+    from utils.db_utils import load_embedding_function
+
+    if multimodal_ef is None:
+        with startup.phase("load_model"):
+            multimodal_ef = load_embedding_function()
+    return multimodal_ef
+
+def warm_up():
+    """Run every startup phase; the per-process ones (IRIS connection, batcher thread, index) come last."""
+    global db, image_embedder, search_index
+    from utils.db_utils import connect_db
+    from utils.batch_utils import create_embedding_batcher
+    from utils.index_utils import create_search_index
+
+    try:
+        load_model()
+        with startup.phase("connect_db"):
+            db = connect_db(multimodal_ef)
+        with startup.phase("start_batcher"):
+            # Concurrent /predict handlers share batched CLIP forward passes
+            image_embedder = create_embedding_batcher(multimodal_ef)
+            if image_embedder is not multimodal_ef:
+                REGISTRY.add_histogram(
+                    "dermacare_embed_batch_size", "Images per CLIP forward pass", image_embedder.batch_size_histogram
+                )
+                REGISTRY.add_histogram(
+                    "dermacare_embed_queue_seconds", "Time images wait for a CLIP batch",
+                    image_embedder.wait_time_histogram
+                )
+        with startup.phase("build_index"):
+            # Either the IRIS store itself or an in-process mirror of it (VECTOR_INDEX)
+            search_index = create_search_index(db)
+        startup.mark_ready()
+        logger.info("Warm-up complete: %s", startup.phases)
+    except Exception as e:
+        logger.exception("Warm-up failed")
+        startup.mark_failed(e)
+        raise
+
+def start_warmup():
+    """Start warm_up() on a background thread (once per process)."""
+    global _warmup_thread
+    with _warmup_lock:
+        if _warmup_thread is None:
+            def run():
+                try:
+                    warm_up()
+                except Exception:
+                    pass  # already reported and recorded on startup
+
+            _warmup_thread = threading.Thread(target=run, name="warmup", daemon=True)
+            _warmup_thread.start()
+
+def shortlist_neighbours(scored_results):
+    """
+    Rank scored neighbours into the diagnosis shortlist. Returns (shortlist, dominant),
+    where dominant is the top entry when it clears the early-exit thresholds, else None.
+    """
+    shortlist = rank_diagnoses(scored_results, RETRIEVAL_VOTE_TEMPERATURE, SHORTLIST_SIZE)
+    return shortlist, dominant_diagnosis(shortlist, EARLY_EXIT_CONFIDENCE, EARLY_EXIT_MIN_VOTES)
+
+def retrieval_answer(ranked, dominant, mode):
+    """
+    The diagnosis result retrieval alone can give, or None when the LLM is needed: the
+    early-exit diagnosis (with its stored facts when known), or in fast mode the shortlist
+    entries the knowledge store knows, provided it knows the top one.
+    """
+    if dominant is not None:
+        return knowledge_result([dominant], knowledge_store) or early_exit_response(dominant)
+    if mode == 'fast':
+        return knowledge_result(ranked, knowledge_store)
+    return None
+
+def learn_from(result, ranked):
+    """Add an LLM answer's per-diagnosis facts to the knowledge store (a no-op unless KNOWLEDGE_LEARN is set)."""
+    knowledge_store.learn(result["diagnoses"], [entry["diagnosis"] for entry in ranked])
+
+def keep_answer(image_hash, patient_hist, result, ranked, payload, scored_results):
+    """
+    Cache an LLM answer and learn from it. Answers built on prototype fallback neighbours
+    are kept out of both, so the image is searched and answered again once the index is back.
+    """
+    if from_fallback(scored_results):
+        logger.info("Not caching an answer built on fallback neighbours")
+        return
+    learn_from(result, ranked)
+    prediction_cache.put_response(image_hash, patient_hist, OPENAI_MODEL, OPENAI_TEMPERATURE, payload)
+
+def require_ready():
+    """Wait up to WARMUP_WAIT_SECONDS for warm-up, raising ServiceWarmingUp if it hasn't finished."""
+    if startup.ready:
+        return
+    if WARMUP_MODE == 'lazy':
+        start_warmup()
+    if not startup.wait(WARMUP_WAIT_SECONDS):
+        raise ServiceWarmingUp(f"Service is {startup.status}, retry shortly")
+
+readiness_probe = ReadinessProbe(
+    lambda: db,
+    model_loaded=lambda: multimodal_ef is not None,
+    ttl=float(os.getenv('READINESS_CACHE_SECONDS', '5')),
+    startup=startup
+)
+
+if WARMUP_MODE != 'preload':
+    init_process()
+
+if WARMUP_MODE == 'eager':
+    warm_up()
+elif WARMUP_MODE == 'background':
+    start_warmup()
+elif WARMUP_MODE == 'preload':
+    load_model()
+elif WARMUP_MODE != 'lazy':
+    raise ValueError(f"Unknown WARMUP_MODE: {WARMUP_MODE}")
@@ -1,8 +1,6 @@
 import os
 from dotenv import load_dotenv
-from langchain_experimental.open_clip import OpenCLIPEmbeddings
-from langchain_iris import IRISVector
-from langchain.docstore.document import Document
+import argparse
 import re
 import time
 import sys
@@ -54,13 +52,17 @@ def create_documents_from_images(root_dir):
     Walk through the dataset directory and create a Document for each image.
     The document's page_content is set to the image file path and its metadata contains the diagnosis.
     """
+    from langchain.docstore.document import Document
+
     docs = []
     errors = []
     skipped = 0
     
     for root, dirs, files in os.walk(root_dir):
+        # Skip .ipynb_checkpoints and other hidden directories
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
         for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg')):
+            if not file.startswith('.') and file.lower().endswith(('.png', '.jpg', '.jpeg')):
                 try:
                     full_path = os.path.join(root, file)
                     # Verify image can be opened
@@ -76,12 +78,50 @@ def create_documents_from_images(root_dir):
     
     return docs, errors, skipped
 
-def batch(iterable, n=1):
-    """Yield successive n-sized batches from iterable."""
-    for i in range(0, len(iterable), n):
-         yield iterable[i:i + n]
+def build_knowledge_store(state_dir):
+    """Fill the per-diagnosis knowledge store for every diagnosis in the ingestion manifest."""
+    from utils.gpt_utils import create_openai_client, query_openai_with_image_and_text
+    from utils.ingest_utils import IngestManifest
+    from utils.knowledge_utils import KNOWLEDGE_NAME, KnowledgeStore, build_knowledge
+
+    names = sorted({extract_diagnosis(os.path.basename(path)) for path in IngestManifest(state_dir).entries})
+    knowledge_path = os.path.join(state_dir, KNOWLEDGE_NAME)
+    print(f"\nBuilding knowledge for {len(names)} diagnoses...")
+    client = create_openai_client(os.environ["OPENAI_API_KEY"])
+    failed = build_knowledge(
+        names,
+        lambda prompt: query_openai_with_image_and_text(prompt, client=client, temperature=0.2),
+        KnowledgeStore(knowledge_path)
+    )
+    print(f"Saved knowledge for {len(names) - len(failed)} diagnoses to {knowledge_path}")
+    for name in failed:
+        print(f"- No knowledge for {name}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Index the DermNet dataset into IRIS")
+    parser.add_argument("--dataset", help="Dataset directory (defaults to the Kaggle download)")
+    parser.add_argument("--state-dir", default=".ingest",
+                        help="Directory holding the ingestion manifest/checkpoint")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="Images embedded and committed per batch")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes used to decode and preprocess images")
+    parser.add_argument("--prune", action="store_true",
+                        help="Remove rows for images that no longer exist in the dataset")
+    parser.add_argument("--phash-distance", type=int, default=5,
+                        help="Index an image only once when another image's perceptual hash is within "
+                             "this many bits (-1 keeps near duplicates, exact copies are always collapsed)")
+    parser.add_argument("--dedup-similarity", type=float, default=0.97,
+                        help="Merge indexed images whose embeddings are at least this cosine-similar (0 skips)")
+    parser.add_argument("--prototypes-per-class", type=int, default=4,
+                        help="k-means prototypes per diagnosis saved next to the manifest (0 skips)")
+    parser.add_argument("--build-knowledge", action="store_true",
+                        help="Ask the LLM once per diagnosis for its risk factors and clinical features "
+                             "and save them next to the manifest (used by /predict fast mode)")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     print("Starting setup process...")
     
     # Check requirements first
@@ -95,46 +135,31 @@ def main():
     # Load environment variables
     load_dotenv()
     
-    # Download the dataset from Kaggle
-    print("\nDownloading dataset from Kaggle...")
-    try:
-        import kagglehub
-        dataset_path = kagglehub.dataset_download("shubhamgoel27/dermnet")
-        print("Dataset downloaded to:", dataset_path)
-    except Exception as e:
-        print(f"Error downloading dataset: {str(e)}")
-        print("Attempting to use local dataset path...")
-        dataset_path = "../data/dermnet_data"
-        if not os.path.exists(dataset_path):
-            print(f"ERROR: Local dataset not found at {dataset_path}")
-            sys.exit(1)
+    if args.dataset:
+        dataset_path = args.dataset
+    else:
+        # Download the dataset from Kaggle
+        print("\nDownloading dataset from Kaggle...")
+        try:
+            import kagglehub
+            dataset_path = kagglehub.dataset_download("shubhamgoel27/dermnet")
+            print("Dataset downloaded to:", dataset_path)
+        except Exception as e:
+            print(f"Error downloading dataset: {str(e)}")
+            print("Attempting to use local dataset path...")
+            dataset_path = "../data/dermnet_data"
+    if not os.path.exists(dataset_path):
+        print(f"ERROR: Dataset not found at {dataset_path}")
+        sys.exit(1)
     
     try:
-        # Create documents from images
-        print("\nProcessing images...")
-        docs, errors, skipped = create_documents_from_images(dataset_path)
-        
-        if errors:
-            print("\nWarnings during image processing:")
-            for error in errors:
-                print(f"- {error}")
-        
-        print(f"\nProcessed {len(docs)} images successfully")
-        if skipped > 0:
-            print(f"Skipped {skipped} problematic images")
-        
-        if not docs:
-            print("No valid documents created. Aborting setup.")
-            sys.exit(1)
-        
         # Initialize the image embedding function
         print("\nInitializing embedding function...")
         try:
             print("Loading OpenCLIP model (this may take a few minutes)...")
-            multimodal_ef = OpenCLIPEmbeddings(
-                model_name="ViT-B-32",  
-                checkpoint="laion2b_s34b_b79k"
-            )
+            # Heavy imports (torch, langchain) are deferred until they are actually needed
+            from utils.model_utils import load_clip_embeddings
+            multimodal_ef = load_clip_embeddings()
             print("OpenCLIP model loaded successfully!")
         except Exception as e:
             print(f"\nERROR: Failed to initialize embedding function:")
@@ -154,40 +179,76 @@ def main():
         CONNECTION_STRING = f"iris://{username}:{password}@{hostname}:{port}/{namespace}"
         COLLECTION_NAME = "dermnet_multimodal"
         
-        # Create vector store
-        print("\nCreating vector store...")
+        # Index new and changed images; unchanged ones are skipped using the manifest
+        print("\nIndexing images...")
         start = time.time()
         
         try:
-            batch_size = 1000
+            from langchain_iris import IRISVector
+            from utils.ingest_utils import collapse_duplicates, ingest_images
 
-            for i, batch_docs in enumerate(batch(docs, batch_size)):
-                print(f"Processing batch {i+1} with {len(batch_docs)} documents...")
-                if i == 0:
-                    # Create the store for the first batch
-                    db = IRISVector.from_documents(
-                        embedding=multimodal_ef,
-                        documents=batch_docs,
-                        collection_name=COLLECTION_NAME,
-                        connection_string=CONNECTION_STRING,
-                    )
-                else:
-                    # For subsequent batches, add documents to the existing store
-                    db.add_documents(batch_docs)
-                print(f"Batch {i+1} processed.")
+            db = IRISVector(
+                embedding_function=multimodal_ef,
+                collection_name=COLLECTION_NAME,
+                connection_string=CONNECTION_STRING,
+            )
+            summary = ingest_images(
+                dataset_path,
+                multimodal_ef,
+                db,
+                extract_diagnosis,
+                state_dir=args.state_dir,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                prune=args.prune,
+                phash_distance=args.phash_distance
+            )
+            
+            if summary["errors"]:
+                print("\nWarnings during image processing:")
+                for error in summary["errors"]:
+                    print(f"- {error}")
+            
+            # Merge embedding-space near duplicates and aggregate metadata over every duplicate group
+            from utils.dedup_utils import DEDUP_REPORT_NAME
+            report = collapse_duplicates(
+                db,
+                extract_diagnosis,
+                state_dir=args.state_dir,
+                min_similarity=args.dedup_similarity,
+                hidden=summary["hidden"]
+            )
             
             elapsed = time.time() - start
             ids = db.get().get("ids", [])
             print("\nSetup completed successfully!")
+            print(f"Added {summary['added']}, updated {summary['updated']}, "
+                  f"unchanged {summary['skipped']}, removed {summary['removed']}, "
+                  f"skipped {len(summary['errors'])} problematic images")
+            print(f"Duplicates: {report['duplicates']} images folded into {len(report['groups'])} indexed images "
+                  f"({', '.join(f'{n} {reason}' for reason, n in sorted(report['by_reason'].items())) or 'none'}), "
+                  f"report in {os.path.join(args.state_dir, DEDUP_REPORT_NAME)}")
             print(f"Number of docs in vector store: {len(ids)}")
             print(f"Time taken: {elapsed:.2f} seconds")
             
+            if args.prototypes_per_class > 0:
+                # Per-diagnosis prototypes: coarse first stage and fallback for the serving path
+                from utils.index_utils import PROTOTYPES_NAME, build_prototype_table
+                prototypes_path = os.path.join(args.state_dir, PROTOTYPES_NAME)
+                table = build_prototype_table(db, prototypes_path, per_class=args.prototypes_per_class)
+                print(f"Saved {len(table)} prototypes for {len(table.classes)} diagnoses to {prototypes_path}")
+            
+            if args.build_knowledge:
+                build_knowledge_store(args.state_dir)
+            
         except Exception as e:
             print(f"\nERROR: Failed to create vector store: {str(e)}")
+            print(f"Re-run setup to resume from the last committed batch in {args.state_dir}")
             sys.exit(1)
             
     except KeyboardInterrupt:
         print("\nSetup interrupted by user")
+        print(f"Re-run setup to resume from the last committed batch in {args.state_dir}")
         sys.exit(1)
     except Exception as e:
         print(f"\nUnexpected error during setup: {str(e)}")
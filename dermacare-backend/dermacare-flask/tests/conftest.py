@@ -0,0 +1,23 @@
+"""
+Shared fixtures. The tests cover the pure logic in utils/ and run without torch, IRIS or
+an OpenAI key: the benchmarks' stand-ins (stub_store, fake_openai) replace the model,
+the database and the API.
+"""
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+
+@pytest.fixture
+def image_bytes():
+    """Factory for encoded test images: image_bytes(size=(64, 48), mode="RGB", fmt="PNG", seed=0)."""
+    def make(size=(64, 48), mode="RGB", fmt="PNG", seed=0):
+        rng = np.random.default_rng(seed)
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        image = Image.fromarray(pixels, "RGB")
+        if mode != "RGB":
+            image = image.convert(mode)
+        buffer = BytesIO()
+        image.save(buffer, format=fmt)
+        return buffer.getvalue()
+    return make
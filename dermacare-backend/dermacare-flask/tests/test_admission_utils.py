@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+import pytest
+from utils.admission_utils import AdmissionController, AdmissionRejected, admission_params
+
+def queued(controller):
+    return sum(controller.stats()["queued"].values())
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def start_waiter(controller, priority, client, admitted, timeout=None):
+    """Queue an acquire on a thread; on admission it appends (priority, client) to admitted."""
+    def run():
+        try:
+            controller.acquire(priority, client, timeout)
+            admitted.append((priority, client))
+        except AdmissionRejected as e:
+            admitted.append((e.reason, client))
+
+    expected = queued(controller) + 1
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    wait_until(lambda: queued(controller) == expected or admitted)
+    return thread
+
+def test_interactive_admitted_before_earlier_batch():
+    controller = AdmissionController(max_concurrent=1)
+    controller.acquire("batch", "holder")
+    admitted = []
+    batch = start_waiter(controller, "batch", "b", admitted)
+    interactive = start_waiter(controller, "interactive", "i", admitted)
+
+    controller.release("batch", "holder")
+    interactive.join(1)
+    assert admitted == [("interactive", "i")]
+    controller.release("interactive", "i")
+    batch.join(1)
+    assert admitted == [("interactive", "i"), ("batch", "b")]
+
+def test_reserved_slots_are_kept_from_batch_work():
+    controller = AdmissionController(max_concurrent=2, reserved_interactive=1)
+    controller.acquire("batch", "a")
+    admitted = []
+    start_waiter(controller, "batch", "b", admitted)
+    assert controller.stats()["queued"]["batch"] == 1
+    controller.acquire("interactive", "c")  # the reserved slot is still free
+    assert controller.stats()["in_flight"] == {"interactive": 1, "batch": 1}
+
+def test_queued_request_expires_at_its_deadline():
+    controller = AdmissionController(max_concurrent=1)
+    controller.acquire("interactive", "holder")
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("interactive", "late", timeout=0.05)
+    assert rejected.value.reason == "deadline"
+    assert rejected.value.status == 503
+    assert time.monotonic() - started < 1
+    assert queued(controller) == 0
+    assert controller.stats()["clients"] == 1
+
+def test_per_client_limit():
+    controller = AdmissionController(max_concurrent=4, per_client=2)
+    controller.acquire("interactive", "greedy")
+    controller.acquire("interactive", "greedy")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("interactive", "greedy")
+    assert (rejected.value.reason, rejected.value.status) == ("client_limit", 429)
+    controller.acquire("interactive", "other")
+    controller.release("interactive", "greedy")
+    controller.acquire("interactive", "greedy")
+
+def test_full_queue_sheds_or_evicts_batch_work():
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    controller.acquire("interactive", "holder")
+    admitted = []
+    batch = start_waiter(controller, "batch", "b", admitted)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("batch", "c", timeout=1)
+    assert rejected.value.reason == "queue_full"
+
+    # An interactive arrival takes the newest batch waiter's place in the queue
+    interactive = start_waiter(controller, "interactive", "i", admitted)
+    batch.join(1)
+    assert admitted == [("evicted", "b")]
+    controller.release("interactive", "holder")
+    interactive.join(1)
+    assert admitted[-1] == ("interactive", "i")
+
+def test_acquire_async_waits_for_release():
+    controller = AdmissionController(max_concurrent=1)
+
+    async def run():
+        controller.acquire("interactive", "holder")
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, controller.release, "interactive", "holder")
+        await controller.acquire_async("interactive", "async", timeout=1)
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire_async("interactive", "late", timeout=0.05)
+
+    asyncio.run(run())
+    assert controller.stats()["in_flight"]["interactive"] == 1
+
+def test_admission_params_only_lower_priority():
+    assert admission_params({}, "10.0.0.1", "interactive") == ("interactive", "10.0.0.1", None)
+    assert admission_params({"X-Priority": "Batch"}, "10.0.0.1", "interactive")[0] == "batch"
+    # A batch endpoint cannot be promoted, and unknown values keep the default
+    assert admission_params({"X-Priority": "interactive"}, "10.0.0.1", "batch")[0] == "batch"
+    assert admission_params({"X-Priority": "urgent"}, "10.0.0.1", "interactive")[0] == "interactive"
+
+def test_admission_params_ignore_client_supplied_identity():
+    headers = {"X-Client-ID": "rotating-1234", "X-Deadline-Ms": "250"}
+    assert admission_params(headers, "10.0.0.1", "interactive") == ("interactive", "10.0.0.1", 0.25)
+    assert admission_params({"X-Deadline-Ms": "soon"}, "10.0.0.1", "batch")[2] is None
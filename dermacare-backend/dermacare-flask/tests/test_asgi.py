@@ -0,0 +1,56 @@
+import asyncio
+from io import BytesIO
+import pytest
+from werkzeug.datastructures import FileStorage
+from utils.image_utils import UploadRejected
+
+@pytest.fixture(scope="module")
+def asgi():
+    """The async app with warm-up left to the first request (which these tests never reach)."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("WARMUP_MODE", "lazy")
+        patch.setenv("OPENAI_API_KEY", "test")
+        import asgi
+    return asgi
+
+@pytest.fixture
+def post_predict(asgi, monkeypatch):
+    monkeypatch.setattr(asgi.services, "require_ready", lambda: None)
+
+    def post(data, filename="lesion.png"):
+        async def run():
+            response = await asgi.app.test_client().post("/predict", form={"patient_history": "itchy"}, files={
+                "image": FileStorage(stream=BytesIO(data), filename=filename, name="image")
+            })
+            return response.status_code, await response.get_json()
+        return asyncio.run(run())
+    return post
+
+def test_oversized_body_is_413(asgi, post_predict, image_bytes, monkeypatch):
+    monkeypatch.setitem(asgi.app.config, "MAX_CONTENT_LENGTH", 1000)
+    status, body = post_predict(image_bytes(size=(200, 200)))
+    assert status == 413
+    assert body["error"] == "Request body exceeds 1000 bytes"
+
+def test_oversized_image_is_413(asgi, post_predict, image_bytes, monkeypatch):
+    monkeypatch.setattr(asgi, "UPLOAD_MAX_BYTES", 1000)
+    status, body = post_predict(image_bytes(size=(200, 200)))
+    assert status == 413
+    assert body["error"] == "Each image must be at most 1000 bytes"
+
+def test_upload_is_decoded_without_a_copy(asgi, post_predict, image_bytes, monkeypatch):
+    received = []
+
+    def normalize_image(data):
+        received.append(type(data))
+        raise UploadRejected("stop here", 400)
+
+    monkeypatch.setattr(asgi, "normalize_image", normalize_image)
+    status, body = post_predict(image_bytes())
+    assert (status, body["error"]) == (400, "stop here")
+    assert received == [memoryview]
+
+def test_unreadable_upload_message_is_fixed(post_predict):
+    status, body = post_predict(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64)
+    assert status == 400
+    assert body == {"error": "Unreadable PNG image"}
@@ -0,0 +1,70 @@
+import time
+from utils.cache_utils import DiskCache, LRUCache, PredictionCache, normalize_history
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+def test_lru_ttl_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = LRUCache(ttl=10)
+    cache.put("a", 1)
+    now[0] += 5
+    assert cache.get("a") == 1
+    now[0] += 6
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+def test_disk_cache_round_trip_and_persistence(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    DiskCache(str(path)).put("key", {"embedding": [0.1, 0.2], "k": 3})
+    assert DiskCache(str(path)).get("key") == {"embedding": [0.1, 0.2], "k": 3}
+
+def test_disk_cache_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), ttl=10)
+    cache.put("key", "value")
+    now[0] += 5
+    assert cache.get("key") == "value"
+    now[0] += 6
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+def test_disk_cache_evicts_least_recently_accessed(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for key in ("a", "b"):
+        now[0] += 1
+        cache.put(key, key)
+    now[0] += 1
+    cache.get("a")
+    now[0] += 1
+    cache.put("c", "c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert len(cache) == 2
+
+def test_normalize_history_json_ignores_key_order_and_spacing():
+    assert normalize_history('{"age": 30, "sex": "F"}') == normalize_history('{ "sex":"F",\n "age":30 }')
+
+def test_normalize_history_text_collapses_whitespace():
+    assert normalize_history("itchy  rash\n on arms ") == "itchy rash on arms"
+    assert normalize_history("itchy rash") != normalize_history("itchy rash, fever")
+
+def test_response_key_shares_entries_for_equivalent_histories():
+    cache = PredictionCache(LRUCache(), LRUCache())
+    cache.put_response("hash", '{"a": 1, "b": 2}', "gpt-4o", 0.4, {"response": "[]"})
+    assert cache.get_response("hash", '{"b":2,"a":1}', "gpt-4o", 0.4) == {"response": "[]"}
+    assert cache.get_response("hash", '{"b":2,"a":1}', "gpt-4o", 0.7) is None
+    stats = cache.stats()
+    assert stats["responses_hits"] == 1 and stats["responses_misses"] == 1
@@ -0,0 +1,56 @@
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from utils.dedup_utils import HashIndex, cluster_pairs, dhash, hamming_distances, is_hidden, similar_pairs
+from utils.index_utils import normalize_rows
+
+def photo(seed, size=(256, 192)):
+    """A smooth random image, closer to a photograph than pixel noise."""
+    coarse = np.random.default_rng(seed).integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(coarse, "RGB").resize(size, Image.BICUBIC)
+
+def reencode(image, fmt="JPEG", **params):
+    buffer = BytesIO()
+    image.save(buffer, format=fmt, **params)
+    return Image.open(BytesIO(buffer.getvalue()))
+
+def distance(a, b):
+    return int(hamming_distances(np.frombuffer(bytes.fromhex(a), dtype=np.uint8)[None, :], b)[0])
+
+def test_is_hidden():
+    assert is_hidden(".ipynb_checkpoints") and is_hidden(".DS_Store")
+    assert not is_hidden("Acne_1.png")
+
+def test_dhash_survives_resizing_and_reencoding():
+    original = dhash(photo(1))
+    assert len(original) == 16
+    assert dhash(photo(1)) == original
+    assert distance(original, dhash(photo(1).resize((128, 96)))) <= 5
+    assert distance(original, dhash(reencode(photo(1), quality=60))) <= 5
+    assert distance(original, dhash(photo(2))) > 10
+
+def test_hash_index_matches_exact_and_near_duplicates():
+    index = HashIndex(max_distance=5)
+    assert index.match("sha-a", dhash(photo(1))) is None
+    index.add("a.png", "sha-a", dhash(photo(1)))
+    index.add("b.png", "sha-b", dhash(photo(2)))
+    assert len(index) == 2
+    assert index.match("sha-a") == ("a.png", "sha256", 0)
+    path, reason, bits = index.match("sha-c", dhash(reencode(photo(2), quality=60)))
+    assert (path, reason) == ("b.png", "phash") and bits <= 5
+    assert index.match("sha-d", dhash(photo(3))) is None
+    # A negative max_distance disables perceptual matching
+    assert HashIndex(max_distance=-1).match("sha-c", dhash(photo(2))) is None
+
+def test_similar_pairs_across_blocks():
+    rng = np.random.default_rng(0)
+    base = normalize_rows(rng.standard_normal((4, 32)).astype(np.float32))
+    matrix = normalize_rows(np.concatenate([base, base[[0, 2]] + 0.01]).astype(np.float32))
+    pairs = similar_pairs(matrix, 0.99, block_size=2)
+    assert [(i, j) for i, j, _ in pairs] == [(0, 4), (2, 5)]
+    assert all(similarity >= 0.99 for _, _, similarity in pairs)
+
+def test_cluster_pairs_finds_connected_components():
+    roots = cluster_pairs(6, [(0, 3, 0.99), (3, 5, 0.98), (1, 2)])
+    assert roots == [0, 1, 1, 0, 4, 0]
+    assert cluster_pairs(3, []) == [0, 1, 2]
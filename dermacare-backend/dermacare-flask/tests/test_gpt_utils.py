@@ -0,0 +1,49 @@
+import json
+import pytest
+from utils.gpt_utils import (
+    DiagnosisFormatError, diagnosis_result, parse_diagnosis_response, response_format, validate_diagnoses
+)
+
+PSORIASIS = {"Diagnosis": "Psoriasis", "Risk factors": ["Stress"], "Clinical features": ["Silvery scales"]}
+
+def test_validate_accepts_object_and_bare_list():
+    assert validate_diagnoses({"diagnoses": [PSORIASIS]}) == [PSORIASIS]
+    assert validate_diagnoses([PSORIASIS]) == [PSORIASIS]
+    assert validate_diagnoses({"diagnoses": []}) == []
+
+def test_validate_drops_repeated_names_and_fills_missing_lists():
+    diagnoses = validate_diagnoses([PSORIASIS, {"Diagnosis": " psoriasis "}, {"Diagnosis": "Eczema"}])
+    assert [entry["Diagnosis"] for entry in diagnoses] == ["Psoriasis", "Eczema"]
+    assert diagnoses[1] == {"Diagnosis": "Eczema", "Risk factors": [], "Clinical features": []}
+
+@pytest.mark.parametrize("data", [
+    {"answer": []},
+    "Psoriasis",
+    [{"Diagnosis": ""}],
+    ["Psoriasis"],
+    [{"Diagnosis": "Acne", "Risk factors": "Stress"}],
+    [{"Diagnosis": "Acne", "Clinical features": [1, 2]}],
+])
+def test_validate_rejects_malformed_answers(data):
+    with pytest.raises(DiagnosisFormatError):
+        validate_diagnoses(data)
+
+def test_parse_tolerates_a_json_fence():
+    text = "```json\n" + json.dumps({"diagnoses": [PSORIASIS]}) + "\n```"
+    assert parse_diagnosis_response(text) == [PSORIASIS]
+    assert parse_diagnosis_response("not json") is None
+    assert parse_diagnosis_response(None) is None
+
+def test_diagnosis_result_reserializes_without_fences():
+    result = diagnosis_result("```\n" + json.dumps([PSORIASIS]) + "\n```")
+    assert json.loads(result["response"]) == [PSORIASIS]
+    assert result["source"] == "llm"
+    with pytest.raises(DiagnosisFormatError):
+        diagnosis_result('{"diagnoses": "none"}')
+
+def test_response_format_modes():
+    assert response_format("json_schema")["json_schema"]["strict"] is True
+    assert response_format("json_object") == {"type": "json_object"}
+    assert response_format("text") is None
+    with pytest.raises(ValueError):
+        response_format("yaml")
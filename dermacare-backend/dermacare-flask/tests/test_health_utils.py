@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+import pytest
+from benchmarks.stub_store import StubDatabase, synthetic_store
+from utils.health_utils import ReadinessProbe, StartupState, readiness_status
+
+class BrokenDatabase:
+    def __init__(self):
+        self._conn = SimpleNamespace(engine=self)
+
+    def connect(self):
+        raise ConnectionError("IRIS is down")
+
+@pytest.fixture(scope="module")
+def database():
+    return StubDatabase(synthetic_store(20, dimension=8, seed=0))
+
+def test_ready_once_startup_completes(database):
+    startup = StartupState()
+    probe = ReadinessProbe(lambda: database, model_loaded=lambda: True, ttl=0, startup=startup)
+    result = probe.check()
+    assert not result["ready"]
+    assert readiness_status(result) == "warming"
+
+    startup.mark_ready()
+    result = probe.check()
+    assert result["ready"] and result["database"] == "connected"
+    assert result["collection_empty"] is False
+    assert readiness_status(result) == "ready"
+
+def test_failed_startup_is_reported():
+    startup = StartupState()
+    startup.mark_failed(RuntimeError("no weights"))
+    result = ReadinessProbe(lambda: None, model_loaded=lambda: False, startup=startup).check()
+    assert readiness_status(result) == "failed"
+    assert result["startup"]["error"] == "no weights"
+
+def test_database_failure_after_startup_is_not_ready():
+    startup = StartupState()
+    startup.mark_ready()
+    result = ReadinessProbe(BrokenDatabase, model_loaded=lambda: True, startup=startup).check()
+    assert not result["ready"]
+    assert result["error"] == "IRIS is down"
+    assert readiness_status(result) == "not ready"
+
+def test_results_are_cached_for_ttl(database):
+    calls = []
+
+    def get_db():
+        calls.append(1)
+        return database
+
+    probe = ReadinessProbe(get_db, model_loaded=lambda: True, ttl=60)
+    probe.check()
+    assert probe.check()["ready"]
+    assert len(calls) == 1
@@ -0,0 +1,85 @@
+from io import BytesIO
+import pytest
+from PIL import Image
+from utils.cache_utils import hash_image_bytes
+from utils.image_utils import BufferStream, UploadRejected, normalize_image, probe_upload, sniff_image_format
+
+def encode(image, fmt="PNG"):
+    buffer = BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "LA", "L", "P"])
+def test_normalize_converts_modes_to_rgb_jpeg(image_bytes, mode):
+    decoded = normalize_image(image_bytes(mode=mode))
+    assert decoded.format == "JPEG"
+    assert decoded.image.mode == "RGB"
+    assert decoded.data[:3] == b"\xff\xd8\xff"
+    assert Image.open(BytesIO(decoded.data)).mode == "RGB"
+
+def test_normalize_flattens_transparency_onto_white():
+    image = Image.new("RGBA", (32, 32), (255, 0, 0, 0))
+    decoded = normalize_image(encode(image))
+    assert decoded.image.getpixel((16, 16)) == (255, 255, 255)
+
+def test_normalize_downscales_to_max_side(image_bytes):
+    decoded = normalize_image(image_bytes(size=(400, 200), fmt="JPEG"), max_side=100)
+    assert decoded.image.size == (100, 50)
+    small = normalize_image(image_bytes(size=(80, 60)), max_side=100)
+    assert small.image.size == (80, 60)  # never upscaled
+
+def test_normalize_records_source_size(image_bytes):
+    data = image_bytes()
+    assert normalize_image(data).source_size == len(data)
+    assert normalize_image(memoryview(data)).source_size == len(data)
+
+def test_normalized_hash_is_stable(image_bytes):
+    data = image_bytes(size=(120, 90))
+    first = hash_image_bytes(normalize_image(data))
+    assert hash_image_bytes(normalize_image(data)) == first
+    assert hash_image_bytes(normalize_image(memoryview(data))) == first
+    assert hash_image_bytes(normalize_image(image_bytes(size=(120, 90), seed=1))) != first
+
+def test_sniff_image_format_reads_magic_bytes(image_bytes):
+    assert sniff_image_format(image_bytes(fmt="PNG")) == "PNG"
+    assert sniff_image_format(memoryview(image_bytes(fmt="JPEG"))) == "JPEG"
+    assert sniff_image_format(image_bytes(fmt="GIF")) is None
+    assert sniff_image_format(b"") is None
+
+def test_probe_reads_dimensions_from_the_header(image_bytes):
+    assert probe_upload(image_bytes(size=(64, 48), fmt="JPEG")) == ("JPEG", (64, 48))
+
+@pytest.mark.parametrize("data", [b"not an image", b"\x89PNG\r\n\x1a\n" + b"\x00" * 32, b"\xff\xd8\xff"])
+def test_probe_rejects_unsupported_and_corrupt_files(data):
+    with pytest.raises(UploadRejected) as rejected:
+        probe_upload(data)
+    assert rejected.value.status == 400
+    # A fixed message: the parser's own names internal objects
+    assert "object at" not in str(rejected.value)
+
+def test_probe_rejects_oversized_dimensions(image_bytes, monkeypatch):
+    with pytest.raises(UploadRejected) as rejected:
+        probe_upload(image_bytes(size=(200, 100)), max_pixels=10000)
+    assert rejected.value.status == 413
+    # Far past PIL's own limit the header read itself refuses the image
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    with pytest.raises(UploadRejected) as rejected:
+        probe_upload(image_bytes(size=(100, 100)))
+    assert rejected.value.status == 413
+
+def test_normalize_rejects_before_decoding(image_bytes, monkeypatch):
+    monkeypatch.setenv("IMAGE_MAX_PIXELS", "1000")
+    with pytest.raises(UploadRejected) as rejected:
+        normalize_image(image_bytes(size=(64, 48)))
+    assert rejected.value.status == 413
+
+def test_buffer_stream_reads_and_seeks_in_place():
+    stream = BufferStream(bytearray(b"0123456789"))
+    assert stream.read(4) == b"0123"
+    stream.seek(-2, 2)
+    assert stream.read() == b"89"
+    stream.seek(1)
+    buffer = bytearray(3)
+    assert stream.readinto(buffer) == 3 and buffer == b"123"
+    stream.close()
+    assert stream.closed
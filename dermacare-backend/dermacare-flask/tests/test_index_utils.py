@@ -0,0 +1,142 @@
+import time
+import numpy as np
+import pytest
+from benchmarks.stub_store import synthetic_store
+from utils.db_utils import from_fallback
+from utils.index_utils import FallbackSearchIndex, LocalVectorIndex, PrototypeIndex, normalize_rows, top_k_indices
+
+DIAGNOSES = ["Acne", "Eczema", "Psoriasis", "Rosacea"]
+
+@pytest.fixture(scope="module")
+def store():
+    return synthetic_store(2000, dimension=64, diagnoses=DIAGNOSES, seed=1)
+
+@pytest.fixture(scope="module")
+def queries():
+    return normalize_rows(np.random.default_rng(7).standard_normal((40, 64)).astype(np.float32))
+
+def ids(results):
+    return [doc.page_content for doc, _ in results]
+
+def recall(index, reference, queries, k):
+    found = [
+        len(set(ids(index.similarity_search_with_score_by_vector(query, k=k))) & set(ids(expected))) / k
+        for query, expected in zip(queries, reference)
+    ]
+    return float(np.mean(found))
+
+def test_top_k_indices_orders_best_first():
+    scores = np.array([0.1, 0.9, 0.5, 0.7])
+    assert top_k_indices(scores, 2).tolist() == [1, 3]
+    assert top_k_indices(scores, 10).tolist() == [1, 3, 2, 0]
+
+def test_exact_search_matches_brute_force(store, queries):
+    snapshot = store._snapshot
+    for query in queries[:5]:
+        results = store.similarity_search_with_score_by_vector(query, k=10)
+        expected = np.argsort(-(snapshot.matrix @ query))[:10]
+        assert ids(results) == [snapshot.documents[i] for i in expected]
+        # Cosine distance, as IRISVector reports it
+        assert results[0][1] == pytest.approx(1.0 - float(snapshot.matrix[expected[0]] @ query), abs=1e-5)
+
+def test_batched_search_matches_single_queries(store, queries):
+    batched = store.similarity_search_with_score_by_vectors(queries[:4], k=5)
+    assert [ids(results) for results in batched] == [
+        ids(store.similarity_search_with_score_by_vector(query, k=5)) for query in queries[:4]
+    ]
+
+def test_ivf_recall_against_exact(store, queries):
+    snapshot = store._snapshot
+    reference = store.similarity_search_with_score_by_vectors(queries, k=10)
+
+    def ivf(n_probe):
+        return LocalVectorIndex.from_arrays(snapshot.ids, snapshot.matrix, snapshot.documents, snapshot.metadatas,
+                                            approximate=True, n_lists=16, n_probe=n_probe)
+
+    # Probing every list is an exhaustive search; fewer lists trade recall for speed
+    assert recall(ivf(16), reference, queries, 10) == 1.0
+    partial = recall(ivf(4), reference, queries, 10)
+    assert 0.3 < partial < 1.0
+    assert recall(ivf(8), reference, queries, 10) >= partial
+
+def test_filter_restricts_results(store, queries):
+    results = store.similarity_search_with_score_by_vector(queries[0], k=5, filter={"diagnosis": "Eczema"})
+    assert len(results) == 5
+    assert {doc.metadata["diagnosis"] for doc, _ in results} == {"Eczema"}
+
+class FailingIndex:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        raise ConnectionError("IRIS is down")
+
+@pytest.fixture(scope="module")
+def prototypes(store):
+    return PrototypeIndex.from_local_index(store, per_class=4)
+
+def test_prototypes_cover_every_diagnosis(prototypes, store, queries):
+    assert set(prototypes.classes) == set(DIAGNOSES)
+    assert len(prototypes) <= 4 * len(DIAGNOSES)
+    assert int(prototypes.counts.sum()) == len(store)
+    results = prototypes.similarity_search_with_score_by_vector(queries[0], k=3)
+    assert len(results) == 3
+    assert all(doc.metadata["prototype"] and doc.metadata["members"] > 0 for doc, _ in results)
+    assert [distance for _, distance in results] == sorted(distance for _, distance in results)
+
+def test_prototype_table_round_trip(prototypes, tmp_path):
+    path = str(tmp_path / "prototypes.npz")
+    prototypes.save(path)
+    loaded = PrototypeIndex.load(path)
+    assert np.array_equal(loaded.prototypes, prototypes.prototypes)
+    assert loaded.labels.tolist() == prototypes.labels.tolist()
+
+def test_fallback_answers_from_prototypes_on_error(store, prototypes, queries):
+    primary = FailingIndex()
+    index = FallbackSearchIndex(primary, prototypes, cooldown=30.0)
+    results = index.similarity_search_with_score_by_vector(queries[0], k=5)
+    assert from_fallback(results)
+    # During the cooldown the failed primary is not tried again
+    index.similarity_search_with_score_by_vector(queries[1], k=5)
+    assert primary.calls == 1
+    assert not from_fallback(FallbackSearchIndex(store, prototypes).similarity_search_with_score_by_vector(queries[0]))
+
+def test_fallback_retries_primary_after_cooldown(prototypes, queries):
+    primary = FailingIndex()
+    index = FallbackSearchIndex(primary, prototypes, cooldown=0.0)
+    index.similarity_search_with_score_by_vector(queries[0])
+    index.similarity_search_with_score_by_vector(queries[0])
+    assert primary.calls == 2
+
+def test_fallback_on_timeout(prototypes, queries):
+    index = FallbackSearchIndex(FailingIndex(delay=0.5), prototypes, timeout=0.05)
+    started = time.perf_counter()
+    assert from_fallback(index.similarity_search_with_score_by_vector(queries[0]))
+    assert time.perf_counter() - started < 0.4
+
+def test_fallback_batched_search(prototypes, queries):
+    index = FallbackSearchIndex(FailingIndex(), prototypes)
+    batched = index.similarity_search_with_score_by_vectors(queries[:3], k=2)
+    assert len(batched) == 3
+    assert all(from_fallback(results) for results in batched)
+
+def test_routed_search_reports_exact_distances(store, prototypes, queries):
+    snapshot = store._snapshot
+    row_of = {document: i for i, document in enumerate(snapshot.documents)}
+    routed = [
+        LocalVectorIndex.from_arrays(snapshot.ids, snapshot.matrix, snapshot.documents, snapshot.metadatas,
+                                     approximate=True, n_lists=16, n_probe=4),
+        LocalVectorIndex.from_arrays(snapshot.ids, snapshot.matrix, snapshot.documents, snapshot.metadatas,
+                                     prototypes=prototypes, class_probe=2),
+    ]
+    for index in routed:
+        for query in queries[:3]:
+            results = index.similarity_search_with_score_by_vector(query, k=5)
+            distances = [distance for _, distance in results]
+            assert distances == sorted(distances)
+            for doc, distance in results:
+                expected = 1.0 - float(snapshot.matrix[row_of[doc.page_content]] @ query)
+                assert distance == pytest.approx(expected, abs=1e-5)
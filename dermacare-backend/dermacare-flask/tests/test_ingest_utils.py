@@ -0,0 +1,92 @@
+import json
+import os
+import pytest
+from benchmarks.stub_store import FakeImageEmbeddings
+from utils.ingest_utils import MANIFEST_NAME, IngestManifest, ingest_images
+
+class FakeCollection:
+    """The delete/add_embeddings surface of IRISVector that ingest_images writes through."""
+
+    def __init__(self, fail_on_add=None):
+        self.rows = {}
+        self.adds = 0
+        self.fail_on_add = fail_on_add
+
+    def delete(self, ids):
+        for row_id in ids:
+            self.rows.pop(row_id, None)
+
+    def add_embeddings(self, texts, embeddings, metadatas, ids):
+        self.adds += 1
+        if self.adds == self.fail_on_add:
+            raise ConnectionError("IRIS went away")
+        for text, metadata, row_id in zip(texts, metadatas, ids):
+            self.rows[row_id] = (text, metadata)
+
+def extract_diagnosis(filename):
+    return filename.split("_")[0]
+
+@pytest.fixture
+def dataset(tmp_path, image_bytes):
+    root = tmp_path / "images"
+    root.mkdir()
+    for i in range(5):
+        (root / f"Acne_{i}.png").write_bytes(image_bytes(seed=i))
+    return root
+
+def ingest(dataset, db, state_dir, **kwargs):
+    kwargs.setdefault("batch_size", 2)
+    return ingest_images(str(dataset), FakeImageEmbeddings(), db, extract_diagnosis,
+                         state_dir=str(state_dir), workers=1, **kwargs)
+
+def test_second_run_skips_unchanged_files(dataset, tmp_path):
+    db = FakeCollection()
+    first = ingest(dataset, db, tmp_path / "state")
+    assert first["added"] == 5 and not first["errors"]
+    assert len(db.rows) == 5
+    assert all(metadata["diagnosis"] == "Acne" for _, metadata in db.rows.values())
+
+    second = ingest(dataset, db, tmp_path / "state")
+    assert second["added"] == 0 and second["skipped"] == 5
+    assert db.adds == 3
+
+def test_interrupted_run_resumes_from_last_committed_batch(dataset, tmp_path):
+    state = tmp_path / "state"
+    db = FakeCollection(fail_on_add=2)
+    with pytest.raises(ConnectionError):
+        ingest(dataset, db, state)
+    assert len(IngestManifest(str(state)).entries) == 2
+
+    db.fail_on_add = None
+    resumed = ingest(dataset, db, state)
+    assert resumed["added"] == 3 and resumed["skipped"] == 2
+    assert len(db.rows) == 5
+    assert len(IngestManifest(str(state)).entries) == 5
+
+def test_changed_file_replaces_its_row(dataset, tmp_path, image_bytes):
+    db = FakeCollection()
+    state = tmp_path / "state"
+    ingest(dataset, db, state)
+    old_id = IngestManifest(str(state)).entries[str(dataset / "Acne_0.png")]["id"]
+
+    (dataset / "Acne_0.png").write_bytes(image_bytes(seed=99))
+    summary = ingest(dataset, db, state)
+    assert summary["updated"] == 1
+    assert old_id not in db.rows
+    assert len(db.rows) == 5
+
+def test_prune_deletes_rows_of_removed_files(dataset, tmp_path):
+    db = FakeCollection()
+    state = tmp_path / "state"
+    ingest(dataset, db, state)
+    removed_id = IngestManifest(str(state)).entries[str(dataset / "Acne_3.png")]["id"]
+
+    os.remove(dataset / "Acne_3.png")
+    assert ingest(dataset, db, state)["removed"] == 0  # without prune the row is kept
+    assert removed_id in db.rows
+
+    summary = ingest(dataset, db, state, prune=True)
+    assert summary["removed"] == 1
+    assert removed_id not in db.rows
+    with open(state / MANIFEST_NAME) as manifest_file:
+        assert str(dataset / "Acne_3.png") not in json.load(manifest_file)["entries"]
@@ -0,0 +1,92 @@
+import json
+import pytest
+from utils.knowledge_utils import KnowledgeStore, build_knowledge, diagnosis_key, knowledge_result
+
+def answer(name, risks, features=()):
+    return {"Diagnosis": name, "Risk factors": list(risks), "Clinical features": list(features)}
+
+def test_diagnosis_key_ignores_case_and_word_order():
+    assert diagnosis_key("Acne Cystic") == diagnosis_key("cystic acne") == "acne cystic"
+
+def test_learning_is_off_by_default():
+    store = KnowledgeStore()
+    store.learn([answer("Acne", ["Hormones"])], ["Acne"])
+    store.learn([answer("Acne", ["Hormones"])], ["Acne"])
+    assert len(store) == 0
+    assert store.get("Acne") is None
+
+def test_learned_facts_need_repeated_observations():
+    store = KnowledgeStore(min_observations=2, learning=True)
+    store.learn([answer("Acne", ["Hormones", "Patient works night shifts"])], ["Acne"])
+    assert store.get("Acne") is None
+    store.learn([answer("acne", ["Hormones"], ["Comedones"])], ["Acne"])
+    # Only the fact two answers agreed on is served
+    assert store.get("Acne") == {"Diagnosis": "Acne", "Risk factors": ["Hormones"], "Clinical features": []}
+
+def test_learn_keeps_only_shortlisted_diagnoses():
+    store = KnowledgeStore(learning=True)
+    store.learn([answer("Acne", ["Hormones"]), answer("Rosacea", ["Sun"])], ["Acne", "Eczema"])
+    assert store.get("Acne") is not None
+    assert store.get("Rosacea") is None
+
+def test_offline_entries_win_over_learned_ones():
+    store = KnowledgeStore(min_observations=1, learning=True)
+    store.learn([answer("Acne", ["Chocolate"])], ["Acne"])
+    store.put(answer("Acne", ["Hormones"]), source="offline")
+    store.learn([answer("Acne", ["Chocolate"])], ["Acne"])
+    assert store.get("Acne")["Risk factors"] == ["Hormones"]
+
+def test_saves_merge_observations_from_several_processes(tmp_path):
+    path = str(tmp_path / "knowledge.json")
+    workers = [KnowledgeStore(path, min_observations=2, save_interval=3600, learning=True) for _ in range(2)]
+    for worker in workers:
+        worker.learn([answer("Acne", ["Hormones"])], ["Acne"])
+        worker.save()
+    with open(path) as knowledge_file:
+        entry = json.load(knowledge_file)["entries"]["acne"]
+    assert entry["observations"] == 2
+    assert entry["Risk factors"] == {"Hormones": 2}
+    # Neither worker saw enough on its own, but each now serves the merged entry
+    assert workers[1].get("Acne")["Risk factors"] == ["Hormones"]
+    assert KnowledgeStore(path, min_observations=2, learning=True).get("Acne") is not None
+
+def test_build_knowledge_and_knowledge_result(tmp_path):
+    store = KnowledgeStore(str(tmp_path / "knowledge.json"))
+
+    def query(prompt):
+        if "Eczema" in prompt:
+            raise TimeoutError()
+        return {"diagnoses": [answer("Psoriasis", ["Stress"], ["Scales"])]}
+
+    assert build_knowledge(["Psoriasis", "Eczema"], query, store) == ["Eczema"]
+    shortlist = [{"diagnosis": "Psoriasis"}, {"diagnosis": "Eczema"}]
+    result = knowledge_result(shortlist, store)
+    assert [d["Diagnosis"] for d in result["diagnoses"]] == ["Psoriasis"]
+    assert result["source"] == "knowledge"
+    assert knowledge_result(list(reversed(shortlist)), store) is None
+
+def test_failed_background_save_keeps_observations(tmp_path):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_text("")
+    store = KnowledgeStore(str(blocker / "knowledge.json"), save_interval=0, learning=True)
+    # The save after learning fails, but the answer's observations are not lost
+    store.learn([answer("Acne", ["Hormones"]), answer("Eczema", ["Dry skin"])], ["Acne", "Eczema"])
+    assert store.get("Acne") is not None
+    blocker.unlink()
+    store.save()
+    assert KnowledgeStore(str(blocker / "knowledge.json"), learning=True).get("Eczema") is not None
+
+def test_explicit_save_raises(tmp_path):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_text("")
+    store = KnowledgeStore(str(blocker / "knowledge.json"))
+    store.put(answer("Acne", ["Hormones"]), source="offline")
+    with pytest.raises(OSError):
+        store.save()
+
+def test_learn_saves_once_per_answer(tmp_path, monkeypatch):
+    store = KnowledgeStore(str(tmp_path / "knowledge.json"), save_interval=0, learning=True)
+    saves = []
+    monkeypatch.setattr(store, "save", lambda: saves.append(1))
+    store.learn([answer("Acne", ["Hormones"]), answer("Eczema", ["Dry skin"])], ["Acne", "Eczema"])
+    assert saves == [1]
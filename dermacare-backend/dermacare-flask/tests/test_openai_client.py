@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+import pytest
+from openai import RateLimitError
+from benchmarks.fake_openai import start_fake_openai
+from utils.gpt_utils import AsyncOpenAIClient, OpenAIClient
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+@pytest.fixture
+def fake_openai():
+    """Factory for a fake OpenAI server; returns (settings, base_url)."""
+    servers = []
+
+    def start(**settings):
+        server, base_url = start_fake_openai(port=0, **dict({"latency_ms": 0}, **settings))
+        servers.append(server)
+        return server.settings, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def complete(client):
+    return client.chat_completion(model="gpt-4o", messages=MESSAGES, max_tokens=10)
+
+def test_retries_429_then_succeeds(fake_openai):
+    settings, base_url = fake_openai(fail_first=2, retry_after="0")
+    client = OpenAIClient(api_key="test", base_url=base_url, max_retries=3)
+    response = complete(client)
+    assert response.choices[0].message.content
+    assert settings.requests == 3
+
+def test_stops_after_max_retries(fake_openai):
+    settings, base_url = fake_openai(fail_first=100, retry_after="0")
+    client = OpenAIClient(api_key="test", base_url=base_url, max_retries=2)
+    with pytest.raises(RateLimitError):
+        complete(client)
+    assert settings.requests == 3  # the first attempt plus two retries
+
+def test_honours_retry_after(fake_openai):
+    settings, base_url = fake_openai(fail_first=1, retry_after="0.3")
+    # Without the header the jittered backoff would wait at most a millisecond
+    client = OpenAIClient(api_key="test", base_url=base_url, backoff_base=0.001)
+    started = time.perf_counter()
+    complete(client)
+    assert time.perf_counter() - started >= 0.3
+    assert settings.requests == 2
+
+def test_retry_after_capped_at_backoff_max(fake_openai):
+    settings, base_url = fake_openai(fail_first=1, retry_after="30")
+    client = OpenAIClient(api_key="test", base_url=base_url, backoff_max=0.1)
+    started = time.perf_counter()
+    complete(client)
+    assert time.perf_counter() - started < 5
+    assert settings.requests == 2
+
+def test_semaphore_caps_concurrency(fake_openai):
+    settings, base_url = fake_openai(latency_ms=100)
+    client = OpenAIClient(api_key="test", base_url=base_url, max_concurrency=2)
+    threads = [threading.Thread(target=complete, args=(client,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert settings.requests == 8
+    assert settings.max_in_flight == 2
+
+def test_async_client_retries_and_caps_concurrency(fake_openai):
+    settings, base_url = fake_openai(latency_ms=100, fail_first=1, retry_after="0")
+
+    async def run():
+        client = AsyncOpenAIClient(api_key="test", base_url=base_url, max_concurrency=2)
+        try:
+            return await asyncio.gather(*(complete(client) for _ in range(6)))
+        finally:
+            await client.close()
+
+    assert len(asyncio.run(run())) == 6
+    assert settings.requests == 7
+    assert settings.max_in_flight == 2
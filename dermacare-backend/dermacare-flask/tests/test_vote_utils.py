@@ -0,0 +1,47 @@
+import pytest
+from langchain_core.documents import Document
+from utils.vote_utils import dominant_diagnosis, prediction_payload, rank_diagnoses
+
+def neighbours(*pairs):
+    """(diagnosis, cosine distance) pairs as scored search results."""
+    return [(Document(page_content="", metadata={"diagnosis": name}), distance) for name, distance in pairs]
+
+def test_rank_orders_by_share_of_vote():
+    ranked = rank_diagnoses(neighbours(("Acne", 0.10), ("Eczema", 0.20), ("Acne", 0.12), ("Psoriasis", 0.40)))
+    assert [entry["diagnosis"] for entry in ranked] == ["Acne", "Eczema", "Psoriasis"]
+    assert sum(entry["score"] for entry in ranked) == pytest.approx(1.0, abs=1e-3)
+    assert [entry["votes"] for entry in ranked] == [2, 1, 1]
+    assert ranked[0]["similarity"] == pytest.approx(0.90)
+
+def test_close_neighbours_outvote_a_weak_tail():
+    results = neighbours(("Melanoma", 0.05), *[("Acne", 0.35)] * 10)
+    ranked = rank_diagnoses(results, temperature=0.05)
+    assert ranked[0]["diagnosis"] == "Melanoma"
+    assert ranked[1]["votes"] == 10
+    # A high temperature flattens the weights towards a plain count
+    assert rank_diagnoses(results, temperature=10)[0]["diagnosis"] == "Acne"
+
+def test_rank_limit_and_empty_input():
+    ranked = rank_diagnoses(neighbours(("A", 0.1), ("B", 0.2), ("C", 0.3)), limit=2)
+    assert [entry["diagnosis"] for entry in ranked] == ["A", "B"]
+    assert rank_diagnoses([]) == []
+
+def test_missing_diagnosis_votes_as_unknown():
+    results = [(Document(page_content="", metadata={}), 0.1)]
+    assert rank_diagnoses(results)[0]["diagnosis"] == "Unknown"
+
+def test_dominant_diagnosis_thresholds():
+    shortlist = [{"diagnosis": "Acne", "score": 0.8, "votes": 6, "similarity": 0.9}]
+    assert dominant_diagnosis(shortlist, None) is None  # disabled
+    assert dominant_diagnosis(shortlist, 0.75, min_votes=5) is shortlist[0]
+    assert dominant_diagnosis(shortlist, 0.85, min_votes=5) is None
+    assert dominant_diagnosis(shortlist, 0.75, min_votes=7) is None
+    assert dominant_diagnosis([], 0.5) is None
+
+def test_prediction_payload_adds_the_shortlist():
+    shortlist = [{"diagnosis": "Acne", "score": 0.7, "votes": 3, "similarity": 0.9}]
+    payload = prediction_payload({"response": "[]", "diagnoses": []}, shortlist, early_exit=True)
+    assert payload["similar_diagnoses"] == ["Acne"]
+    assert payload["confidence"] == 0.7
+    assert payload["early_exit"] is True
+    assert prediction_payload(None, [])["confidence"] is None
@@ -1,10 +1,17 @@
 
-from .db_utils import init_db, query_db_with_image_and_text, combine_text
+from .db_utils import init_db, embed_images, query_db_with_image_and_text, retrieve_neighbours, combine_text
 from .gpt_utils import query_openai_with_image_and_text
+from .image_utils import decode_image, normalize_image
+from .vote_utils import rank_diagnoses
 
 __all__ = [
     'init_db',
+    'embed_images',
     'query_db_with_image_and_text',
+    'retrieve_neighbours',
     'combine_text',
-    'query_openai_with_image_and_text'
+    'query_openai_with_image_and_text',
+    'decode_image',
+    'normalize_image',
+    'rank_diagnoses'
 ]
\ No newline at end of file
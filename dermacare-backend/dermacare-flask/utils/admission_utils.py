@@ -0,0 +1,260 @@
+import asyncio
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from .metrics_utils import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+# Highest priority first; queued interactive work is always admitted before batch work
+PRIORITIES = ("interactive", "batch")
+
+def admission_params(headers, remote_addr, default_priority):
+    """
+    (priority, client, timeout) for a request. X-Priority may only lower the endpoint's
+    default priority (an interactive endpoint can be called as batch, never the reverse), so
+    a caller cannot claim reserved interactive slots or evict interactive work. The per-client
+    limit is keyed on the remote address rather than a caller-chosen header, and X-Deadline-Ms
+    is how long the caller is willing to wait in the queue.
+    """
+    priority = (headers.get("X-Priority") or default_priority).lower()
+    if priority not in PRIORITIES or PRIORITIES.index(priority) < PRIORITIES.index(default_priority):
+        priority = default_priority
+    try:
+        timeout = float(headers["X-Deadline-Ms"]) / 1000
+    except (KeyError, ValueError):
+        timeout = None
+    return priority, remote_addr, timeout
+
+class AdmissionRejected(Exception):
+    """A request shed by the admission layer; status is 503 (overload, deadline) or 429 (client limit)."""
+
+    def __init__(self, message, reason, status=503, retry_after=1):
+        super().__init__(message)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+class _Waiter:
+    def __init__(self, priority, client, deadline, wake):
+        self.priority = priority
+        self.client = client
+        self.deadline = deadline
+        self.wake = wake
+        self.state = "queued"  # then granted, expired or evicted
+
+class AdmissionController:
+    """
+    Bounded admission in front of the predict pipeline.
+
+    At most max_concurrent requests run at once, with reserved_interactive of those slots
+    kept free of batch work. The rest wait in one FIFO queue per priority class (at most
+    max_queue in total) and are admitted interactive first as slots free up. Each waiter has
+    a deadline (per class, optionally shortened by the caller); work still queued at its
+    deadline is dropped rather than run late. When the queue is full an interactive arrival
+    evicts the newest batch waiter, otherwise the arrival is shed. A client may hold at most
+    per_client running or queued requests.
+
+    Threads use acquire/release (or admit); asyncio handlers use acquire_async.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=24, per_client=0, reserved_interactive=0,
+                 deadlines=None, retry_after=1):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.reserved_interactive = min(reserved_interactive, max_concurrent - 1)
+        self.deadlines = dict({"interactive": 10.0, "batch": 120.0}, **(deadlines or {}))
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._active = {priority: 0 for priority in PRIORITIES}
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._clients = Counter()
+
+    def _has_slot(self, priority):
+        limit = self.max_concurrent
+        if priority != "interactive":
+            limit -= self.reserved_interactive
+        return sum(self._active.values()) < limit
+
+    def _queued_ahead(self, priority):
+        return any(self._queues[other] for other in PRIORITIES[:PRIORITIES.index(priority) + 1])
+
+    def _update_gauges(self):
+        for priority in PRIORITIES:
+            ADMISSION_IN_FLIGHT.set(self._active[priority], priority=priority)
+            ADMISSION_QUEUE_DEPTH.set(len(self._queues[priority]), priority=priority)
+
+    def _forget(self, client):
+        self._clients[client] -= 1
+        if self._clients[client] <= 0:
+            del self._clients[client]
+
+    def _shed(self, priority, reason, message, status=503):
+        ADMISSION_REJECTED.inc(priority=priority, reason=reason)
+        raise AdmissionRejected(message, reason, status, self.retry_after)
+
+    def _enter(self, priority, client, timeout, wake):
+        """Under the lock: admit now (returns None, []) or queue (returns the waiter and any evicted waiters)."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        if self.per_client and self._clients[client] >= self.per_client:
+            self._shed(priority, "client_limit", "Too many requests from this client, retry later", status=429)
+        if self._has_slot(priority) and not self._queued_ahead(priority):
+            self._active[priority] += 1
+            self._clients[client] += 1
+            self._update_gauges()
+            return None, []
+
+        evicted = []
+        if sum(len(queue) for queue in self._queues.values()) >= self.max_queue:
+            lower = [other for other in PRIORITIES[PRIORITIES.index(priority) + 1:] if self._queues[other]]
+            if not lower:
+                self._shed(priority, "queue_full", "Server is overloaded, retry later")
+            victim = self._queues[lower[-1]].pop()
+            victim.state = "evicted"
+            self._forget(victim.client)
+            ADMISSION_REJECTED.inc(priority=victim.priority, reason="evicted")
+            evicted.append(victim)
+
+        deadline = self.deadlines[priority] if timeout is None else min(timeout, self.deadlines[priority])
+        waiter = _Waiter(priority, client, time.monotonic() + deadline, wake)
+        self._queues[priority].append(waiter)
+        self._clients[client] += 1
+        self._update_gauges()
+        return waiter, evicted
+
+    def _dispatch(self):
+        """Under the lock: expire overdue waiters and grant free slots; returns the waiters to wake."""
+        woken = []
+        now = time.monotonic()
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            expired = [waiter for waiter in queue if waiter.deadline <= now]
+            for waiter in expired:
+                queue.remove(waiter)
+                waiter.state = "expired"
+                self._forget(waiter.client)
+                ADMISSION_REJECTED.inc(priority=priority, reason="deadline")
+            woken.extend(expired)
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and self._has_slot(priority):
+                waiter = queue.popleft()
+                waiter.state = "granted"
+                self._active[priority] += 1
+                woken.append(waiter)
+        self._update_gauges()
+        return woken
+
+    def _settle(self, waiter):
+        """After a wait ends: return if the slot was granted, otherwise leave the queue and raise."""
+        with self._lock:
+            if waiter.state == "queued":
+                self._queues[waiter.priority].remove(waiter)
+                waiter.state = "expired"
+                self._forget(waiter.client)
+                ADMISSION_REJECTED.inc(priority=waiter.priority, reason="deadline")
+                self._update_gauges()
+        if waiter.state == "granted":
+            return
+        if waiter.state == "evicted":
+            raise AdmissionRejected("Shed in favour of interactive requests, retry later", "evicted", 503, self.retry_after)
+        raise AdmissionRejected("Request waited too long for admission", "deadline", 503, self.retry_after)
+
+    def _abandon(self, waiter):
+        # The caller gave up (e.g. disconnected) while queued: leave the queue or give the slot back
+        with self._lock:
+            state = waiter.state
+            if state == "queued":
+                self._queues[waiter.priority].remove(waiter)
+                waiter.state = "expired"
+                self._forget(waiter.client)
+                self._update_gauges()
+        if state == "granted":
+            self.release(waiter.priority, waiter.client)
+
+    @staticmethod
+    def _wake_all(waiters):
+        for waiter in waiters:
+            waiter.wake()
+
+    def acquire(self, priority="interactive", client=None, timeout=None):
+        """Block until admitted; raises AdmissionRejected when shed. Pair with release."""
+        started = time.monotonic()
+        event = threading.Event()
+        with self._lock:
+            waiter, evicted = self._enter(priority, client, timeout, event.set)
+        self._wake_all(evicted)
+        if waiter is not None:
+            event.wait(max(0.0, waiter.deadline - time.monotonic()))
+            self._settle(waiter)
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, priority=priority)
+
+    async def acquire_async(self, priority="interactive", client=None, timeout=None):
+        """acquire for asyncio handlers: waits on the event loop instead of blocking a thread."""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        with self._lock:
+            waiter, evicted = self._enter(priority, client, timeout, wake)
+        self._wake_all(evicted)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), max(0.0, waiter.deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+            self._settle(waiter)
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, priority=priority)
+
+    def release(self, priority="interactive", client=None):
+        with self._lock:
+            self._active[priority] -= 1
+            self._forget(client)
+            woken = self._dispatch()
+        self._wake_all(woken)
+
+    @contextmanager
+    def admit(self, priority="interactive", client=None, timeout=None):
+        self.acquire(priority, client, timeout)
+        try:
+            yield
+        finally:
+            self.release(priority, client)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": dict(self._active),
+                "queued": {priority: len(queue) for priority, queue in self._queues.items()},
+                "clients": len(self._clients)
+            }
+
+def create_admission_controller():
+    """
+    AdmissionController from ADMISSION_MAX_CONCURRENT (0 disables admission control and
+    returns None), ADMISSION_MAX_QUEUE, ADMISSION_PER_CLIENT, ADMISSION_RESERVED_INTERACTIVE,
+    ADMISSION_INTERACTIVE_DEADLINE_SECONDS, ADMISSION_BATCH_DEADLINE_SECONDS and
+    ADMISSION_RETRY_AFTER_SECONDS.
+    """
+    max_concurrent = int(os.getenv('ADMISSION_MAX_CONCURRENT', '8'))
+    if max_concurrent <= 0:
+        return None
+    return AdmissionController(
+        max_concurrent=max_concurrent,
+        max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '24')),
+        per_client=int(os.getenv('ADMISSION_PER_CLIENT', '0')),
+        reserved_interactive=int(os.getenv('ADMISSION_RESERVED_INTERACTIVE', '2')),
+        deadlines={
+            "interactive": float(os.getenv('ADMISSION_INTERACTIVE_DEADLINE_SECONDS', '10')),
+            "batch": float(os.getenv('ADMISSION_BATCH_DEADLINE_SECONDS', '120'))
+        },
+        retry_after=int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '1'))
+    )
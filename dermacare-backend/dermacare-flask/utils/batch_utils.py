@@ -0,0 +1,111 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from .db_utils import encode_pixel_batch
+from .image_utils import open_image
+from .metrics_utils import Histogram
+
+_STOP = object()
+
+class EmbeddingBatcher:
+    """
+    Micro-batching wrapper around an OpenCLIPEmbeddings instance.
+    Concurrent handlers submit images; a background worker collects them for up to
+    max_wait_ms or max_batch_size items and runs a single batched forward pass.
+    Preprocessing happens in the calling thread so only the model call is serialized.
+    Attributes not defined here (embed_query, model, preprocess, ...) are delegated
+    to the wrapped embedder.
+    """
+
+    def __init__(self, multimodal_ef, max_batch_size=16, max_wait_ms=5):
+        self.multimodal_ef = multimodal_ef
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_size_histogram = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.wait_time_histogram = Histogram([0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25])
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def __getattr__(self, name):
+        if name == 'multimodal_ef':
+            raise AttributeError(name)
+        return getattr(self.multimodal_ef, name)
+
+    def submit(self, image_source):
+        """Queue one image for embedding and return a Future for its vector."""
+        future = Future()
+        pixels = self.multimodal_ef.preprocess(open_image(image_source))
+        self._queue.put((pixels, future, time.monotonic()))
+        return future
+
+    def embed_images(self, image_sources):
+        futures = [self.submit(source) for source in image_sources]
+        return [future.result() for future in futures]
+
+    def embed_image(self, uris):
+        """Drop-in replacement for OpenCLIPEmbeddings.embed_image."""
+        return self.embed_images(uris)
+
+    def stats(self):
+        return {
+            "batch_size": self.batch_size_histogram.snapshot(),
+            "wait_seconds": self.wait_time_histogram.snapshot(),
+            "queued": self._queue.qsize()
+        }
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+
+            batch = self._collect(first)
+            started = time.monotonic()
+            self.batch_size_histogram.observe(len(batch))
+            for _, _, enqueued in batch:
+                self.wait_time_histogram.observe(started - enqueued)
+
+            try:
+                embeddings = encode_pixel_batch(self.multimodal_ef, [pixels for pixels, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+def create_embedding_batcher(multimodal_ef):
+    """
+    Wrap the embedder in an EmbeddingBatcher configured by EMBED_BATCH_SIZE and
+    EMBED_BATCH_WAIT_MS. A batch size of 1 disables batching and returns the embedder unchanged.
+    """
+    max_batch_size = int(os.getenv('EMBED_BATCH_SIZE', '16'))
+    max_wait_ms = float(os.getenv('EMBED_BATCH_WAIT_MS', '5'))
+    if max_batch_size <= 1:
+        return multimodal_ef
+    return EmbeddingBatcher(multimodal_ef, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from .image_utils import read_image_bytes
+from .metrics_utils import CACHE_LOOKUPS
+
+def hash_image_bytes(image_source):
+    """Content hash of the encoded image bytes, used as the cache key for an upload."""
+    return hashlib.sha256(read_image_bytes(image_source)).hexdigest()
+
+def normalize_history(patient_hist):
+    """
+    Normalize patient history so cosmetic edits (key order, whitespace) share a cache entry.
+    JSON histories are re-serialized with sorted keys; plain text is whitespace-collapsed.
+    """
+    try:
+        return json.dumps(json.loads(patient_hist), sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return ' '.join(str(patient_hist).split())
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with optional TTL."""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskCache:
+    """SQLite-backed cache that survives restarts, with the same get/put interface as LRUCache."""
+
+    def __init__(self, path, max_entries=10000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            with self._conn:
+                if self.ttl is not None and now - created > self.ttl:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    return None
+                self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return pickle.loads(value)
+
+    def put(self, key, value):
+        now = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, blob, now, now)
+            )
+            # Evict least recently accessed rows beyond the size limit
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                "SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+class PredictionCache:
+    """
+    Two-level content-addressed cache for /predict.
+    Level 1 maps an image hash to its CLIP embedding and nearest neighbours.
+    Level 2 maps (image hash, normalized history, model, temperature) to the final response.
+    """
+
+    def __init__(self, neighbour_store, response_store):
+        self.neighbour_store = neighbour_store
+        self.response_store = response_store
+        self._counts = {"neighbours_hits": 0, "neighbours_misses": 0, "responses_hits": 0, "responses_misses": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, level, hit):
+        with self._lock:
+            self._counts[f"{level}_{'hits' if hit else 'misses'}"] += 1
+        CACHE_LOOKUPS.inc(level=level, result="hit" if hit else "miss")
+
+    @staticmethod
+    def response_key(image_hash, patient_hist, model, temperature):
+        raw = json.dumps([image_hash, normalize_history(patient_hist), model, float(temperature)])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get_neighbours(self, image_hash):
+        """Return the cached {"embedding", "results", "k"} entry for an image, or None."""
+        entry = self.neighbour_store.get(image_hash)
+        self._count("neighbours", entry is not None)
+        return entry
+
+    def put_neighbours(self, image_hash, embedding, results, k=None):
+        self.neighbour_store.put(image_hash, {"embedding": embedding, "results": results, "k": k})
+
+    def get_response(self, image_hash, patient_hist, model, temperature):
+        response = self.response_store.get(self.response_key(image_hash, patient_hist, model, temperature))
+        self._count("responses", response is not None)
+        return response
+
+    def put_response(self, image_hash, patient_hist, model, temperature, response):
+        self.response_store.put(self.response_key(image_hash, patient_hist, model, temperature), response)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats["neighbours_entries"] = len(self.neighbour_store)
+        stats["responses_entries"] = len(self.response_store)
+        return stats
+
+def create_prediction_cache():
+    """
+    Build the prediction cache from environment settings:
+    CACHE_BACKEND ("memory" or "disk"), CACHE_DIR, CACHE_MAX_ENTRIES and CACHE_TTL_SECONDS.
+    """
+    backend = os.getenv('CACHE_BACKEND', 'memory').lower()
+    max_entries = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+    ttl = os.getenv('CACHE_TTL_SECONDS')
+    ttl = float(ttl) if ttl else None
+
+    if backend == 'disk':
+        cache_dir = os.getenv('CACHE_DIR', '.cache')
+        return PredictionCache(
+            DiskCache(os.path.join(cache_dir, 'neighbours.sqlite'), max_entries, ttl),
+            DiskCache(os.path.join(cache_dir, 'responses.sqlite'), max_entries, ttl)
+        )
+    if backend != 'memory':
+        raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
+    return PredictionCache(LRUCache(max_entries, ttl), LRUCache(max_entries, ttl))
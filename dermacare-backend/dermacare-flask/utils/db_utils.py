@@ -1,83 +1,183 @@
+import logging
 import os
-from langchain_experimental.open_clip import OpenCLIPEmbeddings
-from langchain_iris import IRISVector
-import traceback
+from .image_utils import open_image
+from .cache_utils import hash_image_bytes
+from .metrics_utils import timed
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_NAME = "dermnet_multimodal"
+
+def get_connection_string():
+    # IRIS DB connection params
+    username = 'demo'
+    password = 'demo'
+    hostname = os.getenv('IRIS_HOSTNAME', 'localhost')
+    port = '1972'
+    namespace = 'USER'
+    return f"iris://{username}:{password}@{hostname}:{port}/{namespace}"
+
+def load_embedding_function():
+    """Load the CLIP embedding function (the slow part of startup), using the EMBED_BACKEND image encoder"""
+    from .model_utils import load_embedding_backend
+
+    logger.info("Initializing OpenCLIP embedding function...")
+    try:
+        multimodal_ef = load_embedding_backend()
+        logger.info("OpenCLIP embedding function initialized successfully")
+        return multimodal_ef
+    except Exception:
+        logger.exception("Failed to initialize OpenCLIP")
+        raise
+
+def connect_db(multimodal_ef):
+    """Connect to the IRIS collection without re-embedding anything"""
+    from langchain_iris import IRISVector
+
+    logger.info("Connecting to IRIS database, collection %s", COLLECTION_NAME)
+    try:
+        # Passing the dimension skips the probe text embedding IRISVector would otherwise run
+        visual = getattr(getattr(multimodal_ef, 'model', None), 'visual', None)
+        db = IRISVector(
+            embedding_function=multimodal_ef,
+            dimension=getattr(multimodal_ef, 'output_dim', None) or getattr(visual, 'output_dim', None),
+            collection_name=COLLECTION_NAME,
+            connection_string=get_connection_string(),
+        )
+        logger.info("Successfully connected to IRIS database")
+        return db
+    except Exception:
+        logger.exception("Failed to connect to IRIS database")
+        raise
 
 def init_db():
     """Initialize database connection"""
-    print("\nStarting database initialization...")
+    logger.info("Starting database initialization...")
     try:
-        # IRIS DB connection params
-        username = 'demo'
-        password = 'demo'
-        hostname = os.getenv('IRIS_HOSTNAME', 'localhost')
-        port = '1972'
-        namespace = 'USER'
-        CONNECTION_STRING = f"iris://{username}:{password}@{hostname}:{port}/{namespace}"
-        COLLECTION_NAME = "dermnet_multimodal"
-
-        print(f"Database connection string: {CONNECTION_STRING}")
-        print(f"Collection name: {COLLECTION_NAME}")
-
-        # Initialize the embedding function
-        print("\nInitializing OpenCLIP embedding function...")
-        try:
-            multimodal_ef = OpenCLIPEmbeddings(
-                model_name="ViT-B-32",  # Using smaller model as discussed
-                checkpoint="laion2b_s34b_b79k"
-            )
-            print("OpenCLIP embedding function initialized successfully!")
-        except Exception as e:
-            print(f"Failed to initialize OpenCLIP: {str(e)}")
-            print("Traceback:")
-            print(traceback.format_exc())
-            raise
-
-        # Connect to DB
-        print("\nConnecting to IRIS database...")
-        try:
-            db = IRISVector.from_documents(
-                embedding=multimodal_ef,
-                documents=[],  # Passing empty list so it doesn't re-embed
-                collection_name=COLLECTION_NAME,
-                connection_string=CONNECTION_STRING,
-            )
-            print("Successfully connected to IRIS database!")
-        except Exception as e:
-            print(f"Failed to connect to IRIS database: {str(e)}")
-            print("Traceback:")
-            print(traceback.format_exc())
-            raise
-
+        multimodal_ef = load_embedding_function()
+        db = connect_db(multimodal_ef)
         return multimodal_ef, db
 
-    except Exception as e:
-        print(f"\nError in init_db: {str(e)}")
-        print("Full traceback:")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("Error in init_db")
         raise
 
-def query_db_with_image_and_text(image_path, multimodal_ef, db):
-    """Query the database with image and text"""
-    print(f"\nQuerying database with image: {image_path}")
-    try:
-        query_embedding = multimodal_ef.embed_image([image_path])[0]
-        print("Image embedded successfully")
+def encode_pixel_batch(multimodal_ef, pixel_tensors):
+    """Run one forward pass of the CLIP image tower over preprocessed pixel tensors."""
+    # Exported backends (CompiledImageEmbeddings) run their own forward pass
+    own_encode = getattr(type(multimodal_ef), 'encode_pixel_batch', None)
+    if own_encode is not None:
+        return own_encode(multimodal_ef, pixel_tensors)
+
+    import torch
+
+    with torch.no_grad():
+        embeddings_tensor = multimodal_ef.model.encode_image(torch.stack(pixel_tensors))
+
+    norm = embeddings_tensor.norm(p=2, dim=-1, keepdim=True)
+    return embeddings_tensor.div(norm).tolist()
 
-        results = db.similarity_search_by_vector(query_embedding, k=3)
-        print(f"Found {len(results)} similar results")
+def embed_images(multimodal_ef, image_sources):
+    """
+    Embed a list of images in a single batched forward pass.
+    Accepts anything open_image understands, so callers can pass decoded images
+    instead of paths and nothing is re-read from disk. Embedders that provide their
+    own embed_images (such as EmbeddingBatcher) are delegated to.
+    """
+    batch_embed = getattr(multimodal_ef, 'embed_images', None)
+    if batch_embed is not None:
+        return batch_embed(image_sources)
 
-        print("\nTop similar results:")
+    pixel_tensors = [multimodal_ef.preprocess(open_image(source)) for source in image_sources]
+    return encode_pixel_batch(multimodal_ef, pixel_tensors)
+
+def search_db_by_embedding(query_embedding, db, k=3):
+    """Nearest-neighbour search for an already computed embedding"""
+    results = db.similarity_search_by_vector(query_embedding, k=k)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Found %d similar results", len(results))
         for result in results:
-            diagnosis = result.metadata.get("diagnosis", "N/A")
-            path = result.metadata.get("path", "N/A")
-            print(f"Diagnosis: {diagnosis} | Path: {path}")
-
-        return results
-    except Exception as e:
-        print(f"Error in query_db_with_image_and_text: {str(e)}")
-        print("Traceback:")
-        print(traceback.format_exc())
+            logger.debug("Diagnosis: %s | Path: %s",
+                         result.metadata.get("diagnosis", "N/A"), result.metadata.get("path", "N/A"))
+
+    return results
+
+def search_db_by_embeddings(query_embeddings, db, k=3):
+    """
+    Nearest-neighbour search for several embeddings. Indexes that support it
+    (LocalVectorIndex) answer all queries together; IRIS is queried once per embedding.
+    """
+    batch_search = getattr(db, 'similarity_search_by_vectors', None)
+    if batch_search is not None:
+        return batch_search(query_embeddings, k=k)
+    return [db.similarity_search_by_vector(embedding, k=k) for embedding in query_embeddings]
+
+def search_db_with_scores(query_embedding, db, k=3):
+    """Nearest neighbours as (Document, cosine distance) pairs, closest first"""
+    results = db.similarity_search_with_score_by_vector(query_embedding, k=k)
+    logger.debug("Found %d similar results", len(results))
+    return results
+
+def search_db_by_embeddings_with_scores(query_embeddings, db, k=3):
+    """search_db_with_scores for several embeddings, batched where the index supports it"""
+    batch_search = getattr(db, 'similarity_search_with_score_by_vectors', None)
+    if batch_search is not None:
+        return batch_search(query_embeddings, k=k)
+    return [db.similarity_search_with_score_by_vector(embedding, k=k) for embedding in query_embeddings]
+
+def from_fallback(scored_results):
+    """
+    True when the neighbours came from the prototype fallback (FallbackSearchIndex answering
+    during an outage) rather than the real index. Such results must not be cached.
+    """
+    return any(doc.metadata.get("prototype") for doc, _ in scored_results)
+
+def retrieve_neighbours(image_source, multimodal_ef, db, k=3, cache=None, image_hash=None, timer=None):
+    """
+    Embed an image and return its k nearest neighbours as (Document, cosine distance) pairs.
+    With a PredictionCache, neighbours cached for the same k are reused; an entry cached
+    for a different k still saves the embedding, so only the search is repeated.
+    Fallback (prototype) neighbours are returned but never cached. A StageTimer records
+    the "embed" and "search" stages.
+    """
+    query_embedding = None
+    if cache is not None:
+        image_hash = image_hash or hash_image_bytes(image_source)
+        cached = cache.get_neighbours(image_hash)
+        if cached is not None:
+            if cached.get("k") == k:
+                logger.debug("Using cached embedding and neighbours")
+                return cached["results"]
+            query_embedding = cached["embedding"]
+
+    if query_embedding is None:
+        with timed(timer, "embed"):
+            query_embedding = embed_images(multimodal_ef, [image_source])[0]
+
+    with timed(timer, "search"):
+        results = search_db_with_scores(query_embedding, db, k=k)
+
+    if cache is not None and results and not from_fallback(results):
+        cache.put_neighbours(image_hash, query_embedding, results, k=k)
+
+    return results
+
+def query_db_with_image_and_text(image_source, multimodal_ef, db, cache=None, image_hash=None, timer=None, k=3):
+    """
+    Query the database with image and text.
+    Returns the k nearest Documents; see retrieve_neighbours for caching and timing.
+    """
+    try:
+        scored_results = retrieve_neighbours(
+            image_source, multimodal_ef, db, k=k, cache=cache, image_hash=image_hash, timer=timer
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            for doc, distance in scored_results:
+                logger.debug("Diagnosis: %s | Path: %s | Distance: %.4f",
+                             doc.metadata.get("diagnosis", "N/A"), doc.metadata.get("path", "N/A"), distance)
+        return [doc for doc, _ in scored_results]
+    except Exception:
+        logger.exception("Error in query_db_with_image_and_text")
         raise
 
 def combine_text(results, patient_hist):
@@ -86,10 +186,15 @@ def combine_text(results, patient_hist):
         diagnoses = [result.metadata.get("diagnosis", "N/A") for result in results]
         top_diagnoses_str = "Top Diagnosis: " + ", ".join(diagnoses)
         combined_output = f"{top_diagnoses_str}, Patient history: {patient_hist}"
-        print(f"\nCombined text output: {combined_output}")
+        logger.debug("Combined text output: %s", combined_output)
         return combined_output
-    except Exception as e:
-        print(f"Error in combine_text: {str(e)}")
-        print("Traceback:")
-        print(traceback.format_exc())
-        raise
\ No newline at end of file
+    except Exception:
+        logger.exception("Error in combine_text")
+        raise
+
+def combine_shortlist_text(shortlist, patient_hist):
+    """Combine a rank_diagnoses shortlist, with each diagnosis's vote share, and patient history"""
+    diagnoses = ", ".join(f"{entry['diagnosis']} (confidence {entry['score']:.2f})" for entry in shortlist)
+    combined_output = f"Top Diagnosis: {diagnoses}, Patient history: {patient_hist}"
+    logger.debug("Combined text output: %s", combined_output)
+    return combined_output
@@ -0,0 +1,100 @@
+import numpy as np
+from PIL import Image
+
+# Written by setup.py next to the ingestion manifest
+DEDUP_REPORT_NAME = "dedup_report.json"
+
+HASH_SIZE = 8
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def is_hidden(name):
+    """Hidden files and directories (.ipynb_checkpoints, .DS_Store, ...) are never indexed."""
+    return name.startswith(".")
+
+def dhash(image):
+    """
+    64-bit difference hash of a PIL image, as 16 hex digits: one bit per horizontally
+    adjacent pixel pair of a 9x8 grayscale thumbnail. Resized and re-encoded copies of an
+    image land within a few bits of each other.
+    """
+    # JPEG decoders can downscale while decoding, so the thumbnail never needs the full image
+    image.draft("L", ((HASH_SIZE + 1) * 4, HASH_SIZE * 4))
+    pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+    return bits.tobytes().hex()
+
+def hamming_distances(hashes, value):
+    """Bit differences between value and each row of hashes ((n, 8) uint8 array)."""
+    target = np.frombuffer(bytes.fromhex(value), dtype=np.uint8)
+    return _POPCOUNT[np.bitwise_xor(hashes, target)].sum(axis=1, dtype=np.int64)
+
+class HashIndex:
+    """
+    Exact (content hash) and perceptual (dhash) lookup over the images kept in the index,
+    used to recognize duplicates before they are embedded.
+    """
+
+    def __init__(self, max_distance=5):
+        self.max_distance = max_distance
+        self._by_sha = {}
+        self._paths = []
+        self._hashes = np.zeros((0, 8), dtype=np.uint8)
+        self._added = []
+
+    def __len__(self):
+        return len(self._by_sha)
+
+    def add(self, path, sha256, phash=None):
+        self._by_sha.setdefault(sha256, path)
+        if phash:
+            self._paths.append(path)
+            self._added.append(np.frombuffer(bytes.fromhex(phash), dtype=np.uint8))
+
+    def match(self, sha256, phash=None):
+        """(path, reason, distance) of the image this one duplicates, or None."""
+        path = self._by_sha.get(sha256)
+        if path is not None:
+            return path, "sha256", 0
+        if not phash or self.max_distance < 0:
+            return None
+        if self._added:
+            self._hashes = np.concatenate([self._hashes, np.stack(self._added)])
+            self._added = []
+        if not len(self._hashes):
+            return None
+        distances = hamming_distances(self._hashes, phash)
+        best = int(np.argmin(distances))
+        if distances[best] > self.max_distance:
+            return None
+        return self._paths[best], "phash", int(distances[best])
+
+def similar_pairs(matrix, min_similarity, block_size=512):
+    """
+    (i, j, similarity) for every pair of rows i < j of a unit-vector matrix whose cosine
+    similarity is at least min_similarity, scored block by block to bound memory.
+    """
+    pairs = []
+    for start in range(0, len(matrix), block_size):
+        scores = matrix[start:start + block_size] @ matrix.T
+        rows, cols = np.nonzero(scores >= min_similarity)
+        for row, col in zip(rows, cols):
+            i = start + int(row)
+            if i < col:
+                pairs.append((i, int(col), float(scores[row, col])))
+    return pairs
+
+def cluster_pairs(n, pairs):
+    """Connected components (union-find) over n items joined by pairs; returns a root per item."""
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j, *_ in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return [find(i) for i in range(n)]
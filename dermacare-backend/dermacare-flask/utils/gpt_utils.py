@@ -1,15 +1,51 @@
+import asyncio
 import base64
-from openai import OpenAI
-from PIL import Image
+import json
+import logging
+import os
+import random
+import threading
+import time
+from openai import (
+    OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError
+)
+from httpx import Limits
 from io import BytesIO
+from .image_utils import DecodedImage, image_mime_type, normalize_image, open_image, read_image_bytes
+from .metrics_utils import OPENAI_TOKENS, timed
 
-def encode_image_file(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+logger = logging.getLogger(__name__)
 
-def resize_image(image_path, max_width=1024, max_height=1024, output_format=None):
-    image = Image.open(image_path)
-    img_format = output_format or image.format or 'JPEG'
+def _cached_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+def record_usage(model, usage):
+    """Add a completion's token usage to the OPENAI_TOKENS counter."""
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+    OPENAI_TOKENS.inc(usage.completion_tokens or 0, model=model, kind="completion")
+    # Prompt tokens served from the provider's prompt cache (a subset of "prompt")
+    OPENAI_TOKENS.inc(_cached_tokens(usage), model=model, kind="cached_prompt")
+
+def usage_summary(usage):
+    """Per-call token usage as a plain dict for API responses, or None."""
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+        "cached_tokens": _cached_tokens(usage)
+    }
+
+def encode_image_file(image_source):
+    return base64.b64encode(read_image_bytes(image_source)).decode('utf-8')
+
+def resize_image(image_source, max_width=1024, max_height=1024, output_format=None):
+    image = open_image(image_source)
+    source_format = image_source.format if isinstance(image_source, DecodedImage) else image.format
+    img_format = output_format or source_format or 'JPEG'
     
     if image.width > max_width or image.height > max_height:
         ratio = min(max_width / image.width, max_height / image.height)
@@ -26,86 +62,260 @@ def resize_image(image_path, max_width=1024, max_height=1024, output_format=None
     
     return None
 
-def load_image_from_path(image_path, detail="auto", resize=True, max_width=1024, max_height=1024):
-    if resize:
-        resized_image = resize_image(image_path, max_width, max_height)
-        
-        if resized_image:
-            base64_image = base64.b64encode(resized_image.getvalue()).decode('utf-8')
-        else:
-            base64_image = encode_image_file(image_path)
+def load_image_from_path(image_source, detail=None, resize=True, max_width=1024, max_height=1024):
+    """
+    Build an image_url content part. image_source may be a path, raw bytes,
+    a file-like object, a PIL image or a DecodedImage.
+    Images already normalized by normalize_image are sent as they are; anything else is
+    normalized here first, unless resize is False. detail defaults to OPENAI_IMAGE_DETAIL.
+    """
+    detail = detail or os.getenv('OPENAI_IMAGE_DETAIL', 'auto')
+    if isinstance(image_source, DecodedImage) and image_source.source_size is not None:
+        data, image_format = image_source.data, image_source.format
+    elif resize:
+        normalized = normalize_image(read_image_bytes(image_source), max_side=min(max_width, max_height))
+        data, image_format = normalized.data, normalized.format
     else:
-        base64_image = encode_image_file(image_path)
-        
+        data = read_image_bytes(image_source)
+        image_format = open_image(data).format
+    
+    base64_image = base64.b64encode(data).decode('utf-8')
     return {
         "type": "image_url",
         "image_url": {
-            "url": f"data:image/jpeg;base64,{base64_image}",
+            "url": f"data:{image_mime_type(image_format)};base64,{base64_image}",
             "detail": detail
         }
     }
 
-def query_openai_with_image_and_text(
-    text_prompt, 
-    image_source=None, 
-    api_key=None, 
-    model="gpt-4o", 
-    max_tokens=1000,
-    temperature=0.7):
+class _RetryPolicy:
+    """Retry classification and backoff shared by the sync and async clients"""
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, APIConnectionError):  # includes APITimeoutError
+            return True
+        return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
 
-    system_prompt = """
-You are an AI dermatologist capable of analyzing images and textual descriptions of skin conditions. You will be provided with up to three diagnoses, a patient history, and potentially an image of the affected area. Your task is to generate a structured JSON response based on these inputs.
+    def _backoff(self, attempt, error):
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # Full jitter keeps a burst of failed calls from retrying in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+class OpenAIClient(_RetryPolicy):
+    """
+    Long-lived OpenAI client shared by all requests.
+    Keeps HTTP connections (and TLS sessions) alive between calls, applies a per-call
+    timeout, retries 429/5xx and connection errors with jittered exponential backoff
+    (honouring Retry-After), and caps concurrent outbound calls with a semaphore.
+    base_url can point at a local stub server for testing.
+    """
+
+    def __init__(self, api_key, base_url=None, timeout=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, max_concurrency=8):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,  # retries are handled here so the semaphore isn't held while backing off
+            http_client=DefaultHttpxClient(
+                limits=Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+            )
+        )
+
+    def chat_completion(self, **kwargs):
+        """chat.completions.create with the concurrency cap and retry policy applied"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._semaphore:
+                    response = self.client.chat.completions.create(**kwargs)
+                record_usage(kwargs.get("model"), response.usage)
+                return response
+            except Exception as e:
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning("OpenAI call failed (%s), retrying in %.2fs", e.__class__.__name__, delay)
+                time.sleep(delay)
+
+    def stream_chat_completion(self, **kwargs):
+        """
+        Yield chunks of a streamed completion. The concurrency slot is held until the
+        stream is exhausted or closed; only the initial request is retried.
+        """
+        for attempt in range(self.max_retries + 1):
+            self._semaphore.acquire()
+            try:
+                stream = self.client.chat.completions.create(stream=True, **kwargs)
+            except Exception as e:
+                self._semaphore.release()
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning("OpenAI call failed (%s), retrying in %.2fs", e.__class__.__name__, delay)
+                time.sleep(delay)
+                continue
+
+            try:
+                for chunk in stream:
+                    # Only the final chunk carries usage, and only with stream_options include_usage
+                    if getattr(chunk, "usage", None) is not None:
+                        record_usage(kwargs.get("model"), chunk.usage)
+                    yield chunk
+            finally:
+                stream.close()
+                self._semaphore.release()
+            return
+
+    def close(self):
+        self.client.close()
+
+class AsyncOpenAIClient(_RetryPolicy):
+    """asyncio counterpart of OpenAIClient for the async serving mode, with the same retry policy."""
+
+    def __init__(self, api_key, base_url=None, timeout=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, max_concurrency=8):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+            )
+        )
+
+    async def chat_completion(self, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await self.client.chat.completions.create(**kwargs)
+                record_usage(kwargs.get("model"), response.usage)
+                return response
+            except Exception as e:
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning("OpenAI call failed (%s), retrying in %.2fs", e.__class__.__name__, delay)
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        await self.client.close()
+
+def _client_settings():
+    return {
+        "base_url": os.getenv('OPENAI_BASE_URL') or None,
+        "timeout": float(os.getenv('OPENAI_TIMEOUT_SECONDS', '60')),
+        "max_retries": int(os.getenv('OPENAI_MAX_RETRIES', '3')),
+        "max_concurrency": int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
+    }
+
+def create_async_openai_client(api_key):
+    """AsyncOpenAIClient configured from the same environment variables as create_openai_client"""
+    return AsyncOpenAIClient(api_key=api_key, **_client_settings())
+
+def create_openai_client(api_key):
+    """
+    Build the shared OpenAIClient from OPENAI_BASE_URL, OPENAI_TIMEOUT_SECONDS,
+    OPENAI_MAX_RETRIES and OPENAI_MAX_CONCURRENCY.
+    """
+    return OpenAIClient(api_key=api_key, **_client_settings())
+
+# Static prefix of every request: sent first and byte-identical each time, with the
+# per-request diagnoses, history and image after it. The answer format itself is enforced
+# by DIAGNOSIS_SCHEMA. OpenAI only caches prompt prefixes of at least 1024 tokens, and
+# this prompt plus the schema come to a few hundred, so requests are not served from the
+# prompt cache today (the "cached_prompt" token count stays at 0). The ordering keeps
+# that possible if the static part grows past the threshold; padding it just to reach it
+# would cost more than it saves.
+SYSTEM_PROMPT = """
+You are an AI dermatologist capable of analyzing images and textual descriptions of skin conditions. You will be provided with a shortlist of candidate diagnoses with their confidence, a patient history, and potentially an image of the affected area.
 
 ### Instructions:
 - If a diagnosis appears multiple times, include it only once.
 - Base your output strictly on the provided diagnoses, patient history, and image analysis.
 - If an image is provided, incorporate visible clinical features into your response.
-- Format your response as JSON with the following keys:
+- Answer with a JSON object whose "diagnoses" list holds, for each condition:
   1. **Diagnosis** – Name of the condition.
   2. **Risk factors** – List of contributing factors.
   3. **Clinical features** – List of symptoms or key characteristics.
-
-### Response Format:
-- Your response must be **JSON only** with **no extra text**.
 - Do not provide explanations, disclaimers, or additional information outside the JSON structure.
 
 **Example Output:**
-```json
-[
-  {
-    "Diagnosis": "Psoriasis",
-    "Risk factors": [
-      "Genetic predisposition",
-      "Stress",
-      "Autoimmune conditions",
-      "Smoking"
-    ],
-    "Clinical features": [
-      "Red patches with silvery scales",
-      "Itching and burning sensation",
-      "Cracked, dry skin that may bleed",
-      "Thickened or ridged nails"
-    ]
-  },
-  {
-    "Diagnosis": "Eczema",
-    "Risk factors": [
-      "Family history of allergies",
-      "Asthma",
-      "Environmental triggers",
-      "Skin barrier dysfunction"
-    ],
-    "Clinical features": [
-      "Dry, sensitive skin",
-      "Severe itching",
-      "Red, inflamed patches",
-      "Fluid-filled blisters that may ooze"
-    ]
-  }
-]
+{"diagnoses": [{"Diagnosis": "Psoriasis", "Risk factors": ["Genetic predisposition", "Stress", "Smoking"], "Clinical features": ["Red patches with silvery scales", "Itching and burning sensation", "Thickened or ridged nails"]}]}
 """
-    client = OpenAI(api_key=api_key)
-    
+
+DIAGNOSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "Diagnosis": {"type": "string"},
+                    "Risk factors": {"type": "array", "items": {"type": "string"}},
+                    "Clinical features": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["Diagnosis", "Risk factors", "Clinical features"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["diagnoses"],
+    "additionalProperties": False
+}
+
+class DiagnosisFormatError(ValueError):
+    """The model's answer is not a valid diagnosis list."""
+
+def response_format(mode=None):
+    """
+    The response_format for OPENAI_RESPONSE_FORMAT: "json_schema" (default, strict structured
+    output against DIAGNOSIS_SCHEMA), "json_object" (JSON mode, for models without structured
+    outputs) or "text" (unconstrained; the answer is still parsed and validated).
+    """
+    mode = (mode or os.getenv('OPENAI_RESPONSE_FORMAT', 'json_schema')).lower()
+    if mode == 'json_schema':
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": "diagnoses", "strict": True, "schema": DIAGNOSIS_SCHEMA}
+        }
+    if mode == 'json_object':
+        return {"type": "json_object"}
+    if mode == 'text':
+        return None
+    raise ValueError(f"Unknown OPENAI_RESPONSE_FORMAT: {mode}")
+
+def _completion_kwargs(model, messages, max_tokens, temperature, fmt):
+    kwargs = {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature}
+    if fmt is not None:
+        kwargs["response_format"] = fmt
+    # Routes requests sharing the static prefix to the same cache (OpenAI only; unset by default).
+    # Only has an effect once that prefix reaches the 1024-token caching minimum.
+    cache_key = os.getenv('OPENAI_PROMPT_CACHE_KEY')
+    if cache_key:
+        kwargs["prompt_cache_key"] = cache_key
+    return kwargs
+
+def build_messages(text_prompt, image_source=None, system_prompt=SYSTEM_PROMPT):
+    """Chat messages for a text prompt plus an optional image (path, bytes, DecodedImage or content part)"""
     content = [{"type": "text", "text": text_prompt}]
     
     if image_source:
@@ -120,12 +330,139 @@ You are an AI dermatologist capable of analyzing images and textual descriptions
         messages.append({"role": "system", "content": system_prompt})
     
     messages.append({"role": "user", "content": content})
+    return messages
+
+def validate_diagnoses(data):
+    """
+    Check a decoded answer ({"diagnoses": [...]}, or the bare list older prompts produced)
+    and return its diagnoses, dropping repeated names. Raises DiagnosisFormatError.
+    """
+    if isinstance(data, dict):
+        data = data.get("diagnoses")
+    if not isinstance(data, list):
+        raise DiagnosisFormatError("Expected a list of diagnoses")
+    diagnoses = []
+    seen = set()
+    for entry in data:
+        name = entry.get("Diagnosis") if isinstance(entry, dict) else None
+        if not isinstance(name, str) or not name.strip():
+            raise DiagnosisFormatError("Every diagnosis needs a Diagnosis name")
+        item = {"Diagnosis": name.strip()}
+        for key in ("Risk factors", "Clinical features"):
+            values = entry.get(key, [])
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise DiagnosisFormatError(f"{key} must be a list of strings")
+            item[key] = values
+        if item["Diagnosis"].lower() not in seen:
+            seen.add(item["Diagnosis"].lower())
+            diagnoses.append(item)
+    return diagnoses
+
+def parse_diagnosis_response(text):
+    """
+    Parse and validate the model's JSON answer, tolerating a ```json fence around it.
+    Returns the list of diagnoses, or None when the text is not a valid answer.
+    """
+    cleaned = (text or "").strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else ""
+        cleaned = cleaned.rsplit("```", 1)[0]
+    try:
+        return validate_diagnoses(json.loads(cleaned))
+    except ValueError:
+        return None
+
+def diagnosis_result(text, usage=None):
+    """
+    {"response", "diagnoses", "usage", "source"} for a model answer: "response" is the validated
+    list re-serialized as JSON (no fences) and "usage" the call's token counts.
+    Raises DiagnosisFormatError when the answer does not validate.
+    """
+    diagnoses = parse_diagnosis_response(text)
+    if diagnoses is None:
+        raise DiagnosisFormatError("Model answer is not a valid diagnosis list")
+    return {"response": json.dumps(diagnoses), "diagnoses": diagnoses, "usage": usage_summary(usage), "source": "llm"}
+
+def completion_result(completion):
+    message = completion.choices[0].message
+    if getattr(message, "refusal", None):
+        raise DiagnosisFormatError(f"Model refused to answer: {message.refusal}")
+    return diagnosis_result(message.content, completion.usage)
+
+def query_openai_with_image_and_text(
+    text_prompt, 
+    image_source=None, 
+    api_key=None, 
+    model="gpt-4o", 
+    max_tokens=1000,
+    temperature=0.7,
+    client=None,
+    timer=None,
+    fmt=None):
+    """
+    Ask the model for a structured diagnosis list (see response_format; fmt overrides it).
+    Returns the validated {"response", "diagnoses", "usage"} result; raises DiagnosisFormatError.
+    """
+    if client is None:
+        client = OpenAIClient(api_key=api_key)
     
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
+    with timed(timer, "prompt"):
+        messages = build_messages(text_prompt, image_source)
     
-    return response.choices[0].message.content
\ No newline at end of file
+    with timed(timer, "llm"):
+        completion = client.chat_completion(
+            **_completion_kwargs(model, messages, max_tokens, temperature, fmt or response_format())
+        )
+    
+    return completion_result(completion)
+
+def stream_openai_with_image_and_text(
+    text_prompt, 
+    image_source=None, 
+    api_key=None, 
+    model="gpt-4o", 
+    max_tokens=1000,
+    temperature=0.7,
+    client=None,
+    timer=None,
+    fmt=None,
+    on_usage=None):
+    """
+    Same request as query_openai_with_image_and_text, returning an iterator of text deltas.
+    The prompt is built (and timed) before this returns, so it is not counted in whatever
+    stage the caller times the iteration under. Pass the joined text to diagnosis_result;
+    on_usage receives the final usage, if reported.
+    """
+    if client is None:
+        client = OpenAIClient(api_key=api_key)
+    
+    with timed(timer, "prompt"):
+        messages = build_messages(text_prompt, image_source)
+    
+    return _stream_deltas(client, model, messages, max_tokens, temperature, fmt, on_usage)
+
+def _stream_deltas(client, model, messages, max_tokens, temperature, fmt, on_usage):
+    for chunk in client.stream_chat_completion(
+        stream_options={"include_usage": True},
+        **_completion_kwargs(model, messages, max_tokens, temperature, fmt or response_format())
+    ):
+        if getattr(chunk, "usage", None) is not None and on_usage is not None:
+            on_usage(chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def aquery_openai_with_messages(
+    messages, 
+    client, 
+    model="gpt-4o", 
+    max_tokens=1000,
+    temperature=0.7,
+    fmt=None):
+    """
+    Async counterpart of query_openai_with_image_and_text. Takes messages prebuilt with
+    build_messages, since encoding the image is CPU work the caller may want off the event loop.
+    """
+    completion = await client.chat_completion(
+        **_completion_kwargs(model, messages, max_tokens, temperature, fmt or response_format())
+    )
+    return completion_result(completion)
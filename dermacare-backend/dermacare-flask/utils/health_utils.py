@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import select
+
+logger = logging.getLogger(__name__)
+
+class StartupState:
+    """
+    Tracks startup phases ("warming" -> "ready" or "failed") and how long each one took,
+    so readiness can report progress while the model loads in the background.
+    """
+
+    def __init__(self):
+        self.status = "warming"
+        self.error = None
+        self.phases = {}
+        self._started = time.perf_counter()
+        self._ready = threading.Event()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - started, 3)
+            logger.info("Startup phase '%s' took %.2fs", name, self.phases[name])
+
+    def mark_ready(self):
+        self.phases["total"] = round(time.perf_counter() - self._started, 3)
+        self.status = "ready"
+        self._ready.set()
+
+    def mark_failed(self, error):
+        self.status = "failed"
+        self.error = str(error)
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def report(self):
+        report = {"status": self.status, "phases": dict(self.phases)}
+        if self.error:
+            report["error"] = self.error
+        return report
+
+def readiness_status(result):
+    """
+    Status for a ReadinessProbe result: "ready", the startup status ("warming" or "failed")
+    while warm-up has not completed, otherwise "not ready" (a check failed after startup).
+    """
+    if result["ready"]:
+        return "ready"
+    startup = result.get("startup") or {}
+    if startup.get("status") in ("warming", "failed"):
+        return startup["status"]
+    return "not ready"
+
+class ReadinessProbe:
+    """
+    Constant-cost readiness check, cached for ttl seconds.
+    The database check fetches at most one row id over a dedicated connection, so
+    probe latency does not grow with the collection. Concurrent probes inside the
+    ttl window share one result instead of each hitting IRIS.
+    """
+
+    def __init__(self, get_db, model_loaded, ttl=5.0, startup=None):
+        self.get_db = get_db
+        self.model_loaded = model_loaded
+        self.ttl = ttl
+        self.startup = startup
+        self._conn = None
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = 0.0
+
+    def _ping_db(self):
+        db = self.get_db()
+        if self._conn is None:
+            self._conn = db._conn.engine.connect()
+        try:
+            row = self._conn.execute(select(db.table.c.id).limit(1)).first()
+        except Exception:
+            # Drop the connection so the next probe reconnects instead of reusing a broken one
+            self._conn.close()
+            self._conn = None
+            raise
+        return row is not None
+
+    def _run_checks(self):
+        result = {"database": "disconnected", "collection_empty": None, "model_loaded": False}
+        try:
+            result["collection_empty"] = not self._ping_db()
+            result["database"] = "connected"
+        except Exception as e:
+            result["error"] = str(e)
+        result["model_loaded"] = bool(self.model_loaded())
+        result["ready"] = result["database"] == "connected" and result["model_loaded"]
+        return result
+
+    def check(self):
+        """Return the cached readiness result, re-running the checks once it is older than ttl."""
+        if self.startup is not None and not self.startup.ready:
+            # Still warming up (or failed to): nothing to ping yet
+            return {
+                "ready": False,
+                "database": "disconnected",
+                "model_loaded": bool(self.model_loaded()),
+                "startup": self.startup.report()
+            }
+        with self._lock:
+            now = time.monotonic()
+            if self._result is None or now - self._checked_at >= self.ttl:
+                started = time.perf_counter()
+                self._result = self._run_checks()
+                self._result["check_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                self._checked_at = now
+            result = dict(self._result, age_seconds=round(now - self._checked_at, 3))
+        if self.startup is not None:
+            result["startup"] = self.startup.report()
+        return result
@@ -0,0 +1,224 @@
+import io
+import logging
+import os
+from collections import namedtuple
+from io import BytesIO
+from PIL import Image, ImageOps
+from werkzeug.exceptions import RequestEntityTooLarge
+from .metrics_utils import IMAGE_BYTES, IMAGE_BYTES_SAVED
+
+logger = logging.getLogger(__name__)
+
+# An upload decoded once and shared by verification, embedding and the LLM payload.
+# source_size is set by normalize_image: the size of the upload before re-encoding.
+DecodedImage = namedtuple('DecodedImage', ['image', 'data', 'format', 'source_size'], defaults=[None])
+
+# Accepted upload formats by their leading magic bytes
+UPLOAD_SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+)
+
+class UploadRejected(ValueError):
+    """An upload refused before it is decoded; status is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class UploadBuffer(BytesIO):
+    """
+    In-memory file part for the multipart parsers (Flask and Quart) in place of spooled
+    temporary files, refusing to grow past max_bytes. upload_buffer reads it without a copy.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    def write(self, data):
+        if self.tell() + len(data) > self.max_bytes:
+            raise RequestEntityTooLarge(f"Each image must be at most {self.max_bytes} bytes")
+        return super().write(data)
+
+def upload_buffer(file_storage):
+    """The uploaded bytes as a memoryview over an UploadBuffer part, without a copy."""
+    stream = file_storage.stream
+    if isinstance(stream, BytesIO):
+        return stream.getbuffer()
+    return memoryview(file_storage.read())
+
+class BufferStream(io.RawIOBase):
+    """
+    Read-only, seekable file object over a bytes-like buffer. Unlike BytesIO it does not
+    copy a memoryview up front, so an upload buffer can be decoded in place.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        chunk = self._view[self._position:end].tobytes()
+        self._position = max(self._position, end)
+        return chunk
+
+    def close(self):
+        # Release the view so the buffer it came from can be freed or resized
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+def sniff_image_format(data):
+    """'JPEG' or 'PNG' from the leading magic bytes of data (never the filename), else None."""
+    header = bytes(data[:8])
+    for signature, image_format in UPLOAD_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return None
+
+def probe_upload(data, max_pixels=None):
+    """
+    Check an upload before anything is decoded: the format from its magic bytes and the
+    dimensions from the header alone (Image.open reads no pixel data). Raises UploadRejected,
+    400 for unsupported or unreadable files and 413 above max_pixels (IMAGE_MAX_PIXELS).
+    Returns (format, (width, height)).
+    """
+    max_pixels = max_pixels or int(os.getenv('IMAGE_MAX_PIXELS', '50000000'))
+    image_format = sniff_image_format(data)
+    if image_format is None:
+        raise UploadRejected("Invalid image format. Must be PNG or JPEG")
+    try:
+        with BufferStream(data) as stream, Image.open(stream, formats=[image_format]) as image:
+            size = image.size
+    except Image.DecompressionBombError:
+        raise UploadRejected(f"Image dimensions exceed {max_pixels} pixels", 413)
+    except Exception:
+        # The parser's message names internal objects, so it is logged rather than returned
+        logger.info("Could not read %s upload header", image_format, exc_info=True)
+        raise UploadRejected(f"Unreadable {image_format} image")
+    if size[0] * size[1] > max_pixels:
+        raise UploadRejected(f"Image is {size[0]}x{size[1]}, at most {max_pixels} pixels are accepted", 413)
+    return image_format, size
+
+def decode_image(data):
+    """
+    Decode raw image bytes into a DecodedImage.
+    The bytes are verified first; since verify() leaves the parser unusable,
+    the pixels are then loaded from a fresh in-memory handle.
+    """
+    buffer = BytesIO(data)
+    Image.open(buffer).verify()
+
+    buffer.seek(0)
+    image = Image.open(buffer)
+    image.load()
+    return DecodedImage(image=image, data=data, format=image.format or 'JPEG')
+
+def _normalize_settings():
+    # Read per call, so values from .env loaded after import still apply
+    return {
+        "max_side": int(os.getenv('IMAGE_MAX_SIDE', '1024')),
+        "output_format": os.getenv('IMAGE_FORMAT', 'JPEG').upper(),
+        "quality": int(os.getenv('IMAGE_QUALITY', '85'))
+    }
+
+def normalize_image(data, max_side=None, output_format=None, quality=None):
+    """
+    Verify, decode and normalize an upload in one pass, returning a DecodedImage whose
+    pixels feed CLIP and whose data is the compact payload sent to the LLM. data may be a
+    memoryview over the request buffer; it is decoded in place, and probe_upload rejects
+    unsupported formats and oversized dimensions before any pixels are decoded.
+
+    JPEGs are downscaled inside the decoder (draft) when they are at least twice max_side;
+    other formats use reduce() before the final resample. EXIF orientation is applied,
+    transparency is flattened onto white, and the result is re-encoded as JPEG or WEBP
+    (IMAGE_FORMAT) at IMAGE_QUALITY without any metadata.
+    """
+    settings = _normalize_settings()
+    max_side = max_side or settings["max_side"]
+    output_format = (output_format or settings["output_format"]).upper()
+    quality = quality or settings["quality"]
+    source_format, _ = probe_upload(data)
+    source_size = memoryview(data).nbytes
+
+    with BufferStream(data) as stream:
+        Image.open(stream, formats=[source_format]).verify()
+    with BufferStream(data) as stream:
+        image = Image.open(stream, formats=[source_format])
+        if image.format == 'JPEG':
+            image.draft('RGB', (max_side, max_side))
+        # Decodes the pixels into a new image, so nothing refers to the buffer afterwards
+        image = ImageOps.exif_transpose(image)
+
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((max_side, max_side), Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+    byte_stream = BytesIO()
+    image.save(byte_stream, format=output_format, quality=quality)
+    normalized = byte_stream.getvalue()
+
+    IMAGE_BYTES.inc(source_size, stage="upload")
+    IMAGE_BYTES.inc(len(normalized), stage="normalized")
+    IMAGE_BYTES_SAVED.observe(source_size - len(normalized))
+    logger.debug("Normalized image %dx%d: %d -> %d bytes", image.width, image.height, source_size, len(normalized))
+    return DecodedImage(image=image, data=normalized, format=output_format, source_size=source_size)
+
+def image_mime_type(image_format):
+    return Image.MIME.get((image_format or 'JPEG').upper(), 'image/jpeg')
+
+def open_image(image_source):
+    """
+    Return a PIL image for a path, raw bytes, file-like object, PIL image or DecodedImage.
+    """
+    if isinstance(image_source, DecodedImage):
+        return image_source.image
+    if isinstance(image_source, Image.Image):
+        return image_source
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(image_source))
+    return Image.open(image_source)
+
+def read_image_bytes(image_source):
+    """
+    Return the encoded bytes for a path, raw bytes, file-like object, PIL image or DecodedImage.
+    """
+    if isinstance(image_source, DecodedImage):
+        return image_source.data
+    if isinstance(image_source, Image.Image):
+        byte_stream = BytesIO()
+        image_source.save(byte_stream, format=image_source.format or 'PNG')
+        return byte_stream.getvalue()
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        return bytes(image_source)
+    if hasattr(image_source, 'read'):
+        image_source.seek(0)
+        return image_source.read()
+    with open(image_source, "rb") as image_file:
+        return image_file.read()
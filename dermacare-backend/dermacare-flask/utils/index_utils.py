@@ -0,0 +1,511 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as SearchTimeout
+import numpy as np
+from langchain_core.documents import Document
+from sqlalchemy import select
+from .metrics_utils import SEARCH_FALLBACKS
+
+logger = logging.getLogger(__name__)
+
+FETCH_CHUNK_SIZE = 1000
+# Written by setup.py next to the ingestion manifest
+PROTOTYPES_NAME = "prototypes.npz"
+
+def _to_vector(value):
+    # sqlalchemy_iris returns native VECTOR columns as lists, older builds as "v1,v2,..." strings
+    if isinstance(value, str):
+        return np.array(value.strip('[]').split(','), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def kmeans(vectors, n_clusters, n_iter=10, seed=0):
+    """
+    Spherical k-means over unit vectors. Returns (centroids, assignments);
+    empty clusters are re-seeded from random points.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int64)
+
+    for _ in range(n_iter):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums).astype(np.float32)
+
+    return centroids, assignments
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+class _IndexSnapshot:
+    """Immutable arrays for one version of the index, swapped atomically on refresh."""
+
+    def __init__(self, ids, matrix, documents, metadatas, centroids=None, lists=None):
+        self.ids = ids
+        self.matrix = matrix
+        self.documents = documents
+        self.metadatas = metadatas
+        self.centroids = centroids
+        self.lists = lists
+        self._class_blocks = None
+
+    def class_blocks(self):
+        """
+        Per diagnosis: (row indices, contiguous copy of those rows), built on first use.
+        Scoring a block directly avoids gathering scattered rows on every query.
+        """
+        if self._class_blocks is None:
+            labels = np.array([meta.get("diagnosis") or "Unknown" for meta in self.metadatas])
+            names, inverse = np.unique(labels, return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            boundaries = np.searchsorted(inverse[order], np.arange(len(names) + 1))
+            blocks = {}
+            for i, name in enumerate(names):
+                rows = order[boundaries[i]:boundaries[i + 1]]
+                blocks[str(name)] = (rows, np.ascontiguousarray(self.matrix[rows]))
+            self._class_blocks = blocks
+        return self._class_blocks
+
+class PrototypeIndex:
+    """
+    A few spherical k-means prototypes per diagnosis, held as one float32 matrix with a
+    parallel label array. Scoring every class is a single matrix-vector product, so it works
+    as a coarse first stage (top_classes) and, through the IRISVector search methods, as a
+    stand-in index that answers with prototypes when the real one is unavailable.
+    """
+
+    def __init__(self, prototypes, labels, counts=None):
+        self.prototypes = np.ascontiguousarray(prototypes, dtype=np.float32)
+        self.labels = np.asarray(labels).astype(str)
+        self.counts = np.asarray(counts if counts is not None else np.ones(len(self.labels)), dtype=np.int64)
+        self.classes, self.label_ids = np.unique(self.labels, return_inverse=True)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def build(cls, embeddings, labels, per_class=4, n_iter=10, seed=0):
+        """Cluster each diagnosis's embeddings into at most per_class prototypes."""
+        matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        labels = np.asarray(labels).astype(str)
+        prototypes, prototype_labels, counts = [], [], []
+        for name in np.unique(labels):
+            members = matrix[labels == name]
+            centroids, assignments = kmeans(members, per_class, n_iter=n_iter, seed=seed)
+            member_counts = np.bincount(assignments, minlength=len(centroids))
+            keep = member_counts > 0
+            prototypes.append(centroids[keep])
+            prototype_labels.extend([name] * int(keep.sum()))
+            counts.extend(member_counts[keep].tolist())
+        return cls(np.concatenate(prototypes), prototype_labels, counts)
+
+    @classmethod
+    def from_local_index(cls, index, per_class=4):
+        snapshot = index._snapshot
+        labels = [meta.get("diagnosis") or "Unknown" for meta in snapshot.metadatas]
+        return cls.build(snapshot.matrix, labels, per_class=per_class)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as table:
+            return cls(table["prototypes"], table["labels"], table["counts"])
+
+    def save(self, path):
+        """Write atomically, so a server loading the table never sees a partial file."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as table_file:
+            np.savez(table_file, prototypes=self.prototypes, labels=self.labels, counts=self.counts)
+        os.replace(tmp_path, path)
+
+    def class_scores(self, embedding):
+        """Best prototype similarity for every diagnosis in self.classes."""
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32))
+        scores = np.full(len(self.classes), -np.inf, dtype=np.float32)
+        np.maximum.at(scores, self.label_ids, self.prototypes @ query)
+        return scores
+
+    def top_classes(self, embedding, n):
+        return [str(self.classes[i]) for i in top_k_indices(self.class_scores(embedding), n)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        """The k closest prototypes as (Document, cosine distance) pairs; filter is ignored."""
+        similarities = self.prototypes @ normalize_rows(np.asarray(embedding, dtype=np.float32))
+        return [
+            (
+                Document(page_content="", metadata={
+                    "diagnosis": str(self.labels[i]), "prototype": True, "members": int(self.counts[i])
+                }),
+                float(1.0 - similarities[i])
+            )
+            for i in top_k_indices(similarities, k)
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k)]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        return [self.similarity_search_with_score_by_vector(embedding, k=k) for embedding in embeddings]
+
+class LocalVectorIndex:
+    """
+    In-process mirror of an IRIS vector collection.
+    Embeddings are held in a contiguous float32 matrix of unit vectors and searched with
+    a single matrix-vector product (exact), or through an inverted-file layout over
+    k-means centroids when approximate=True. With a PrototypeIndex and class_probe > 0,
+    each unfiltered query only scores the rows of its class_probe closest diagnoses,
+    kept as one contiguous block per diagnosis (a second copy of the matrix).
+    It exposes the same similarity_search methods as IRISVector, so it can replace db
+    in query_db_with_image_and_text.
+    """
+
+    def __init__(self, db, approximate=False, n_lists=None, n_probe=8, prototypes=None, class_probe=0):
+        self.db = db
+        self.approximate = approximate
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.prototypes = prototypes
+        self.class_probe = class_probe
+        self._lock = threading.Lock()
+        self._snapshot = _IndexSnapshot([], np.zeros((0, 0), dtype=np.float32), [], [])
+        self._refresh_thread = None
+        self._conn = None
+
+    @classmethod
+    def from_arrays(cls, ids, embeddings, documents, metadatas, approximate=False, n_lists=None, n_probe=8,
+                    prototypes=None, class_probe=0):
+        """Build an index from in-memory rows, with no IRIS collection behind it (refresh is unavailable)."""
+        index = cls(None, approximate=approximate, n_lists=n_lists, n_probe=n_probe,
+                    prototypes=prototypes, class_probe=class_probe)
+        matrix = np.ascontiguousarray(normalize_rows(np.asarray(embeddings, dtype=np.float32)))
+        snapshot = _IndexSnapshot(list(ids), matrix, list(documents), list(metadatas))
+        if approximate and len(snapshot.ids):
+            index._build_lists(snapshot, index._snapshot, np.zeros(0, dtype=bool), len(snapshot.ids))
+        index._snapshot = snapshot
+        return index
+
+    def __len__(self):
+        return len(self._snapshot.ids)
+
+    def _connection(self):
+        # A dedicated connection, so refreshes never share IRISVector's connection with request threads
+        if self._conn is None:
+            self._conn = self.db._conn.engine.connect()
+        return self._conn
+
+    def _fetch_ids(self):
+        table = self.db.table
+        return [row[0] for row in self._connection().execute(select(table.c.id))]
+
+    def _fetch_rows(self, ids):
+        table = self.db.table
+        rows = []
+        for i in range(0, len(ids), FETCH_CHUNK_SIZE):
+            chunk = ids[i:i + FETCH_CHUNK_SIZE]
+            statement = select(table.c.id, table.c.embedding, table.c.document, table.c.metadata).where(
+                table.c.id.in_(chunk)
+            )
+            rows.extend(self._connection().execute(statement))
+        return rows
+
+    def refresh(self):
+        """
+        Load rows added to IRIS since the last refresh and drop rows that were deleted.
+        Only new rows have their embeddings transferred. Returns (added, removed).
+        """
+        with self._lock:
+            current = self._snapshot
+            remote_ids = self._fetch_ids()
+            remote_set = set(remote_ids)
+            known = set(current.ids)
+            new_ids = [row_id for row_id in remote_ids if row_id not in known]
+            keep = np.array([row_id in remote_set for row_id in current.ids], dtype=bool)
+            removed = int(len(keep) - keep.sum())
+
+            if not new_ids and not removed:
+                return 0, 0
+
+            rows = self._fetch_rows(new_ids)
+            ids = [row_id for row_id, kept in zip(current.ids, keep) if kept]
+            documents = [doc for doc, kept in zip(current.documents, keep) if kept]
+            metadatas = [meta for meta, kept in zip(current.metadatas, keep) if kept]
+            blocks = [current.matrix[keep]] if len(current.ids) else []
+
+            if rows:
+                blocks.append(normalize_rows(np.stack([_to_vector(row.embedding) for row in rows])))
+                for row in rows:
+                    ids.append(row.id)
+                    documents.append(row.document)
+                    metadatas.append(json.loads(row.metadata) if row.metadata else {})
+
+            matrix = np.ascontiguousarray(np.concatenate(blocks), dtype=np.float32)
+            snapshot = _IndexSnapshot(ids, matrix, documents, metadatas)
+            if self.approximate and ids:
+                self._build_lists(snapshot, current, keep, len(rows))
+            self._snapshot = snapshot
+            logger.info("Local vector index refreshed: %d added, %d removed, %d total", len(rows), removed, len(ids))
+            return len(rows), removed
+
+    def _build_lists(self, snapshot, previous, keep, n_added):
+        # Re-cluster on first load or after large changes; otherwise assign new rows
+        # to the existing centroids so incremental refreshes stay cheap
+        n_rows = len(snapshot.ids)
+        if previous.centroids is None or n_added > 0.1 * max(len(previous.ids), 1):
+            n_lists = self.n_lists or max(1, int(np.sqrt(n_rows)))
+            centroids, assignments = kmeans(snapshot.matrix, n_lists)
+        else:
+            centroids = previous.centroids
+            old_assignments = np.empty(len(previous.ids), dtype=np.int64)
+            for list_id, members in enumerate(previous.lists):
+                old_assignments[members] = list_id
+            new_assignments = np.argmax(snapshot.matrix[n_rows - n_added:] @ centroids.T, axis=1)
+            assignments = np.concatenate([old_assignments[keep], new_assignments])
+        order = np.argsort(assignments, kind='stable')
+        boundaries = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        snapshot.centroids = centroids
+        snapshot.lists = [order[boundaries[i]:boundaries[i + 1]] for i in range(len(centroids))]
+
+    def start_auto_refresh(self, interval_seconds):
+        """Refresh from IRIS every interval_seconds on a daemon thread."""
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval_seconds):
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("Local vector index refresh failed")
+
+        self._refresh_thread = threading.Thread(target=loop, name="vector-index-refresh", daemon=True)
+        self._refresh_thread.start()
+        return stop
+
+    def _routed(self, snapshot):
+        return bool(self.prototypes is not None and self.class_probe) or (
+            self.approximate and snapshot.centroids is not None
+        )
+
+    def _class_routed_search(self, snapshot, query, k):
+        blocks = snapshot.class_blocks()
+        chosen = [
+            blocks[name] for name in self.prototypes.top_classes(query, self.class_probe) if name in blocks
+        ]
+        if not chosen:
+            # None of the table's classes are in the index (it predates a re-ingest): full scan
+            return None
+        rows = np.concatenate([block_rows for block_rows, _ in chosen])
+        scores_subset = np.concatenate([block @ query for _, block in chosen])
+        local_best = top_k_indices(scores_subset, k)
+        return self._results(snapshot, rows[local_best], scores_subset[local_best])
+
+    def _candidate_rows(self, snapshot, query):
+        if not self.approximate or snapshot.centroids is None:
+            return None
+        probe = top_k_indices(snapshot.centroids @ query, self.n_probe)
+        return np.concatenate([snapshot.lists[list_id] for list_id in probe])
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        """Return (Document, cosine distance) pairs, matching IRISVector's scoring."""
+        snapshot = self._snapshot
+        if not snapshot.ids:
+            return []
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32))
+
+        if self.prototypes is not None and self.class_probe and not filter:
+            results = self._class_routed_search(snapshot, query, k)
+            if results is not None:
+                return results
+
+        rows = self._candidate_rows(snapshot, query)
+        if filter:
+            mask = np.array(
+                [all(meta.get(key) == value for key, value in filter.items()) for meta in snapshot.metadatas],
+                dtype=bool
+            )
+            rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+
+        if rows is None:
+            scores = snapshot.matrix @ query
+            best = top_k_indices(scores, k)
+            return self._results(snapshot, best, scores[best])
+        scores_subset = snapshot.matrix[rows] @ query
+        local_best = top_k_indices(scores_subset, k)
+        return self._results(snapshot, rows[local_best], scores_subset[local_best])
+
+    @staticmethod
+    def _results(snapshot, best, best_scores):
+        """(Document, cosine distance) pairs for rows best, whose similarities are best_scores (same order)."""
+        return [
+            (
+                Document(page_content=snapshot.documents[i] or "", metadata=snapshot.metadatas[i]),
+                float(1.0 - score)
+            )
+            for i, score in zip(best, best_scores)
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        """
+        (Document, cosine distance) pairs for several query vectors; exact mode scores
+        them all in one matrix product.
+        """
+        snapshot = self._snapshot
+        if not snapshot.ids:
+            return [[] for _ in embeddings]
+        if self._routed(snapshot):
+            return [self.similarity_search_with_score_by_vector(embedding, k=k) for embedding in embeddings]
+
+        queries = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        scores = queries @ snapshot.matrix.T
+        results = []
+        for row_scores in scores:
+            best = top_k_indices(row_scores, k)
+            results.append(self._results(snapshot, best, row_scores[best]))
+        return results
+
+    def similarity_search_by_vectors(self, embeddings, k=4):
+        """Search several query vectors at once; exact mode scores them all in one matrix product."""
+        return [
+            [doc for doc, _ in results]
+            for results in self.similarity_search_with_score_by_vectors(embeddings, k=k)
+        ]
+
+class FallbackSearchIndex:
+    """
+    Search primary, answering from fallback (a PrototypeIndex) when a search raises or takes
+    longer than timeout seconds. After a failure the primary is skipped for cooldown seconds,
+    so requests during an outage do not each wait out the timeout.
+    """
+
+    def __init__(self, primary, fallback, timeout=None, cooldown=30.0, max_workers=8):
+        self.primary = primary
+        self.fallback = fallback
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self._skip_until = 0.0
+        self._executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search") if timeout else None
+        )
+
+    def __getattr__(self, name):
+        # Everything else (refresh, __len__-style helpers, db) is the primary index's
+        if name == "primary":
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def _search(self, search):
+        if time.monotonic() < self._skip_until:
+            SEARCH_FALLBACKS.inc(reason="cooldown")
+            return search(self.fallback)
+        try:
+            if self._executor is None:
+                return search(self.primary)
+            context = contextvars.copy_context()
+            return self._executor.submit(context.run, search, self.primary).result(timeout=self.timeout)
+        except SearchTimeout:
+            reason = "timeout"
+            logger.warning("Search took longer than %.1fs, answering from prototypes", self.timeout)
+        except Exception:
+            reason = "error"
+            logger.exception("Search failed, answering from prototypes")
+        self._skip_until = time.monotonic() + self.cooldown
+        SEARCH_FALLBACKS.inc(reason=reason)
+        return search(self.fallback)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        return self._search(lambda index: index.similarity_search_with_score_by_vector(embedding, k=k, filter=filter))
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        def search(index):
+            batch_search = getattr(index, 'similarity_search_with_score_by_vectors', None)
+            if batch_search is not None:
+                return batch_search(embeddings, k=k)
+            return [index.similarity_search_with_score_by_vector(embedding, k=k) for embedding in embeddings]
+        return self._search(search)
+
+    def similarity_search_by_vectors(self, embeddings, k=4):
+        return [[doc for doc, _ in results] for results in self.similarity_search_with_score_by_vectors(embeddings, k=k)]
+
+def build_prototype_table(db, path, per_class=4):
+    """Mirror the IRIS collection, cluster it into per-diagnosis prototypes and save them to path."""
+    index = LocalVectorIndex(db)
+    index.refresh()
+    if not len(index):
+        raise ValueError("The collection is empty; nothing to build prototypes from")
+    table = PrototypeIndex.from_local_index(index, per_class=per_class)
+    table.save(path)
+    return table
+
+def load_prototypes(path=None):
+    """The PrototypeIndex at path (VECTOR_INDEX_PROTOTYPES, default .ingest/prototypes.npz), or None."""
+    path = path or os.getenv('VECTOR_INDEX_PROTOTYPES') or os.path.join(".ingest", PROTOTYPES_NAME)
+    if not os.path.exists(path):
+        return None
+    table = PrototypeIndex.load(path)
+    logger.info("Loaded %d prototypes for %d diagnoses from %s", len(table), len(table.classes), path)
+    return table
+
+def create_search_index(db):
+    """
+    Select the search backend from VECTOR_INDEX: "iris" (default) queries IRIS directly,
+    "local" mirrors the collection into an exact in-process index and "local-approx"
+    adds an inverted-file layout (VECTOR_INDEX_N_PROBE lists probed per query).
+    VECTOR_INDEX_REFRESH_SECONDS enables periodic incremental refresh.
+
+    When the prototype table exists, local indexes search only the rows of the
+    VECTOR_INDEX_CLASS_PROBE closest diagnoses (0 searches everything), and every backend
+    falls back to the prototypes when a search fails or exceeds SEARCH_FALLBACK_TIMEOUT_SECONDS.
+    """
+    backend = os.getenv('VECTOR_INDEX', 'iris').lower()
+    if backend not in ('iris', 'local', 'local-approx'):
+        raise ValueError(f"Unknown VECTOR_INDEX: {backend}")
+    prototypes = load_prototypes()
+
+    if backend == 'iris':
+        index = db
+    else:
+        index = LocalVectorIndex(
+            db,
+            approximate=backend == 'local-approx',
+            n_probe=int(os.getenv('VECTOR_INDEX_N_PROBE', '8')),
+            prototypes=prototypes,
+            class_probe=int(os.getenv('VECTOR_INDEX_CLASS_PROBE', '0'))
+        )
+        index.refresh()
+        refresh_seconds = float(os.getenv('VECTOR_INDEX_REFRESH_SECONDS', '0'))
+        if refresh_seconds > 0:
+            index.start_auto_refresh(refresh_seconds)
+
+    if prototypes is None:
+        return index
+    return FallbackSearchIndex(
+        index,
+        prototypes,
+        timeout=float(os.getenv('SEARCH_FALLBACK_TIMEOUT_SECONDS', '2')) or None,
+        cooldown=float(os.getenv('SEARCH_FALLBACK_COOLDOWN_SECONDS', '30'))
+    )
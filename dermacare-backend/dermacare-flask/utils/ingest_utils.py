@@ -0,0 +1,355 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image
+from .db_utils import encode_pixel_batch
+from .dedup_utils import DEDUP_REPORT_NAME, HashIndex, cluster_pairs, dhash, is_hidden, similar_pairs
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MANIFEST_NAME = "manifest.json"
+
+_worker_preprocess = None
+
+def _init_worker(preprocess):
+    global _worker_preprocess
+    _worker_preprocess = preprocess
+
+def load_and_preprocess(path):
+    """
+    Read, hash (content and perceptual), verify and preprocess one image. Runs inside the
+    process pool, so it only returns plain data (and the preprocessed pixel tensor).
+    """
+    try:
+        with open(path, "rb") as image_file:
+            data = image_file.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        Image.open(BytesIO(data)).verify()
+        phash = dhash(Image.open(BytesIO(data)))
+        pixels = None
+        if _worker_preprocess is not None:
+            pixels = _worker_preprocess(Image.open(BytesIO(data)))
+        return {"path": path, "sha256": sha256, "phash": phash, "pixels": pixels, "error": None}
+    except Exception as e:
+        return {"path": path, "sha256": None, "phash": None, "pixels": None, "error": str(e)}
+
+def scan_images(root_dir, hidden=None):
+    """
+    Return {path: {"size", "mtime"}} for every image under root_dir. Hidden directories
+    (e.g. .ipynb_checkpoints) and files are skipped; their paths are appended to hidden if given.
+    """
+    found = {}
+    for root, dirs, files in os.walk(root_dir):
+        if hidden is not None:
+            hidden.extend(os.path.join(root, name) for name in dirs if is_hidden(name))
+        dirs[:] = sorted(name for name in dirs if not is_hidden(name))
+        for file in sorted(files):
+            if is_hidden(file):
+                continue
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                full_path = os.path.join(root, file)
+                stat = os.stat(full_path)
+                found[full_path] = {"size": stat.st_size, "mtime": stat.st_mtime}
+    return found
+
+def document_id(path, sha256):
+    """Deterministic row id, so re-inserting a batch after a crash cannot duplicate it."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{sha256}:{path}"))
+
+class IngestManifest:
+    """
+    Persisted record of committed images: path -> size, mtime, content and perceptual hash
+    and row id. Duplicates share their canonical image's row id and also record duplicate_of
+    (the canonical path), the reason (sha256, phash or embedding) and how close they were.
+    Saved atomically after every committed batch, which doubles as the resume checkpoint.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as manifest_file:
+                self.entries = json.load(manifest_file).get("entries", {})
+
+    def is_unchanged(self, path, size, mtime):
+        entry = self.entries.get(path)
+        return entry is not None and entry["size"] == size and entry["mtime"] == mtime
+
+    def is_duplicate(self, path):
+        return "duplicate_of" in self.entries.get(path, {})
+
+    def save(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump({"version": 1, "entries": self.entries}, manifest_file)
+        os.replace(tmp_path, self.path)
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def ingest_images(root_dir, multimodal_ef, db, extract_diagnosis, state_dir=".ingest",
+                  batch_size=256, workers=None, prune=False, phash_distance=5):
+    """
+    Incrementally index every image under root_dir into db.
+
+    Unchanged files (same size and mtime as the manifest) are skipped without being read.
+    The rest are hashed, verified and preprocessed in a process pool; files whose content
+    hash is unchanged only have their manifest entry refreshed. Exact copies and near
+    duplicates (dhash within phash_distance bits, negative disables) of an image already
+    indexed are recorded against it in the manifest instead of being embedded. New or
+    changed images are embedded in batches, written to IRIS, and the manifest is
+    checkpointed after each batch, so an interrupted run resumes from the last committed batch.
+
+    Returns a summary dict with added, updated, skipped, removed, duplicates, hidden and errors.
+    """
+    manifest = IngestManifest(state_dir)
+    hidden = []
+    found = scan_images(root_dir, hidden)
+    summary = {"added": 0, "updated": 0, "skipped": 0, "removed": 0, "duplicates": 0,
+               "hidden": hidden, "errors": []}
+
+    missing = [path for path in manifest.entries if path not in found]
+    if prune and missing:
+        # Duplicates share their canonical image's row; only canonical rows are deleted
+        db.delete(ids=[manifest.entries[path]["id"] for path in missing if not manifest.is_duplicate(path)])
+        for path in missing:
+            del manifest.entries[path]
+        manifest.save()
+        summary["removed"] = len(missing)
+
+    changed = [
+        path for path, stat in found.items()
+        if not manifest.is_unchanged(path, stat["size"], stat["mtime"])
+    ]
+    # Duplicates of images that changed or were pruned lose their row, so they are processed again
+    released = set(changed) | (set(missing) if prune else set())
+    orphans = [
+        path for path, entry in manifest.entries.items()
+        if entry.get("duplicate_of") in released and path not in released
+    ]
+    for path in orphans:
+        del manifest.entries[path]
+    todo = changed + [path for path in orphans if path in found]
+    summary["skipped"] = len(found) - len(todo)
+
+    # Images that keep their row; duplicates are matched against these and the new ones
+    kept = HashIndex(phash_distance)
+    for path, entry in manifest.entries.items():
+        if path not in released and not manifest.is_duplicate(path):
+            kept.add(path, entry["sha256"], entry.get("phash"))
+
+    print(f"{len(found)} images found, {summary['skipped']} unchanged, {len(todo)} to process, "
+          f"{len(hidden)} hidden directories skipped")
+
+    pending_batch = []
+    queued = set()
+    # Duplicates of images still waiting in pending_batch, recorded once their row is committed
+    deferred = {}
+
+    def commit(batch_items):
+        embeddings = encode_pixel_batch(multimodal_ef, [item["pixels"] for item in batch_items])
+        new_ids = [document_id(item["path"], item["sha256"]) for item in batch_items]
+        stale_ids = [
+            manifest.entries[item["path"]]["id"]
+            for item in batch_items
+            if item["path"] in manifest.entries and not manifest.is_duplicate(item["path"])
+        ]
+        # Deleting the new ids as well makes a replayed batch idempotent
+        db.delete(ids=stale_ids + new_ids)
+        db.add_embeddings(
+            texts=[item["path"] for item in batch_items],
+            embeddings=embeddings,
+            metadatas=[
+                {"diagnosis": extract_diagnosis(os.path.basename(item["path"])), "path": item["path"]}
+                for item in batch_items
+            ],
+            ids=new_ids
+        )
+        for item, row_id in zip(batch_items, new_ids):
+            if item["path"] in manifest.entries:
+                summary["updated"] += 1
+            else:
+                summary["added"] += 1
+            manifest.entries[item["path"]] = dict(
+                found[item["path"]], sha256=item["sha256"], phash=item["phash"], id=row_id
+            )
+            queued.discard(item["path"])
+            for duplicate_path, duplicate in deferred.pop(item["path"], []):
+                manifest.entries[duplicate_path] = dict(duplicate, id=row_id)
+        manifest.save()
+        print(f"Committed batch of {len(batch_items)} images "
+              f"({summary['added'] + summary['updated'] + summary['duplicates']}/{len(todo)})")
+
+    def handle(result):
+        if result["error"]:
+            summary["errors"].append(f"Error processing {result['path']}: {result['error']}")
+            return
+        path = result["path"]
+        entry = manifest.entries.get(path)
+        if entry is not None and entry["sha256"] == result["sha256"]:
+            # Touched but not modified: refresh the manifest without re-embedding
+            entry.update(found[path])
+            entry.setdefault("phash", result["phash"])
+            if "duplicate_of" not in entry:
+                kept.add(path, entry["sha256"], entry["phash"])
+            summary["skipped"] += 1
+            return
+
+        match = kept.match(result["sha256"], result["phash"])
+        if match is not None:
+            canonical, reason, distance = match
+            if entry is not None and "duplicate_of" not in entry:
+                # Changed into a copy of another image: its own row is no longer needed
+                db.delete(ids=[entry["id"]])
+            duplicate = dict(
+                found[path], sha256=result["sha256"], phash=result["phash"],
+                duplicate_of=canonical, reason=reason, distance=distance
+            )
+            summary["duplicates"] += 1
+            if canonical in queued:
+                deferred.setdefault(canonical, []).append((path, duplicate))
+            else:
+                manifest.entries[path] = dict(duplicate, id=manifest.entries[canonical]["id"])
+            return
+
+        kept.add(path, result["sha256"], result["phash"])
+        queued.add(path)
+        pending_batch.append(result)
+        if len(pending_batch) >= batch_size:
+            commit(pending_batch[:])
+            pending_batch.clear()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(multimodal_ef.preprocess,)) as pool:
+        # Keep two chunks in flight so decoding overlaps with embedding without
+        # buffering the whole dataset's tensors in memory
+        in_flight = deque()
+        for chunk in _chunks(todo, batch_size):
+            in_flight.append(pool.map(load_and_preprocess, chunk, chunksize=8))
+            if len(in_flight) > 2:
+                for result in in_flight.popleft():
+                    handle(result)
+        while in_flight:
+            for result in in_flight.popleft():
+                handle(result)
+
+    if pending_batch:
+        commit(pending_batch)
+    manifest.save()
+    return summary
+
+def collapse_duplicates(db, extract_diagnosis, state_dir=".ingest", min_similarity=0.97, hidden=()):
+    """
+    Merge near-duplicate rows of db and write the dedup report next to the manifest.
+
+    Rows whose embeddings have a cosine similarity of at least min_similarity (0 skips this
+    step) are clustered; each cluster keeps the row of its first path in sorted order and the
+    other rows are deleted, their images recorded in the manifest as duplicates of it. Every
+    kept row that stands for several images (including the exact and perceptual duplicates
+    found by ingest_images) gets aggregated metadata: the majority diagnosis, the count per
+    diagnosis and the number of duplicates. Returns the report.
+    """
+    from .index_utils import LocalVectorIndex
+
+    manifest = IngestManifest(state_dir)
+    index = LocalVectorIndex(db)
+    index.refresh()
+    snapshot = index._snapshot
+    row_of = {row_id: row for row, row_id in enumerate(snapshot.ids)}
+
+    pairs = []
+    if min_similarity > 0 and len(snapshot.ids):
+        pairs = similar_pairs(snapshot.matrix, min_similarity)
+    roots = cluster_pairs(len(snapshot.ids), pairs)
+
+    groups = {}
+    for path, entry in manifest.entries.items():
+        row = row_of.get(entry["id"])
+        if row is not None:
+            groups.setdefault(roots[row], []).append(path)
+
+    deleted, rewrites, report_groups = [], [], []
+    by_reason = Counter()
+    for paths in groups.values():
+        owners = sorted(path for path in paths if not manifest.is_duplicate(path))
+        if not owners:
+            continue
+        keeper = owners[0]
+        keeper_id = manifest.entries[keeper]["id"]
+        keeper_row = row_of[keeper_id]
+        for path in paths:
+            entry = manifest.entries[path]
+            if path == keeper:
+                continue
+            if "duplicate_of" not in entry:
+                similarity = float(snapshot.matrix[row_of[entry["id"]]] @ snapshot.matrix[keeper_row])
+                deleted.append(entry["id"])
+                entry.update(reason="embedding", similarity=round(similarity, 4))
+            entry.update(id=keeper_id, duplicate_of=keeper)
+
+        labels = Counter(extract_diagnosis(os.path.basename(path)) for path in paths)
+        own_label = extract_diagnosis(os.path.basename(keeper))
+        diagnosis = max(labels, key=lambda name: (labels[name], name == own_label))
+        metadata = {"diagnosis": diagnosis, "path": keeper}
+        if len(paths) > 1:
+            metadata.update(duplicates=len(paths) - 1, diagnoses=dict(labels))
+            members = []
+            for path in sorted(paths):
+                if path != keeper:
+                    entry = manifest.entries[path]
+                    members.append(dict(
+                        {"path": path},
+                        **{key: entry[key] for key in ("reason", "distance", "similarity") if key in entry}
+                    ))
+            report_groups.append({"path": keeper, "diagnosis": diagnosis, "diagnoses": dict(labels), "members": members})
+            by_reason.update(member["reason"] for member in members)
+        if snapshot.metadatas[keeper_row] != metadata:
+            rewrites.append((keeper_id, keeper_row, metadata))
+
+    if deleted or rewrites:
+        try:
+            db.delete(ids=deleted + [row_id for row_id, _, _ in rewrites])
+            if rewrites:
+                db.add_embeddings(
+                    texts=[snapshot.documents[row] for _, row, _ in rewrites],
+                    embeddings=[snapshot.matrix[row].tolist() for _, row, _ in rewrites],
+                    metadatas=[metadata for _, _, metadata in rewrites],
+                    ids=[row_id for row_id, _, _ in rewrites]
+                )
+        except Exception:
+            # Forget the affected images so the next run indexes them again
+            affected = {row_id for row_id, _, _ in rewrites} | set(deleted)
+            reloaded = IngestManifest(state_dir)
+            reloaded.entries = {
+                path: entry for path, entry in reloaded.entries.items() if entry["id"] not in affected
+            }
+            reloaded.save()
+            raise
+    manifest.save()
+
+    report = {
+        "version": 1,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "min_similarity": min_similarity,
+        "images": len(manifest.entries),
+        "indexed": len(snapshot.ids) - len(deleted),
+        "duplicates": sum(by_reason.values()),
+        "by_reason": dict(by_reason),
+        "rows_deleted": len(deleted),
+        "rows_rewritten": len(rewrites),
+        "hidden_skipped": list(hidden),
+        "groups": sorted(report_groups, key=lambda group: (-len(group["members"]), group["path"]))
+    }
+    tmp_path = os.path.join(state_dir, DEDUP_REPORT_NAME + ".tmp")
+    with open(tmp_path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    os.replace(tmp_path, os.path.join(state_dir, DEDUP_REPORT_NAME))
+    return report
@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from .metrics_utils import CACHE_LOOKUPS
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves are not serialized between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Written by setup.py next to the ingestion manifest
+KNOWLEDGE_NAME = "knowledge.json"
+
+KNOWLEDGE_PROMPT = (
+    "Top Diagnosis: {diagnosis} (confidence 1.00), Patient history: not provided. "
+    "List the general risk factors and clinical features of this condition only."
+)
+
+def diagnosis_key(name):
+    """
+    Normalized lookup key for a diagnosis name: lower-case words in sorted order, so the
+    names extract_diagnosis derives from filenames ("Acne Cystic") and the model's
+    ("Cystic acne") share an entry.
+    """
+    return " ".join(sorted(re.findall(r"[a-z0-9]+", str(name).lower())))
+
+FACT_FIELDS = ("Risk factors", "Clinical features")
+
+def _new_entry(name, source):
+    return {"name": name, "source": source, "observations": 0, "Risk factors": Counter(), "Clinical features": Counter()}
+
+def _merge_entry(entries, key, delta):
+    """
+    Fold delta (one entry's observations) into entries. Offline entries replace learned
+    ones and learned facts never override offline ones. Returns False when delta was dropped.
+    """
+    entry = entries.get(key)
+    if entry is None or (delta["source"] == "offline" and entry["source"] != "offline"):
+        entry = entries[key] = _new_entry(delta["name"], delta["source"])
+    elif entry["source"] == "offline" and delta["source"] != "offline":
+        return False
+    entry["observations"] += delta["observations"]
+    for field in FACT_FIELDS:
+        entry[field].update(delta[field])
+    return True
+
+class KnowledgeStore:
+    """
+    Risk factors and clinical features per diagnosis, the parts of an answer that do not
+    depend on the image or history. Entries come from an offline build (setup.py) or, only
+    when learning is enabled, from the model's answers. Live answers are grounded in one
+    patient's image and history, so a learned fact is served only once min_observations
+    answers have agreed on it; each fact keeps a count of how often it was seen and lookups
+    return the most frequent max_facts.
+
+    Saved as JSON at most every save_interval seconds. Each save re-reads the file under a
+    lock and adds only what this process observed since its last save, so several worker
+    processes sharing the file accumulate their observations instead of overwriting them.
+    """
+
+    def __init__(self, path=None, max_facts=6, min_observations=1, save_interval=30.0, learning=False):
+        self.path = path
+        self.max_facts = max_facts
+        self.min_observations = min_observations
+        self.save_interval = save_interval
+        self.learning = learning
+        self._entries = self._read()
+        # Observations made since the last save, merged into the file by save()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read(self):
+        entries = {}
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "r") as knowledge_file:
+                for key, entry in json.load(knowledge_file).get("entries", {}).items():
+                    entries[key] = {
+                        "name": entry["name"],
+                        "source": entry.get("source", "llm"),
+                        "observations": entry.get("observations", 1),
+                        "Risk factors": Counter(entry.get("Risk factors", {})),
+                        "Clinical features": Counter(entry.get("Clinical features", {}))
+                    }
+        return entries
+
+    def _facts(self, entry, field):
+        # Learned facts must recur across answers; a one-off is likely about a single patient
+        min_count = 1 if entry["source"] == "offline" else self.min_observations
+        return [fact for fact, count in entry[field].most_common() if count >= min_count][:self.max_facts]
+
+    def get(self, name):
+        """The cached {"Diagnosis", "Risk factors", "Clinical features"} for name, or None."""
+        result = None
+        with self._lock:
+            entry = self._entries.get(diagnosis_key(name))
+            if entry is not None and (
+                entry["source"] == "offline" or (self.learning and entry["observations"] >= self.min_observations)
+            ):
+                result = {"Diagnosis": name}
+                result.update((field, self._facts(entry, field)) for field in FACT_FIELDS)
+                if not any(result[field] for field in FACT_FIELDS):
+                    result = None
+        CACHE_LOOKUPS.inc(level="knowledge", result="hit" if result is not None else "miss")
+        return result
+
+    def put(self, diagnosis, source="llm"):
+        """Record one diagnosis dict from a validated answer; entries without facts are ignored."""
+        self._record(diagnosis, source)
+        self._maybe_save()
+
+    def _record(self, diagnosis, source):
+        if not diagnosis["Risk factors"] and not diagnosis["Clinical features"]:
+            return
+        key = diagnosis_key(diagnosis["Diagnosis"])
+        delta = _new_entry(diagnosis["Diagnosis"], source)
+        delta["observations"] = 1
+        for field in FACT_FIELDS:
+            delta[field].update(fact.strip() for fact in diagnosis[field] if fact.strip())
+        with self._lock:
+            if _merge_entry(self._entries, key, delta):
+                _merge_entry(self._pending, key, delta)
+
+    def learn(self, diagnoses, names):
+        """
+        Learn from an answer when learning is enabled, keeping only diagnoses whose key
+        matches one of names (the retrieval shortlist), so entries stay keyed by the
+        dataset's diagnosis names.
+        """
+        if not self.learning:
+            return
+        known = {diagnosis_key(name): name for name in names}
+        for diagnosis in diagnoses:
+            name = known.get(diagnosis_key(diagnosis["Diagnosis"]))
+            if name is not None:
+                self._record(dict(diagnosis, Diagnosis=name), "llm")
+        self._maybe_save()
+
+    def _maybe_save(self):
+        # Runs on the request path: a failed save must not fail the answer that triggered it.
+        # save() keeps the observations, so the next interval retries them.
+        if self.path and time.monotonic() - self._saved_at >= self.save_interval:
+            try:
+                self.save()
+            except Exception:
+                logger.exception("Could not save the knowledge store to %s", self.path)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        """
+        Merge this process's observations since the last save into the file, then reload it.
+        Raises on failure, keeping the observations for the next save.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._saved_at = time.monotonic()
+        if not pending:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with self._file_lock():
+                entries = self._read()
+                for key, delta in pending.items():
+                    _merge_entry(entries, key, delta)
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as knowledge_file:
+                    json.dump({
+                        "version": 1,
+                        "entries": {
+                            key: {
+                                "name": entry["name"],
+                                "source": entry["source"],
+                                "observations": entry["observations"],
+                                "Risk factors": dict(entry["Risk factors"]),
+                                "Clinical features": dict(entry["Clinical features"])
+                            }
+                            for key, entry in entries.items()
+                        }
+                    }, knowledge_file)
+                os.replace(tmp_path, self.path)
+        except Exception:
+            # Keep the observations for the next save
+            with self._lock:
+                for key, delta in pending.items():
+                    _merge_entry(self._pending, key, delta)
+            raise
+        with self._lock:
+            # The file now holds every process's observations; re-apply what arrived meanwhile
+            for key, delta in self._pending.items():
+                _merge_entry(entries, key, delta)
+            self._entries = entries
+
+def knowledge_result(shortlist, store):
+    """
+    A diagnosis result ({"response", "diagnoses", "usage", "source"}) built from the store
+    for the shortlist entries it knows, best first. None when the top entry is unknown.
+    """
+    diagnoses = []
+    for position, entry in enumerate(shortlist):
+        cached = store.get(entry["diagnosis"])
+        if cached is None and position == 0:
+            return None
+        if cached is not None:
+            diagnoses.append(cached)
+    return {"response": json.dumps(diagnoses), "diagnoses": diagnoses, "usage": None, "source": "knowledge"}
+
+def build_knowledge(names, query, store):
+    """
+    Offline build: ask the model (query(text_prompt) -> diagnosis result) once per diagnosis
+    name for its general facts and store them as "offline" entries. Returns the names that failed.
+    """
+    failed = []
+    for name in names:
+        try:
+            result = query(KNOWLEDGE_PROMPT.format(diagnosis=name))
+            answer = next(
+                (d for d in result["diagnoses"] if diagnosis_key(d["Diagnosis"]) == diagnosis_key(name)),
+                result["diagnoses"][0] if result["diagnoses"] else None
+            )
+            if answer is None:
+                raise ValueError("empty answer")
+            store.put(dict(answer, Diagnosis=name), source="offline")
+        except Exception as e:
+            logger.warning("Could not build knowledge for %s: %s", name, e)
+            failed.append(name)
+    store.save()
+    return failed
+
+def create_knowledge_store():
+    """
+    KnowledgeStore at KNOWLEDGE_PATH (default .ingest/knowledge.json). Learning from live
+    answers is off unless KNOWLEDGE_LEARN is "true"; KNOWLEDGE_MIN_OBSERVATIONS sets how many
+    answers must agree before a learned entry, and each of its facts, is served.
+    """
+    return KnowledgeStore(
+        os.getenv('KNOWLEDGE_PATH') or os.path.join(".ingest", KNOWLEDGE_NAME),
+        max_facts=int(os.getenv('KNOWLEDGE_MAX_FACTS', '6')),
+        min_observations=int(os.getenv('KNOWLEDGE_MIN_OBSERVATIONS', '2')),
+        learning=os.getenv('KNOWLEDGE_LEARN', 'false').lower() in ('1', 'true', 'yes')
+    )
@@ -0,0 +1,43 @@
+import logging
+import os
+import re
+import uuid
+from contextvars import ContextVar
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+
+# Set per request by the web layer; "-" outside of a request (startup, background threads)
+request_id_var = ContextVar("request_id", default="-")
+
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request id to every record so log lines can be correlated."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+def configure_logging(level=None):
+    """
+    Route all loggers to stderr at LOG_LEVEL (default INFO), tagging each line with the
+    request id. Debug messages use lazy %-formatting, so they cost a level check when disabled.
+    """
+    root = logging.getLogger()
+    if any(getattr(handler, "_dermacare", False) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RequestIdFilter())
+    handler._dermacare = True
+    root.addHandler(handler)
+    root.setLevel((level or os.getenv('LOG_LEVEL', 'INFO')).upper())
+    # httpx logs every OpenAI request at INFO; those are already covered by metrics
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+def bind_request_id(incoming=None):
+    """Use the caller's X-Request-ID when it is well formed, otherwise generate one; returns it."""
+    request_id = incoming if incoming and _VALID_REQUEST_ID.match(incoming) else uuid.uuid4().hex
+    request_id_var.set(request_id)
+    return request_id
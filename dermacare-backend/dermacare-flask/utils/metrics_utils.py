@@ -0,0 +1,230 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+class Histogram:
+    """Thread-safe cumulative histogram with fixed upper bounds, in the Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """Return cumulative bucket counts keyed by upper bound, plus count and sum."""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+
+        cumulative = {}
+        running = 0
+        for bound, bucket_count in zip(self.buckets + [float('inf')], counts):
+            running += bucket_count
+            cumulative['+Inf' if bound == float('inf') else str(bound)] = running
+        return {"buckets": cumulative, "count": count, "sum": total}
+
+def _format_labels(label_names, values, extra=()):
+    pairs = list(zip(label_names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {",".join(key): value for key, value in self._values.items()}
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in values)
+        return lines
+
+class Gauge(Counter):
+    """Value that can go up and down (queue depth, in-flight work), with optional labels."""
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class HistogramFamily:
+    """A Histogram per combination of label values, sharing one set of buckets."""
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = tuple(label_names)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def render(self):
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, histogram in histograms:
+            lines.extend(render_histogram(self.name, histogram, self.label_names, key))
+        return lines
+
+def render_histogram(name, histogram, label_names=(), values=()):
+    snapshot = histogram.snapshot()
+    lines = [
+        f"{name}_bucket{_format_labels(label_names, values, [('le', bound)])} {count}"
+        for bound, count in snapshot["buckets"].items()
+    ]
+    lines.append(f"{name}_sum{_format_labels(label_names, values)} {snapshot['sum']}")
+    lines.append(f"{name}_count{_format_labels(label_names, values)} {snapshot['count']}")
+    return lines
+
+class _HistogramView:
+    def __init__(self, name, help_text, histogram):
+        self.name = name
+        self.help_text = help_text
+        self.histogram = histogram
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        return lines + render_histogram(self.name, self.histogram)
+
+class MetricsRegistry:
+    """Process-wide collection of metrics, rendered together for the /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name, metric):
+        with self._lock:
+            existing = self._metrics.setdefault(name, metric)
+        return existing
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(name, Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(name, Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, buckets, label_names=()):
+        return self._register(name, HistogramFamily(name, help_text, buckets, label_names))
+
+    def add_histogram(self, name, help_text, histogram):
+        """Expose an existing unlabelled Histogram (e.g. EmbeddingBatcher's) under name."""
+        with self._lock:
+            self._metrics[name] = _HistogramView(name, help_text, histogram)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+REGISTRY = MetricsRegistry()
+REQUESTS = REGISTRY.counter("dermacare_requests_total", "HTTP requests by endpoint and status", ("endpoint", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "dermacare_request_seconds", "End-to-end request latency", LATENCY_BUCKETS, ("endpoint",)
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "dermacare_stage_seconds", "Time spent in each stage of a prediction", LATENCY_BUCKETS, ("endpoint", "stage")
+)
+ERRORS = REGISTRY.counter("dermacare_errors_total", "Unhandled errors by exception type", ("endpoint", "type"))
+CACHE_LOOKUPS = REGISTRY.counter(
+    "dermacare_cache_lookups_total", "Prediction cache lookups by level and result", ("level", "result")
+)
+OPENAI_TOKENS = REGISTRY.counter("dermacare_openai_tokens_total", "OpenAI tokens used", ("model", "kind"))
+IMAGE_BYTES = REGISTRY.counter(
+    "dermacare_image_bytes_total", "Image bytes uploaded and after normalization", ("stage",)
+)
+IMAGE_BYTES_SAVED = REGISTRY.histogram(
+    "dermacare_image_bytes_saved", "Bytes removed from each image by normalization",
+    [0, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+)
+ADMISSION_IN_FLIGHT = REGISTRY.gauge(
+    "dermacare_admission_in_flight", "Admitted predictions running, by priority class", ("priority",)
+)
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "dermacare_admission_queue_depth", "Predictions waiting for admission, by priority class", ("priority",)
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "dermacare_admission_wait_seconds", "Time from arrival to admission", LATENCY_BUCKETS, ("priority",)
+)
+ADMISSION_REJECTED = REGISTRY.counter(
+    "dermacare_admission_rejected_total", "Predictions shed by the admission layer", ("priority", "reason")
+)
+SEARCH_FALLBACKS = REGISTRY.counter(
+    "dermacare_search_fallbacks_total", "Searches answered from the prototype table instead of the index", ("reason",)
+)
+
+class StageTimer:
+    """
+    Per-request stage durations. Each stage is recorded into STAGE_SECONDS when it ends and
+    kept on the timer, so the request can report its own breakdown (see server_timing).
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            STAGE_SECONDS.observe(elapsed, endpoint=self.endpoint, stage=name)
+
+    def server_timing(self):
+        """Value for a Server-Timing response header, durations in milliseconds."""
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items())
+
+def timed(timer, name):
+    """timer.stage(name), or a no-op when the caller passed no timer."""
+    return timer.stage(name) if timer is not None else nullcontext()
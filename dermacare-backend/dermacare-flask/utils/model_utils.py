@@ -0,0 +1,322 @@
+"""
+Loading the OpenCLIP image/text model, optionally from a local pre-serialized artifact.
+
+Export the weights once:
+    python -m utils.model_utils export clip-vit-b-32.pt
+then set CLIP_WEIGHTS_PATH=clip-vit-b-32.pt. The state dict is memory-mapped on load,
+so startup skips the open_clip download/checkpoint path and pre-forked workers share
+the weight pages through the OS page cache.
+
+For CPU serving the image tower can also be exported on its own, optionally int8-quantized:
+    python -m utils.model_utils export-image clip-image.onnx --format onnx --quantize
+and selected with EMBED_BACKEND=onnx EMBED_BACKEND_PATH=clip-image.onnx (EMBED_THREADS
+sets the intra-op thread count). Before switching, compare it against the torch model:
+    python -m utils.model_utils verify clip-image.onnx --dataset ../data/dermnet_data
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLIP_MODEL_NAME = "ViT-B-32"
+CLIP_CHECKPOINT = "laion2b_s34b_b79k"
+EMBED_BACKENDS = ('torch', 'onnx', 'torchscript')
+
+def load_clip_embeddings(model_name=CLIP_MODEL_NAME, checkpoint=CLIP_CHECKPOINT, weights_path=None):
+    """Return an OpenCLIPEmbeddings, built from CLIP_WEIGHTS_PATH when that artifact exists."""
+    from langchain_experimental.open_clip import OpenCLIPEmbeddings
+
+    if weights_path is None:
+        weights_path = os.getenv('CLIP_WEIGHTS_PATH')
+    if not weights_path or not os.path.exists(weights_path):
+        return OpenCLIPEmbeddings(model_name=model_name, checkpoint=checkpoint)
+
+    import open_clip
+    import torch
+
+    logger.info("Loading CLIP weights from %s", weights_path)
+    model, _, preprocess = open_clip.create_model_and_transforms(model_name=model_name, pretrained=None)
+    state_dict = torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+
+    # model_construct skips the validator that would load the checkpoint again
+    return OpenCLIPEmbeddings.model_construct(
+        model=model,
+        preprocess=preprocess,
+        tokenizer=open_clip.get_tokenizer(model_name),
+        model_name=model_name,
+        checkpoint=checkpoint
+    )
+
+def export_clip_weights(path, model_name=CLIP_MODEL_NAME, checkpoint=CLIP_CHECKPOINT):
+    """Save the pretrained weights as a plain state dict that load_clip_embeddings can memory-map."""
+    import torch
+
+    multimodal_ef = load_clip_embeddings(model_name, checkpoint, weights_path="")
+    torch.save(multimodal_ef.model.state_dict(), path)
+    print(f"Saved {model_name}/{checkpoint} weights to {path}")
+
+def _preprocess_config(visual):
+    # open_clip records the transform it built on the vision tower; older releases only have image_size
+    config = dict(getattr(visual, 'preprocess_cfg', None) or {"size": visual.image_size})
+    config.pop("mode", None)
+    if isinstance(config.get("size"), tuple):
+        config["size"] = list(config["size"])
+    return config
+
+def _image_transform(config):
+    import open_clip
+
+    config = dict(config)
+    size = config.pop("size")
+    return open_clip.image_transform(tuple(size) if isinstance(size, list) else size, is_train=False, **config)
+
+def export_image_encoder(path, fmt="onnx", quantize=False, model_name=CLIP_MODEL_NAME, checkpoint=CLIP_CHECKPOINT):
+    """
+    Export the CLIP image tower (pixels -> unit-norm embedding) as ONNX or TorchScript.
+    quantize applies dynamic int8 quantization to the linear layers. The preprocessing
+    settings and embedding size are written to <path>.json for CompiledImageEmbeddings.
+    """
+    import torch
+
+    if fmt not in ('onnx', 'torchscript'):
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    model = load_clip_embeddings(model_name, checkpoint).model.eval()
+
+    class ImageEncoder(torch.nn.Module):
+        def __init__(self, clip_model):
+            super().__init__()
+            self.clip_model = clip_model
+
+        def forward(self, pixels):
+            return self.clip_model.encode_image(pixels, normalize=True)
+
+    encoder = ImageEncoder(model).eval()
+    preprocess = _preprocess_config(model.visual)
+    size = preprocess["size"]
+    height, width = (size, size) if isinstance(size, int) else size
+    example = torch.randn(1, 3, height, width)
+
+    if fmt == 'onnx':
+        export_path = path + ".fp32" if quantize else path
+        torch.onnx.export(
+            encoder,
+            example,
+            export_path,
+            input_names=["pixels"],
+            output_names=["embeddings"],
+            dynamic_axes={"pixels": {0: "batch"}, "embeddings": {0: "batch"}},
+            opset_version=17
+        )
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(export_path, path, weight_type=QuantType.QInt8)
+            os.remove(export_path)
+    else:
+        if quantize:
+            encoder = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            traced = torch.jit.trace(encoder, example)
+        torch.jit.save(traced, path)
+
+    with open(path + ".json", "w") as config_file:
+        json.dump({
+            "format": fmt,
+            "quantized": quantize,
+            "model_name": model_name,
+            "checkpoint": checkpoint,
+            "output_dim": model.visual.output_dim,
+            "preprocess": preprocess
+        }, config_file, indent=2)
+    print(f"Saved {fmt}{' int8' if quantize else ''} image encoder for {model_name}/{checkpoint} to {path}")
+
+class CompiledImageEmbeddings:
+    """
+    CLIP image embedder running an exported image tower (ONNX Runtime or TorchScript) on CPU.
+    Provides the image side of OpenCLIPEmbeddings (preprocess, embed_image, embed_images)
+    plus encode_pixel_batch, so EmbeddingBatcher and ingestion use it unchanged. Text
+    embedding is rarely needed when serving, so the full torch model is loaded on first use.
+    """
+
+    def __init__(self, path, num_threads=None):
+        with open(path + ".json", "r") as config_file:
+            self.config = json.load(config_file)
+        self.path = path
+        self.format = self.config["format"]
+        self.output_dim = self.config["output_dim"]
+        self.preprocess = _image_transform(self.config["preprocess"])
+        self._text_ef = None
+        self._text_lock = threading.Lock()
+
+        if self.format == 'onnx':
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+            self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self.input_name = self.session.get_inputs()[0].name
+        elif self.format == 'torchscript':
+            import torch
+
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            self.module = torch.jit.load(path, map_location="cpu").eval()
+        else:
+            raise ValueError(f"Unknown image encoder format: {self.format}")
+
+    def encode_pixel_batch(self, pixel_tensors):
+        """One forward pass over preprocessed pixel tensors; returns unit-norm embeddings as lists."""
+        import torch
+
+        batch = torch.stack(pixel_tensors)
+        if self.format == 'onnx':
+            return self.session.run(None, {self.input_name: batch.numpy()})[0].tolist()
+        with torch.no_grad():
+            return self.module(batch).tolist()
+
+    def embed_images(self, image_sources):
+        from .image_utils import open_image
+
+        return self.encode_pixel_batch([self.preprocess(open_image(source)) for source in image_sources])
+
+    def embed_image(self, uris):
+        """Drop-in replacement for OpenCLIPEmbeddings.embed_image."""
+        return self.embed_images(uris)
+
+    def _text_embeddings(self):
+        with self._text_lock:
+            if self._text_ef is None:
+                self._text_ef = load_clip_embeddings(self.config["model_name"], self.config["checkpoint"])
+        return self._text_ef
+
+    def embed_documents(self, texts):
+        return self._text_embeddings().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._text_embeddings().embed_query(text)
+
+def load_embedding_backend(backend=None, path=None, num_threads=None):
+    """
+    Return the CLIP embedder selected by EMBED_BACKEND: "torch" (default, OpenCLIPEmbeddings),
+    or "onnx"/"torchscript" running the image tower exported to EMBED_BACKEND_PATH.
+    EMBED_THREADS caps the intra-op threads used per forward pass.
+    """
+    backend = (backend or os.getenv('EMBED_BACKEND', 'torch')).lower()
+    path = path or os.getenv('EMBED_BACKEND_PATH')
+    if num_threads is None and os.getenv('EMBED_THREADS'):
+        num_threads = int(os.getenv('EMBED_THREADS'))
+
+    if backend not in EMBED_BACKENDS:
+        raise ValueError(f"Unknown EMBED_BACKEND: {backend}")
+    if backend == 'torch':
+        if num_threads:
+            import torch
+
+            torch.set_num_threads(num_threads)
+        return load_clip_embeddings()
+
+    if not path:
+        raise ValueError(f"EMBED_BACKEND={backend} requires EMBED_BACKEND_PATH")
+    embedder = CompiledImageEmbeddings(path, num_threads=num_threads)
+    if embedder.format != backend:
+        raise ValueError(f"{path} is a {embedder.format} export, not {backend}")
+    logger.info("Using %s%s image encoder from %s",
+                backend, " int8" if embedder.config.get("quantized") else "", path)
+    return embedder
+
+def _embed_all(embedder, paths, batch_size):
+    from .db_utils import embed_images
+
+    embeddings = []
+    started = time.perf_counter()
+    for i in range(0, len(paths), batch_size):
+        embeddings.extend(embed_images(embedder, paths[i:i + batch_size]))
+    return embeddings, time.perf_counter() - started
+
+def verify_backend(path, dataset, limit=200, k=5, batch_size=16, num_threads=None):
+    """
+    Embed a reference image set with the torch model and an exported image encoder, and
+    report how closely they agree: cosine similarity between the two embeddings of each
+    image, overlap of their top-k neighbours in the dermnet_multimodal collection and
+    whether the nearest neighbour's diagnosis is the same.
+    """
+    import numpy as np
+    from .db_utils import connect_db
+    from .ingest_utils import scan_images
+
+    paths = sorted(scan_images(dataset))
+    if limit:
+        # Spread the sample across diagnosis folders rather than taking the first few
+        paths = paths[::max(1, len(paths) // limit)][:limit]
+    if not paths:
+        raise ValueError(f"No images found under {dataset}")
+
+    reference = load_clip_embeddings()
+    candidate = CompiledImageEmbeddings(path, num_threads=num_threads)
+    reference_embeddings, reference_seconds = _embed_all(reference, paths, batch_size)
+    candidate_embeddings, candidate_seconds = _embed_all(candidate, paths, batch_size)
+
+    a = np.asarray(reference_embeddings, dtype=np.float32)
+    b = np.asarray(candidate_embeddings, dtype=np.float32)
+    cosine = np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+    db = connect_db(reference)
+    overlaps, same_top1 = [], 0
+    for reference_embedding, candidate_embedding in zip(reference_embeddings, candidate_embeddings):
+        expected = db.similarity_search_by_vector(reference_embedding, k=k)
+        actual = db.similarity_search_by_vector(candidate_embedding, k=k)
+        expected_paths = {doc.metadata.get("path") for doc in expected}
+        overlaps.append(len(expected_paths & {doc.metadata.get("path") for doc in actual}) / max(len(expected), 1))
+        if expected and actual and expected[0].metadata.get("diagnosis") == actual[0].metadata.get("diagnosis"):
+            same_top1 += 1
+
+    return {
+        "backend": candidate.format,
+        "quantized": candidate.config.get("quantized", False),
+        "images": len(paths),
+        "k": k,
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "topk_overlap_mean": float(np.mean(overlaps)),
+        "top1_diagnosis_agreement": same_top1 / len(paths),
+        "reference_images_per_second": len(paths) / reference_seconds,
+        "candidate_images_per_second": len(paths) / candidate_seconds
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CLIP model artifacts")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export_parser = subcommands.add_parser("export", help="Export pretrained weights for fast loading")
+    export_parser.add_argument("path")
+    image_parser = subcommands.add_parser("export-image", help="Export the image tower for EMBED_BACKEND")
+    image_parser.add_argument("path")
+    image_parser.add_argument("--format", choices=["onnx", "torchscript"], default="onnx")
+    image_parser.add_argument("--quantize", action="store_true", help="Dynamic int8 quantization")
+    verify_parser = subcommands.add_parser("verify", help="Compare an exported image tower with the torch model")
+    verify_parser.add_argument("path")
+    verify_parser.add_argument("--dataset", default="../data/dermnet_data")
+    verify_parser.add_argument("--limit", type=int, default=200, help="Reference images to sample (0 = all)")
+    verify_parser.add_argument("--k", type=int, default=5)
+    verify_parser.add_argument("--threads", type=int, default=None)
+    verify_parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_clip_weights(args.path)
+    elif args.command == "export-image":
+        export_image_encoder(args.path, fmt=args.format, quantize=args.quantize)
+    elif args.command == "verify":
+        report = verify_backend(args.path, args.dataset, limit=args.limit, k=args.k, num_threads=args.threads)
+        print(json.dumps(report, indent=2))
+        if args.output:
+            with open(args.output, "w") as report_file:
+                json.dump(report, report_file, indent=2)
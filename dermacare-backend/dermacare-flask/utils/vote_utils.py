@@ -0,0 +1,71 @@
+import json
+import numpy as np
+
+def rank_diagnoses(scored_results, temperature=0.05, limit=None):
+    """
+    Aggregate (Document, cosine distance) neighbours into a ranked shortlist of diagnoses.
+
+    Each neighbour votes for its diagnosis with weight softmax(similarity / temperature),
+    so close neighbours dominate and a long tail of weak matches cannot outvote them.
+    The votes are summed per diagnosis with one bincount, so a larger k costs little.
+    Returns [{"diagnosis", "score", "votes", "similarity"}] best first, where score is the
+    diagnosis's share of the total vote (scores sum to 1 over all diagnoses) and
+    similarity is its best neighbour's cosine similarity.
+    """
+    if not scored_results:
+        return []
+    labels = [doc.metadata.get("diagnosis") or "Unknown" for doc, _ in scored_results]
+    similarities = 1.0 - np.array([distance for _, distance in scored_results], dtype=np.float64)
+
+    names, inverse = np.unique(labels, return_inverse=True)
+    logits = similarities / temperature
+    weights = np.exp(logits - logits.max())
+    scores = np.bincount(inverse, weights=weights, minlength=len(names))
+    scores /= scores.sum()
+    votes = np.bincount(inverse, minlength=len(names))
+    best = np.full(len(names), -np.inf)
+    np.maximum.at(best, inverse, similarities)
+
+    order = np.argsort(-scores, kind='stable')
+    if limit:
+        order = order[:limit]
+    return [
+        {
+            "diagnosis": str(names[i]),
+            "score": round(float(scores[i]), 4),
+            "votes": int(votes[i]),
+            "similarity": round(float(best[i]), 4)
+        }
+        for i in order
+    ]
+
+def dominant_diagnosis(shortlist, min_confidence=None, min_votes=1):
+    """
+    The top diagnosis when it holds at least min_confidence of the vote from at least
+    min_votes neighbours, otherwise None. A min_confidence of None disables the check.
+    """
+    if min_confidence is None or not shortlist:
+        return None
+    top = shortlist[0]
+    if top["score"] >= min_confidence and top["votes"] >= min_votes:
+        return top
+    return None
+
+def early_exit_response(entry):
+    """A diagnosis result, shaped like the LLM call's, for a diagnosis settled by retrieval alone."""
+    diagnoses = [{"Diagnosis": entry["diagnosis"], "Risk factors": [], "Clinical features": []}]
+    return {"response": json.dumps(diagnoses), "diagnoses": diagnoses, "usage": None, "source": "retrieval"}
+
+def prediction_payload(result, shortlist, early_exit=False):
+    """
+    The /predict response body: the diagnosis result ({"response", "diagnoses", "usage"},
+    or None before the LLM has answered) plus the ranked shortlist and its confidence.
+    """
+    payload = dict(result or {})
+    payload.update(
+        similar_diagnoses=[entry["diagnosis"] for entry in shortlist],
+        shortlist=shortlist,
+        confidence=shortlist[0]["score"] if shortlist else None,
+        early_exit=early_exit
+    )
+    return payload
@@ -24,6 +24,11 @@ const DiagnosisSection = ({ diagnosisResult, isLoading }) => {
       // Log the raw response for debugging
       console.log("Raw response:", response);
 
+      // The server validates the answer and returns it parsed
+      if (Array.isArray(response.diagnoses)) {
+        return response.diagnoses;
+      }
+
       // Remove markdown code block syntax and parse JSON
       const jsonStr = response.response.replace(/```json\n|\n```/g, '');
       return JSON.parse(jsonStr);
@@ -39,6 +39,9 @@ const ReferralSection = ({ diagnosisResult, isLoading, formData }) => {
 
   const parseResponse = (response) => {
     try {
+      if (Array.isArray(response.diagnoses)) {
+        return response.diagnoses;
+      }
       const jsonStr = response.response.replace(/```json\n|\n```/g, '');
       return JSON.parse(jsonStr);
     } catch (error) {